@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.accelerometer
+    ~~~~~~~~~~~~~~~~~~~
+
+    Collection of utilities for raw accelerometer data
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+
+"""
+Epoch level activity from raw tri-axial accelerometer samples.
+
+Samples are expected in g units at a fixed sampling rate, as an array of
+shape (samples, 3). Large recordings can be processed chunk by chunk
+(e.g., slices of a `numpy.memmap`), since the filter state and the
+samples of an incomplete epoch are carried over to the next chunk.
+"""
+
+
+ACTIVITY_METHODS = ('enmo', 'counts')
+
+
+def enmo(values):
+    """
+    Calculates Euclidean norm minus one (ENMO).
+
+    Negative values are truncated to zero.
+
+    van Hees, V. T., et al. "Separating movement and gravity components
+    in an acceleration signal and implications for the assessment of
+    human daily physical activity." PloS one 8.4 (2013): e61691.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of shape (samples, 3) with acceleration in g.
+
+    Returns
+    -------
+    ndarray
+        ENMO of each sample.
+    """
+
+    values = np.asarray(values, dtype='f8')
+    norm = np.sqrt(np.einsum('ij,ij->i', values, values))
+    return np.maximum(norm - 1, 0)
+
+
+def _bandpass_filter(sampling_rate, low=0.29, high=1.63, order=4):
+    """
+    Creates band-pass filter (second-order sections) for activity counts.
+    """
+
+    return signal.butter(order, [low, high], btype='bandpass',
+                         fs=sampling_rate, output='sos')
+
+
+def iter_epoch_activity(chunks, sampling_rate, start, epoch='60s',
+                        method='enmo', state=None):
+    """
+    Lazily calculates epoch level activity from chunks of samples.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Arrays of shape (samples, 3) with acceleration in g. Chunks
+        must be consecutive and can have any length.
+    sampling_rate : float
+        Samples per second.
+    start : DateTime
+        Time of the first sample (in local time).
+    epoch : str or Timedelta
+        Epoch length. It must be a multiple of the sampling period.
+        Default is '60s'.
+    method : str
+        Either 'enmo' (mean ENMO of each epoch, in g) or 'counts'.
+        Counts are computed by band-pass filtering (0.29-1.63 Hz) each
+        axis, summing the rectified signal over each epoch and taking
+        the vector magnitude of the three axes. They are not
+        calibrated to the counts of any particular device.
+        Default is 'enmo'.
+    state : dict
+        If given, the filter state and incomplete epoch are kept in
+        `state`, so the stream can be continued in a later call with
+        the same `state`. Default is None.
+
+    Returns
+    -------
+    generator
+        One DataFrame for each chunk, indexed by the start of the
+        epochs, with `method` as column. Only complete epochs are
+        yielded.
+    """
+
+    if method not in ACTIVITY_METHODS:
+        raise ValueError('Unknown method: {0}. Must be one of {1}'.format(
+            method, ACTIVITY_METHODS))
+
+    epoch = pd.Timedelta(epoch)
+    epoch_len = epoch.total_seconds() * sampling_rate
+    if epoch_len < 1 or not np.isclose(epoch_len, round(epoch_len)):
+        raise ValueError('Epoch must be a multiple of the sampling period')
+    epoch_len = int(round(epoch_len))
+
+    if state is None:
+        state = {}
+    state.setdefault('epochs', 0)
+    state.setdefault('rest', None)
+    if method == 'counts':
+        sos = _bandpass_filter(sampling_rate)
+    start = pd.Timestamp(start)
+
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype='f8')
+        if len(chunk) == 0:
+            continue
+
+        if method == 'enmo':
+            x = enmo(chunk)
+        else:
+            if state.get('zi') is None:
+                # start from steady state to avoid the initial transient
+                zi = signal.sosfilt_zi(sos)
+                state['zi'] = zi[:, :, None] * chunk[0][None, None, :]
+            x, state['zi'] = signal.sosfilt(sos, chunk, axis=0,
+                                            zi=state['zi'])
+            x = np.abs(x)
+
+        if state['rest'] is not None:
+            x = np.concatenate([state['rest'], x])
+        n = len(x) // epoch_len
+        state['rest'] = x[n * epoch_len:]
+        if n == 0:
+            continue
+
+        x = x[:n * epoch_len].reshape((n, epoch_len) + x.shape[1:])
+        if method == 'enmo':
+            values = x.mean(axis=1)
+        else:
+            values = np.sqrt((x.sum(axis=1) ** 2).sum(axis=1))
+
+        index = start + epoch * np.arange(state['epochs'],
+                                          state['epochs'] + n)
+        state['epochs'] += n
+        yield pd.DataFrame({method: values}, index=pd.DatetimeIndex(index))
+
+
+def epoch_activity(values, sampling_rate, start, epoch='60s',
+                   method='enmo', chunk_size=2**20):
+    """
+    Calculates epoch level activity from raw samples.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of shape (samples, 3) with acceleration in g. A
+        `numpy.memmap` can be used for recordings that do not fit
+        in memory, since only `chunk_size` samples are read at a time.
+    sampling_rate : float
+        Samples per second.
+    start : DateTime
+        Time of the first sample (in local time).
+    epoch : str or Timedelta
+        Epoch length. Default is '60s'.
+    method : str
+        Either 'enmo' or 'counts'. See `iter_epoch_activity`.
+        Default is 'enmo'.
+    chunk_size : int
+        Number of samples processed at a time. Default is 2**20.
+
+    Returns
+    -------
+    DataFrame
+        Indexed by the start of the epochs, with `method` as column.
+        Samples of the last incomplete epoch are ignored.
+    """
+
+    chunks = (values[i:i + chunk_size]
+              for i in range(0, len(values), chunk_size))
+    l = list(iter_epoch_activity(chunks, sampling_rate, start, epoch=epoch,
+                                 method=method))
+
+    if len(l) == 0:
+        return pd.DataFrame({method: np.empty(0)},
+                            index=pd.DatetimeIndex([]))
+
+    return pd.concat(l)
+
+
+def hourly_activity(epochs, value_col, how='sum'):
+    """
+    Aggregates epoch level activity by hour.
+
+    The result can be used with `anvil.circadian.inter_daily_stability`
+    and `anvil.circadian.intra_daily_variability`.
+
+    Parameters
+    ----------
+    epochs : DataFrame
+        DataFrame with `DateTimeIndex`, e.g., from `epoch_activity`.
+    value_col : str
+        Column with activity values.
+    how : str
+        Either 'sum' or 'mean' of the values in each hour.
+        Default is 'sum'.
+
+    Returns
+    -------
+    DataFrame
+        It contains date, hour and value columns sorted by date
+        and hour. Hours without epochs are not included.
+    """
+
+    if how not in ('sum', 'mean'):
+        raise ValueError('Unknown aggregation: {0}. Must be either '
+                         'sum or mean'.format(how))
+
+    index = pd.DatetimeIndex(epochs.index)
+    g = epochs[value_col].groupby([index.date, index.hour]).agg(how)
+
+    return pd.DataFrame({'date': g.index.get_level_values(0),
+                         'hour': g.index.get_level_values(1),
+                         'value': g.values})
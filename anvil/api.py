@@ -8,6 +8,16 @@
     :copyright: (c) 2016 by Saeed Abdullah.
 """
 
-from .utils import convert_time_zone, get_hourly_distribution
+from .utils import convert_time_zone, get_hourly_distribution,\
+    get_hourly_tensor, resample_to_grid, sessionize, get_hourly_usage
 from .circadian import inter_daily_stability, intra_daily_variability,\
-    calculate_srm, rolling_srm_across_users
+    calculate_srm, rolling_srm_across_users, cosinor_across_users,\
+    sleep_regularity_index
+from .parallel import apply_by_user
+from .cache import disk_cache
+from .pyramid import build_aggregation_pyramid, query_pyramid
+from .accelerometer import epoch_activity, hourly_activity
+from .pipeline import compute_features
+from .approximate import stratified_sample,\
+    approximate_inter_daily_stability, approximate_hourly_distribution,\
+    approximate_daily_location_cluster_count
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.approximate
+    ~~~~~~~~~~~~~~~~~
+
+    Collection of approximate (sampling based) feature computations
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from .circadian import inter_daily_stability
+from .location import daily_location_cluster_count
+from .utils import _to_nanoseconds
+
+
+"""
+Approximate mode.
+
+Each function keeps at most `sample_size` rows of every stratum (e.g.,
+user-day or hour) and computes the feature on the sample, along with
+an error estimate. Daily location cluster counts can also be
+approximated with the `sample_size` option of
+`anvil.location.daily_location_cluster_count`. Smaller `sample_size`
+values trade accuracy for speed. These functions are meant for
+exploratory analysis; use the exact functions for final results.
+"""
+
+
+def _random_state(random_state):
+    """
+    Creates `np.random.RandomState` from seed (or state).
+    """
+
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
+
+
+def stratified_sample(df, strata, sample_size, random_state=None):
+    """
+    Samples at most `sample_size` rows of each stratum.
+
+    Rows of each stratum are sampled uniformly without replacement
+    (as with reservoir sampling), and strata with fewer rows are kept
+    as they are.
+
+    Parameters
+    ----------
+    df : DataFrame
+    strata : array-like or list
+        Stratum keys, i.e., anything accepted by `DataFrame.groupby`
+        (e.g., a column name, an array or a list of arrays).
+    sample_size : int
+        Maximum number of rows in each stratum.
+    random_state : int or np.random.RandomState
+        Seed of random numbers. Default is None.
+
+    Returns
+    -------
+    DataFrame
+        Sampled rows in the original order.
+    """
+
+    codes = df.groupby(strata, sort=False).ngroup().values
+    return df.iloc[_sample_positions(codes, sample_size, random_state)]
+
+
+def _sample_positions(codes, sample_size, random_state=None):
+    """
+    Samples at most `sample_size` positions of each stratum code.
+    """
+
+    if sample_size < 1:
+        raise ValueError('sample_size must be positive')
+
+    rs = _random_state(random_state)
+    order = np.lexsort((rs.rand(len(codes)), codes))
+    sorted_codes = codes[order]
+    start = np.searchsorted(sorted_codes, sorted_codes, side='left')
+    rank = np.arange(len(codes)) - start
+
+    return np.sort(order[rank < sample_size])
+
+
+def approximate_inter_daily_stability(df, value_col, hour_col='hour',
+                                      sample_size=7, n_bootstrap=200,
+                                      random_state=None):
+    """
+    Approximates interdaily stability from a sample of each hour.
+
+    At most `sample_size` rows (days) of each hour are used. The
+    standard error is estimated by bootstrap, resampling the rows of
+    each hour (with replacement), which is vectorized over the
+    bootstrap replicates.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Hourly data (see `anvil.circadian.inter_daily_stability`).
+    value_col : str
+        Column to calculate daily stability.
+    hour_col : str
+        Column indicating hourly values. Default is 'hour'.
+    sample_size : int
+        Maximum number of rows of each hour. Default is 7.
+    n_bootstrap : int
+        Number of bootstrap replicates. Default is 200.
+    random_state : int or np.random.RandomState
+        Seed of random numbers. Default is None.
+
+    Returns
+    -------
+    tuple
+        (is, se) where is the IS of the sample and se is the
+        bootstrap standard error.
+    """
+
+    rs = _random_state(random_state)
+    sample = stratified_sample(df, df[hour_col].values, sample_size,
+                               random_state=rs)
+    estimate = inter_daily_stability(sample, value_col, hour_col)
+
+    # rows sorted by hour, so each hour is a contiguous range
+    sample = sample.sort_values(hour_col, kind='stable')
+    hours = sample[hour_col].values
+    values = sample[value_col].values.astype(float)
+    starts = np.flatnonzero(np.r_[True, hours[1:] != hours[:-1]])
+    sizes = np.diff(np.r_[starts, len(hours)])
+    first = np.repeat(starts, sizes)
+    size = np.repeat(sizes, sizes)
+
+    index = first + (rs.rand(n_bootstrap, len(values)) * size).astype(int)
+    x = values[index]
+
+    n = len(values)
+    mean = x.mean(axis=1, keepdims=True)
+    hour_mean = np.add.reduceat(x, starts, axis=1) / sizes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        replicates = n * ((hour_mean - mean) ** 2).sum(axis=1) / \
+            (24 * ((x - mean) ** 2).sum(axis=1))
+
+    return estimate, np.nanstd(replicates, ddof=1)
+
+
+def approximate_hourly_distribution(df, value_cols, sample_size=60,
+                                    random_state=None):
+    """
+    Approximates hourly means from a sample of each hour.
+
+    At most `sample_size` rows of each date and hour are used, and the
+    means and their (analytic) standard errors are computed for all
+    hours at once. For other statistics, `anvil.utils.
+    get_hourly_distribution` can be used with a `stratified_sample`
+    (without error estimates).
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex`.
+    value_cols : str or list
+        Columns to average. Missing values are ignored.
+    sample_size : int
+        Maximum number of rows of each date and hour. Default is 60.
+    random_state : int or np.random.RandomState
+        Seed of random numbers. Default is None.
+
+    Returns
+    -------
+    DataFrame
+        It contains hour, date and, for each column of `value_cols`,
+        the mean and '<col>_se' columns, sorted by date and hour. The
+        standard error includes the finite population correction, so
+        it is zero for hours with at most `sample_size` rows.
+    """
+
+    if isinstance(value_cols, str):
+        value_cols = [value_cols]
+
+    # hours since epoch (in local time) identify date and hour
+    hours = _to_nanoseconds(df.index) // pd.Timedelta(hours=1).value
+    keys, codes = np.unique(hours, return_inverse=True)
+    keys = pd.DatetimeIndex(keys * pd.Timedelta(hours=1).value)
+    n_groups = len(keys)
+
+    pos = _sample_positions(codes, sample_size, random_state)
+    c = codes[pos]
+    fpc = 1 - np.bincount(c, minlength=n_groups) / \
+        np.bincount(codes, minlength=n_groups)
+
+    r = pd.DataFrame({'hour': keys.hour, 'date': keys.date})
+    for col in value_cols:
+        x = df[col].values[pos].astype('f8')
+        valid = ~np.isnan(x)
+        x, k = x[valid], c[valid]
+
+        n = np.bincount(k, minlength=n_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.bincount(k, weights=x, minlength=n_groups) / n
+            ss = np.bincount(k, weights=(x - mean[k]) ** 2,
+                             minlength=n_groups)
+            se = np.sqrt(ss / (n - 1) / n * fpc)
+        # all rows are in the sample
+        se[(fpc == 0) & (n > 0)] = 0
+
+        r[col] = mean
+        r[col + '_se'] = se
+
+    return r
+
+
+def approximate_daily_location_cluster_count(df, sample_size=200,
+                                             n_samples=5,
+                                             random_state=None,
+                                             **kwargs):
+    """
+    Approximates number of location clusters in a day.
+
+    It is `anvil.location.daily_location_cluster_count` with
+    `sample_size` given, i.e., large days are clustered on `n_samples`
+    independent samples (of `sample_size` points) with `min_samples`
+    scaled by the sampling fraction, and the count is the mean over
+    the samples.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with DateTimeIndex.
+    sample_size : int
+        Maximum number of points of each day. Default is 200.
+    n_samples : int
+        Number of samples of each day. Default is 5.
+    random_state : int or np.random.RandomState
+        Seed of random numbers. Default is None.
+    **kwargs
+        Keyword arguments that will be passed to
+        `daily_location_cluster_count`.
+
+    Returns
+    -------
+    DataFrame
+        It contains date, cluster (mean count) and cluster_se columns.
+    """
+
+    return daily_location_cluster_count(df, sample_size=sample_size,
+                                        n_samples=n_samples,
+                                        random_state=random_state,
+                                        **kwargs)
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.cache
+    ~~~~~~~~~~~
+
+    Collection of utilities for caching results on disk
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+import datetime as dt
+import enum
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def _update_hash(h, value):
+    """
+    Updates hash object with the content of a value.
+
+    DataFrame, Series, Index and extension arrays (e.g., Categorical)
+    are hashed using `pd.util.hash_pandas_object` (including the
+    index) with their dtypes, numeric arrays by their raw bytes,
+    object arrays by their elements and Python functions by their
+    qualified names, code, defaults and closures (so different
+    lambdas or closures of the same scope differ). Other callables
+    are hashed by their qualified names, containers by their
+    elements and scalars using `repr`.
+
+    Parameters
+    ----------
+    h : hashlib hash object
+    value : object
+
+    Raises
+    ------
+    TypeError
+        If the value (or an element) has no stable content hash.
+    """
+
+    h.update(type(value).__name__.encode())
+
+    if isinstance(value, pd.Index):
+        meta = (list(value.names),
+                [str(value.get_level_values(i).dtype)
+                 for i in range(value.nlevels)])
+        h.update(repr(meta).encode())
+        for i in range(value.nlevels):
+            _update_dtype_hash(h, value.get_level_values(i).dtype)
+        h.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(value, pd.api.extensions.ExtensionArray):
+        _update_dtype_hash(h, value.dtype)
+        h.update(pd.util.hash_pandas_object(pd.Series(value), index=False)
+                 .values.tobytes())
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        if isinstance(value, pd.DataFrame):
+            meta = [(c, str(t)) for c, t in value.dtypes.items()]
+        else:
+            meta = (value.name, str(value.dtype))
+        # index values are hashed in UTC, so time zone is in meta
+        index = value.index
+        meta = (meta, list(index.names),
+                [str(index.get_level_values(i).dtype)
+                 for i in range(index.nlevels)])
+        h.update(repr(meta).encode())
+        dtypes = value.dtypes if isinstance(value, pd.DataFrame) \
+            else [value.dtype]
+        for t in dtypes:
+            _update_dtype_hash(h, t)
+        h.update(pd.util.hash_pandas_object(value, index=True).values
+                 .tobytes())
+    elif isinstance(value, np.ndarray):
+        h.update(repr((value.shape, str(value.dtype))).encode())
+        if value.dtype.hasobject:
+            # raw bytes of object arrays are pointers
+            values = value.ravel()
+            if pd.api.types.infer_dtype(values, skipna=False) in \
+                    ('string', 'bytes', 'empty'):
+                h.update(pd.util.hash_array(values).tobytes())
+            else:
+                for v in values:
+                    _update_hash(h, v)
+        else:
+            h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, functools.partial):
+        _update_hash(h, value.func)
+        _update_hash(h, value.args)
+        _update_hash(h, sorted(value.keywords.items()))
+    elif callable(value) and hasattr(value, '__qualname__'):
+        h.update('{0}.{1}'.format(value.__module__,
+                                  value.__qualname__).encode())
+        if hasattr(value, '__code__'):
+            _update_code_hash(h, value.__code__)
+            _update_hash(h, value.__defaults__)
+            _update_hash(h, value.__kwdefaults__)
+            for cell in value.__closure__ or ():
+                try:
+                    contents = cell.cell_contents
+                except ValueError:
+                    # empty cell
+                    continue
+                # a recursive closure refers to itself
+                if contents is not value:
+                    _update_hash(h, contents)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, (set, frozenset)):
+        for v in sorted(value, key=repr):
+            _update_hash(h, v)
+    elif isinstance(value, dict):
+        for k in sorted(value, key=repr):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif isinstance(value, _SCALAR_TYPES) or value is pd.NaT:
+        h.update(repr(value).encode())
+    else:
+        raise TypeError('Cannot hash the content of {0} for '
+                        'caching'.format(type(value).__name__))
+
+
+# values with a stable and complete `repr`
+_SCALAR_TYPES = (type(None), type(Ellipsis), bool, int, float, complex,
+                 str, bytes, range, slice, np.generic, np.dtype, dt.date,
+                 dt.time, dt.timedelta, enum.Enum)
+
+
+def _update_dtype_hash(h, dtype):
+    """
+    Updates hash object with a dtype (including categories).
+    """
+
+    h.update(str(dtype).encode())
+    if isinstance(dtype, pd.CategoricalDtype):
+        _update_hash(h, dtype.categories)
+        _update_hash(h, dtype.ordered)
+
+
+def _update_code_hash(h, code):
+    """
+    Updates hash object with the bytecode, constants and names of a
+    code object (including nested code objects, e.g., of lambdas).
+
+    Parameters
+    ----------
+    h : hashlib hash object
+    code : code object
+    """
+
+    h.update(code.co_code)
+    _update_hash(h, code.co_names)
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            _update_code_hash(h, c)
+        else:
+            _update_hash(h, c)
+
+
+def _cache_key(func, args, kwargs):
+    """
+    Computes content based key of a function call.
+
+    Arguments are bound to the signature of `func` (with defaults
+    applied), so positional and keyword calls share the same key.
+
+    Parameters
+    ----------
+    func : function
+    args : tuple
+    kwargs : dict
+
+    Returns
+    -------
+    str
+        Hex digest of the call.
+    """
+
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+
+    h = hashlib.blake2b(digest_size=20)
+    _update_hash(h, func)
+    _update_hash(h, dict(bound.arguments))
+    return h.hexdigest()
+
+
+def _cache_entries(cache_dir):
+    """
+    Lists cached entries.
+
+    Parameters
+    ----------
+    cache_dir : str
+
+    Returns
+    -------
+    list
+        List of (path, size, mtime) tuples.
+    """
+
+    l = []
+    for root, _, files in os.walk(cache_dir):
+        for f in files:
+            if f.endswith('.pkl'):
+                p = os.path.join(root, f)
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:
+                    continue
+                l.append((p, st.st_size, st.st_mtime))
+    return l
+
+
+def _evict(cache_dir, max_size, keep=None):
+    """
+    Removes least recently used entries until the cache fits.
+
+    Parameters
+    ----------
+    cache_dir : str
+    max_size : int
+        Maximum size of the cache directory in bytes.
+    keep : str
+        Path of an entry that should never be removed (e.g., the
+        entry that has just been written). Default is None.
+
+    Returns
+    -------
+    int
+        Size of the remaining entries in bytes.
+    """
+
+    entries = sorted(_cache_entries(cache_dir), key=lambda z: z[2])
+    total = sum(z[1] for z in entries)
+
+    for p, size, _ in entries:
+        if total <= max_size:
+            break
+        if p == keep:
+            continue
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+    return total
+
+
+def disk_cache(cache_dir, max_size=2**30):
+    """
+    Memoizes function results on local disk.
+
+    Results are pickled in `cache_dir` with a key computed from the
+    content of the arguments (e.g., rows of a DataFrame slice) and the
+    parameters. So, re-running daily jobs only computes new or changed
+    user-days. For example:
+
+        clustering = disk_cache('/tmp/anvil')(do_location_clustering)
+        clustering(df_day, eps=0.5)
+
+    The least recently used entries are removed when the total size
+    of `cache_dir` exceeds `max_size`. The size is scanned once and
+    then kept as a running total of the written entries, so the
+    directory is only scanned again when a write pushes the total
+    past `max_size`. Entries written by other processes are only
+    counted at the next scan.
+
+    The wrapped function has the following additional functions:
+
+        cache_info() : returns a dictionary with hits, misses,
+                       uncached (calls not cached), entries and
+                       size (in bytes).
+        invalidate(*args, **kwargs) : removes the entry for the
+                                      given arguments.
+        cache_clear() : removes all entries of the function.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory. It is created if it does not exist.
+    max_size : int
+        Maximum size of the cache directory in bytes. Default is 1 GB.
+
+    Returns
+    -------
+    function
+        A decorator.
+
+    Notes
+    -----
+        Arguments must be hashable by content, i.e., DataFrame,
+        Series, Index, arrays, functions, containers of them or
+        scalars (e.g., numbers, strings and dates). Calls with other
+        arguments are not cached (see `uncached` in `cache_info`).
+        Python functions are identified by their names, code and
+        closures, so changing the body of a function invalidates its
+        entries, but changing a module level function it calls or a
+        global it reads does not.
+    """
+
+    def decorator(func):
+        func_dir = os.path.join(cache_dir, '{0}.{1}'.format(
+            func.__module__, func.__qualname__))
+        os.makedirs(func_dir, exist_ok=True)
+
+        stats = {'hits': 0, 'misses': 0, 'uncached': 0}
+        # running size of cache_dir, scanned at the first write
+        state = {'size': None}
+
+        def path_for(args, kwargs):
+            return os.path.join(func_dir,
+                                _cache_key(func, args, kwargs) + '.pkl')
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                p = path_for(args, kwargs)
+            except TypeError:
+                # arguments without a stable content hash
+                stats['uncached'] += 1
+                return func(*args, **kwargs)
+
+            try:
+                with open(p, 'rb') as f:
+                    result = pickle.load(f)
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                stats['hits'] += 1
+                # mtime is used as the last access time for LRU
+                os.utime(p)
+                return result
+
+            stats['misses'] += 1
+            result = func(*args, **kwargs)
+
+            fd, tmp = tempfile.mkstemp(dir=func_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, p)
+
+            if state['size'] is None:
+                state['size'] = sum(z[1] for z in _cache_entries(cache_dir))
+            else:
+                state['size'] += os.path.getsize(p)
+            if state['size'] > max_size:
+                state['size'] = _evict(cache_dir, max_size, keep=p)
+            return result
+
+        def cache_info():
+            entries = _cache_entries(func_dir)
+            return {'hits': stats['hits'],
+                    'misses': stats['misses'],
+                    'uncached': stats['uncached'],
+                    'entries': len(entries),
+                    'size': sum(z[1] for z in entries)}
+
+        def invalidate(*args, **kwargs):
+            try:
+                os.remove(path_for(args, kwargs))
+                return True
+            except FileNotFoundError:
+                return False
+
+        def cache_clear():
+            for p, _, _ in _cache_entries(func_dir):
+                os.remove(p)
+            stats['hits'] = stats['misses'] = stats['uncached'] = 0
+
+        wrapper.cache_info = cache_info
+        wrapper.invalidate = invalidate
+        wrapper.cache_clear = cache_clear
+
+        return wrapper
+
+    return decorator
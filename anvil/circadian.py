@@ -11,15 +11,21 @@
 
 
 import datetime as dt
+import itertools
+import numpy as np
 import pandas as pd
 
+from .parallel import apply_by_user
+from .utils import compact_frame, filter_valid_dates, iter_batches,\
+    to_day_number, _to_nanoseconds
+
 
 """
 Utility functions for circadian analysis.
 """
 
 
-def inter_daily_stability(df, value_col,
+def inter_daily_stability(df, value_col=None,
                           hour_col='hour'):
     """
     Calculates interdaily stability (IS) from hourly data.
@@ -34,19 +40,28 @@ def inter_daily_stability(df, value_col,
 
     Parameters
     ----------
-    df : DataFrame.
+    df : DataFrame or ndarray
+        Hourly data. It can also be an array of shape
+        (users, days, 24) with NaN for missing hours (see
+        `anvil.utils.get_hourly_tensor`), or of shape (users, hours)
+        starting at midnight (see `anvil.utils.resample_to_grid`),
+        in which case IS is computed for all users simultaneously.
     value_col : str
-        Column to calculate daily stability.
+        Column to calculate daily stability. Not used for arrays.
     hour_col : str
-        Column indicating hourly values.
+        Column indicating hourly values. Not used for arrays.
 
     Returns
     -------
-    float
-        Value indicating inter daily stability.
+    float or ndarray
+        Value indicating inter daily stability. An array with
+        one value per user is returned for array input.
 
     """
 
+    if isinstance(df, np.ndarray):
+        return _inter_daily_stability_tensor(df)
+
     hour_count = 24
     mean = df[value_col].mean()
     N = len(df)
@@ -63,7 +78,54 @@ def inter_daily_stability(df, value_col,
     return nom/denominator
 
 
-def intra_daily_variability(df, value_col):
+def _as_hourly_tensor(x):
+    """
+    Gives a (users, days, 24) view of hourly array.
+
+    Arrays of shape (users, hours) are reshaped without copying, and
+    float arrays (e.g., float32) are used as they are.
+    """
+
+    x = np.asarray(x)
+    if x.dtype.kind != 'f':
+        x = x.astype('f8')
+    if x.ndim == 2:
+        if x.shape[1] % 24 != 0:
+            raise ValueError('Array of shape (users, hours) must have '
+                             'hourly bins of whole days (a multiple of '
+                             '24), got {0} bins'.format(x.shape[1]))
+        x = x.reshape(len(x), -1, 24)
+    elif x.ndim != 3 or x.shape[2] != 24:
+        raise ValueError('Expected hourly array of shape (users, hours) '
+                         'or (users, days, 24), got {0}'.format(x.shape))
+    return x
+
+
+def _inter_daily_stability_tensor(x):
+    """
+    Calculates IS from (users, days, 24) array.
+
+    See `inter_daily_stability`.
+    """
+
+    x = _as_hourly_tensor(x)
+    hour_count = 24
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        N = np.sum(~np.isnan(x), axis=(1, 2))
+        mean = np.nansum(x, axis=(1, 2), dtype='f8') / N
+
+        denominator = hour_count * np.nansum(
+            (x - mean[:, None, None])**2, axis=(1, 2))
+
+        hour_n = np.sum(~np.isnan(x), axis=1)
+        hour_mean = np.nansum(x, axis=1, dtype='f8') / hour_n
+        nom = np.nansum((hour_mean - mean[:, None])**2, axis=1) * N
+
+        return nom/denominator
+
+
+def intra_daily_variability(df, value_col=None):
     """
     Calculate intra-daily variability (IV).
 
@@ -73,18 +135,27 @@ def intra_daily_variability(df, value_col):
 
     Parameters
     ----------
-    df : DataFrame.
-        It must be sorted by date (ascending).
+    df : DataFrame or ndarray
+        It must be sorted by date (ascending). It can also be
+        an array of shape (users, days, 24) with NaN for missing
+        hours (see `anvil.utils.get_hourly_tensor`) or of shape
+        (users, hours) (see `anvil.utils.resample_to_grid`), in which
+        case IV is computed for all users simultaneously. Only
+        successive hours with values are used for differences.
     value_col : str
-        Column to compute daily variability.
+        Column to compute daily variability. Not used for arrays.
 
     Returns
     -------
-    float
-        Computed variability score.
+    float or ndarray
+        Computed variability score. An array with one value per
+        user is returned for array input.
 
     """
 
+    if isinstance(df, np.ndarray):
+        return _intra_daily_variability_tensor(df)
+
     s = (df[value_col] - df[value_col].shift(1))**2
     nom = len(df) * sum(s.fillna(0).values)
 
@@ -96,7 +167,28 @@ def intra_daily_variability(df, value_col):
     return nom/denom
 
 
-def sort_by_hourly_values(df, value_col,
+def _intra_daily_variability_tensor(x):
+    """
+    Calculates IV from (users, days, 24) array.
+
+    See `intra_daily_variability`.
+    """
+
+    x = _as_hourly_tensor(x)
+    x = x.reshape(len(x), -1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        N = np.sum(~np.isnan(x), axis=1)
+        diff = np.subtract(x[:, 1:], x[:, :-1], dtype='f8')
+        nom = N * np.nansum(diff**2, axis=1)
+
+        mean = np.nansum(x, axis=1, dtype='f8') / N
+        denom = (N - 1) * np.nansum((x - mean[:, None])**2, axis=1)
+
+        return nom/denom
+
+
+def sort_by_hourly_values(df, value_col=None,
                           hour_col='hour'):
     """
     Sorts by average hourly values.
@@ -109,11 +201,16 @@ def sort_by_hourly_values(df, value_col,
     Parameters
     ----------
 
-    df : DataFrame
+    df : DataFrame or ndarray
+        Hourly data. It can also be an array of shape
+        (users, days, 24) with NaN for missing hours (see
+        `anvil.utils.get_hourly_tensor`) or of shape (users, hours)
+        starting at midnight (see `anvil.utils.resample_to_grid`).
     value_col : str
-        Column to compute average values.
+        Column to compute average values. Not used for arrays.
     hour_col : str
-        Column denoting hours. Default is 'hour'.
+        Column denoting hours. Default is 'hour'. Not used
+        for arrays.
 
 
     Returns
@@ -121,9 +218,21 @@ def sort_by_hourly_values(df, value_col,
     list
         A sorted list (ascending) of tuples (h, v)
         with first element is the hour and second
-        element is average value.
+        element is average value. For array input,
+        a list with one such list for each user.
     """
 
+    if isinstance(df, np.ndarray):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = _as_hourly_tensor(df)
+            means = np.nansum(x, axis=1, dtype='f8') / \
+                np.sum(~np.isnan(x), axis=1)
+
+        # NaN (hours without values) are placed at the end by argsort
+        order = np.argsort(means, axis=1, kind='stable')
+        return [[(int(h), m[h]) for h in o if not np.isnan(m[h])]
+                for o, m in zip(order, means)]
+
     d = {}
     for k, v in df.groupby(hour_col):
         d[k] = v[value_col].mean()
@@ -132,6 +241,584 @@ def sort_by_hourly_values(df, value_col,
     return sorted(d.items(), key=lambda z: z[1])
 
 
+PROFILE_METRICS = ('correlation', 'shift')
+
+
+def hourly_profile_matrix(df, value_col=None, user_col='user_id',
+                          hour_col='hour', normalize=True):
+    """
+    Creates a matrix of 24-hour profiles (average hourly values).
+
+    The average values are the same as those of `sort_by_hourly_values`,
+    but they are computed for all users in one pass.
+
+    Parameters
+    ----------
+    df : DataFrame or ndarray
+        Hourly data of all users. It can also be an array of shape
+        (users, days, 24) with NaN for missing hours (see
+        `anvil.utils.get_hourly_tensor`) or of shape (users, hours)
+        starting at midnight (see `anvil.utils.resample_to_grid`).
+    value_col : str
+        Column to compute average values. Not used for arrays.
+    user_col : str
+        User id column. Rows without user id are ignored. Default is
+        'user_id'. Not used for arrays.
+    hour_col : str
+        Column denoting hours. Default is 'hour'. Not used for arrays.
+    normalize : bool
+        If each profile should be standardized (zero mean and unit
+        variance across hours), as required by `profile_similarity`
+        and `nearest_profiles`. Hours without values are then set to
+        zero (the mean). Default is True.
+
+    Returns
+    -------
+    profiles : ndarray
+        Array of shape (users, 24).
+    users : ndarray
+        User ids of the rows. For array input, it is the row number.
+    """
+
+    if isinstance(df, np.ndarray):
+        x = _as_hourly_tensor(df)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profiles = np.nansum(x, axis=1, dtype='f8') / \
+                np.sum(~np.isnan(x), axis=1)
+        users = np.arange(len(x))
+    else:
+        df = df[df[user_col].notnull()]
+        codes, users = pd.factorize(df[user_col])
+        values = df[value_col].values.astype('f8')
+        key = codes * 24 + df[hour_col].values.astype(int)
+        valid = ~np.isnan(values)
+
+        size = len(users) * 24
+        total = np.bincount(key[valid], weights=values[valid],
+                            minlength=size)
+        n = np.bincount(key[valid], minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profiles = (total / n).reshape(len(users), 24)
+        users = np.asarray(users)
+
+    if normalize:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.nanmean(profiles, axis=1, keepdims=True)
+            std = np.nanstd(profiles, axis=1, keepdims=True)
+            profiles = (profiles - mean) / std
+        # constant (or empty) profiles are not similar to anything
+        profiles = np.nan_to_num(profiles, nan=0.0, posinf=0.0, neginf=0.0)
+
+    return profiles, users
+
+
+def iter_profile_similarity(profiles, other=None, metric='correlation',
+                            max_shift=None, block_size=1024):
+    """
+    Lazily computes similarity of profiles block by block.
+
+    Only `block_size` rows of the similarity matrix are kept in
+    memory at a time.
+
+    Parameters
+    ----------
+    profiles : ndarray
+        Normalized profiles of shape (users, 24) (see
+        `hourly_profile_matrix`).
+    other : ndarray
+        Normalized profiles compared with. Default is `profiles`.
+    metric : str
+        Either 'correlation' (Pearson correlation of the profiles) or
+        'shift' (maximum correlation over circular shifts of one of
+        the profiles, i.e., similar shapes at different times of the
+        day are similar). The corresponding distance is 1 - value.
+        Default is 'correlation'.
+    max_shift : int
+        Maximum shift (in hours, in either direction) for 'shift'.
+        Default is None, i.e., all shifts.
+    block_size : int
+        Number of rows in each block. Default is 1024.
+
+    Returns
+    -------
+    generator
+        Tuples (i, block) where block is the similarity of rows
+        i to i + block_size of `profiles` with all rows of `other`.
+    """
+
+    if metric not in PROFILE_METRICS:
+        raise ValueError('Unknown metric: {0}. Must be one of {1}'.format(
+            metric, PROFILE_METRICS))
+
+    profiles = np.asarray(profiles)
+    other = profiles if other is None else np.asarray(other)
+    m = profiles.shape[1]
+
+    if metric == 'correlation':
+        shifts = [0]
+    elif max_shift is None:
+        shifts = range(m)
+    else:
+        shifts = range(-max_shift, max_shift + 1)
+
+    for i in range(0, len(profiles), block_size):
+        x = profiles[i:i + block_size]
+        block = None
+        for s in shifts:
+            r = np.roll(x, s, axis=1) @ other.T
+            block = r if block is None else np.maximum(block, r)
+        yield i, block / m
+
+
+def profile_similarity(profiles, other=None, metric='correlation',
+                       max_shift=None, block_size=1024):
+    """
+    Computes pairwise similarity of profiles.
+
+    The full matrix is returned. For a large number of users, see
+    `iter_profile_similarity` and `nearest_profiles`.
+
+    Parameters
+    ----------
+    See `iter_profile_similarity`.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (len(profiles), len(other)).
+    """
+
+    blocks = iter_profile_similarity(profiles, other, metric=metric,
+                                     max_shift=max_shift,
+                                     block_size=block_size)
+    return np.vstack([b for i, b in blocks])
+
+
+def nearest_profiles(profiles, k=5, metric='correlation', max_shift=None,
+                     block_size=1024):
+    """
+    Finds the most similar profiles of each user.
+
+    Parameters
+    ----------
+    profiles : ndarray
+        Normalized profiles of shape (users, 24) (see
+        `hourly_profile_matrix`).
+    k : int
+        Number of neighbors. Default is 5.
+    metric : str
+        See `iter_profile_similarity`. Default is 'correlation'.
+    max_shift : int
+        See `iter_profile_similarity`.
+    block_size : int
+        See `iter_profile_similarity`.
+
+    Returns
+    -------
+    indices : ndarray
+        Array of shape (users, k) with row numbers of the neighbors,
+        ordered by decreasing similarity. A user is not its own
+        neighbor.
+    similarities : ndarray
+        Array of shape (users, k) with the corresponding similarity.
+    """
+
+    n = len(profiles)
+    k = min(k, n - 1)
+    if k < 1:
+        raise ValueError('At least two profiles are required')
+
+    indices = np.empty((n, k), dtype=int)
+    similarities = np.empty((n, k))
+
+    blocks = iter_profile_similarity(profiles, metric=metric,
+                                     max_shift=max_shift,
+                                     block_size=block_size)
+    for i, block in blocks:
+        rows = np.arange(len(block))
+        block[rows, rows + i] = -np.inf
+
+        top = np.argpartition(block, -k, axis=1)[:, -k:]
+        values = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-values, axis=1, kind='stable')
+
+        indices[i:i + len(block)] = np.take_along_axis(top, order, axis=1)
+        similarities[i:i + len(block)] = np.take_along_axis(values, order,
+                                                            axis=1)
+
+    return indices, similarities
+
+
+def batch_cosinor(values, times, period=24.0, mask=None,
+                  user_ids=None):
+    """
+    Fits cosinor model for many users at once.
+
+    The model is y(t) = M + A * cos(2 * pi * t / period - phi), which
+    is fitted as a linear least-squares problem with a design matrix
+    [1, cos(wt), sin(wt)]. The design is built once for the sampling
+    grid and weighted normal equations of all users are solved in one
+    batched call.
+
+    Cornelissen, G. "Cosinor-based rhythmometry."
+    Theoretical Biology and Medical Modelling 11.1 (2014): 16.
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of shape (users, samples).
+    times : array-like
+        Sampling times in hours (length is the number of samples).
+        For acrophase in clock time, it should be measured from
+        midnight.
+    period : float
+        Period in hours. Default is 24.
+    mask : ndarray
+        Boolean array with the same shape as `values` where False
+        indicates missing data. NaN values are always considered
+        missing. Default is None.
+    user_ids : array-like
+        User ids. Default is 0, 1, ..., users - 1.
+
+    Returns
+    -------
+    DataFrame
+        A DataFrame with user_id, mesor, amplitude, acrophase and n
+        columns. Acrophase is the time of peak in hours within
+        [0, period) and n is the number of used samples. Users with
+        less than three samples (or degenerate sampling) get NaN.
+    """
+
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    times = np.asarray(times, dtype=float)
+
+    w = ~np.isnan(values)
+    if mask is not None:
+        w &= np.asarray(mask, dtype=bool)
+    w = w.astype(float)
+    y = np.where(w > 0, values, 0)
+
+    omega = 2 * np.pi / period
+    X = np.column_stack([np.ones_like(times), np.cos(omega * times),
+                         np.sin(omega * times)])
+
+    # (users, 3, 3) weighted normal matrices and (users, 3) right sides
+    outer = (X[:, :, None] * X[:, None, :]).reshape(len(times), 9)
+    xtx = (w @ outer).reshape(-1, 3, 3)
+    xty = (w * y) @ X
+
+    if user_ids is None:
+        user_ids = np.arange(len(values))
+
+    return _solve_cosinor(xtx, xty, w.sum(axis=1), period, user_ids)
+
+
+def _solve_cosinor(xtx, xty, n, period, user_ids):
+    """
+    Solves cosinor normal equations of all users in one batched call.
+
+    Parameters
+    ----------
+    xtx : ndarray
+        Normal matrices of shape (users, 3, 3).
+    xty : ndarray
+        Right sides of shape (users, 3).
+    n : ndarray
+        Number of samples of each user.
+    period : float
+        Period in hours.
+    user_ids : array-like
+        User ids.
+
+    Returns
+    -------
+    DataFrame
+        See `batch_cosinor`.
+    """
+
+    valid = (n >= 3) & (np.linalg.cond(xtx) < 1e10)
+    xtx[~valid] = np.eye(3)
+
+    beta = np.linalg.solve(xtx, xty[:, :, None])[:, :, 0]
+    beta[~valid] = np.nan
+
+    omega = 2 * np.pi / period
+    acrophase = np.arctan2(beta[:, 2], beta[:, 1])
+
+    return pd.DataFrame({'user_id': user_ids,
+                         'mesor': beta[:, 0],
+                         'amplitude': np.hypot(beta[:, 1], beta[:, 2]),
+                         'acrophase': np.mod(acrophase / omega, period),
+                         'n': n.astype(int)})
+
+
+def cosinor_across_users(df, value_col, user_col='user_id',
+                         period=24.0):
+    """
+    Fits cosinor model for each user.
+
+    Each user is fitted on its own samples: the normal equations of
+    all users are accumulated from the rows with `np.bincount` and
+    solved in one batched call (see `batch_cosinor` for details). So,
+    memory grows with the number of rows, not with the time span or
+    with how the timestamps of the users are aligned.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time). Values of
+        the same user and timestamp are averaged, and rows without
+        user id are ignored.
+    value_col : str
+        Column with activity values.
+    user_col : str
+        User id column. Default is 'user_id'.
+    period : float
+        Period in hours. Default is 24.
+
+    Returns
+    -------
+    DataFrame
+        A DataFrame with user_id, mesor, amplitude, acrophase and n
+        columns.
+    """
+
+    df = df[df[user_col].notnull()]
+    user_codes, users = pd.factorize(df[user_col], sort=True)
+    x = df[value_col].values.astype(float)
+    valid = ~np.isnan(x)
+    t = _to_nanoseconds(df.index)
+
+    # mean of duplicate (user, timestamp) values
+    g = pd.Series(x[valid]).groupby([user_codes[valid], t[valid]]).mean()
+    u = g.index.get_level_values(0).values
+    t = g.index.get_level_values(1).values
+
+    # hours from the first midnight
+    day = pd.Timedelta(days=1).value
+    start = t.min() // day * day if len(t) > 0 else 0
+    times = (t - start) / pd.Timedelta(hours=1).value
+
+    omega = 2 * np.pi / period
+    X = np.column_stack([np.ones_like(times), np.cos(omega * times),
+                         np.sin(omega * times)])
+    y = g.values
+
+    def per_user(weights):
+        return np.bincount(u, weights=weights, minlength=len(users))
+
+    xtx = np.stack([per_user(X[:, a] * X[:, b])
+                    for a in range(3) for b in range(3)],
+                   axis=-1).reshape(-1, 3, 3)
+    xty = np.stack([per_user(X[:, a] * y) for a in range(3)], axis=-1)
+    n = np.bincount(u, minlength=len(users))
+
+    return _solve_cosinor(xtx, xty, n, period, users)
+
+
+def chi_square_periodogram(values, periods, mask=None):
+    """
+    Computes chi-square periodogram for many users at once.
+
+    For each candidate period P (in samples), the series is folded
+    into K = T // P cycles and Qp = N * sum(Nh * (Mh - M)^2) /
+    sum((x - M)^2) is computed, where Mh is the mean of phase h,
+    Nh is the number of samples in phase h, M is the overall mean and
+    N is the number of samples. With complete data, it is the same as
+    Sokolove and Bushell (1978). The cost is linear in the series
+    length for each period.
+
+    Sokolove, P. G., and W. N. Bushell. "The chi square periodogram:
+    its utility for analysis of circadian rhythms."
+    Journal of Theoretical Biology 72.1 (1978): 131-160.
+
+    Parameters
+    ----------
+    values : ndarray
+        Regularly sampled (e.g., hourly) values of shape
+        (users, samples).
+    periods : iterable
+        Candidate periods in number of samples, e.g., `range(20, 29)`
+        for hourly data.
+    mask : ndarray
+        Boolean array with the same shape as `values` where False
+        indicates missing data. NaN values are always considered
+        missing. Default is None.
+
+    Returns
+    -------
+    ndarray
+        Qp values of shape (users, len(periods)).
+
+    Notes
+    -----
+        A period is significant at level alpha if Qp exceeds
+        `scipy.stats.chi2.ppf(1 - alpha, P - 1)`.
+    """
+
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    if mask is not None:
+        values = np.where(mask, values, np.nan)
+
+    periods = [int(p) for p in periods]
+    r = np.full((len(values), len(periods)), np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, p in enumerate(periods):
+            k = values.shape[1] // p
+            if k == 0:
+                continue
+
+            x = values[:, :k * p]
+            valid = ~np.isnan(x)
+            n = valid.sum(axis=1)
+            m = np.nansum(x, axis=1) / n
+
+            folded = x.reshape(len(x), k, p)
+            nh = valid.reshape(len(x), k, p).sum(axis=1)
+            mh = np.nansum(folded, axis=1) / nh
+
+            nom = np.nansum(nh * (mh - m[:, None])**2, axis=1)
+            denom = np.nansum((x - m[:, None])**2, axis=1)
+            r[:, i] = n * nom / denom
+
+    return r
+
+
+def lomb_scargle_periodogram(times, values, periods, mask=None,
+                             block_size=2**22):
+    """
+    Computes Lomb-Scargle periodogram for many users at once.
+
+    It handles irregularly sampled series. The normalized power
+    follows Press et al. (Numerical Recipes, 13.8), computed
+    with vectorized operations over users, samples and periods.
+    The cost is linear in the series length for each period.
+
+    Parameters
+    ----------
+    times : ndarray
+        Sampling times in hours. Either shared by all users (1-D) or
+        of shape (users, samples).
+    values : ndarray
+        Array of shape (users, samples). Series of different
+        lengths can be padded with NaN (in values, times or both).
+    periods : iterable
+        Candidate periods in hours, e.g., `np.arange(20, 28.1, 0.25)`.
+    mask : ndarray
+        Boolean array with the same shape as `values` where False
+        indicates missing data. Samples with NaN value or time are
+        always considered missing. Default is None.
+    block_size : int
+        Maximum number of elements of intermediate arrays, which
+        bounds memory usage. Default is 2**22.
+
+    Returns
+    -------
+    ndarray
+        Normalized power of shape (users, len(periods)).
+    """
+
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    times = np.broadcast_to(np.asarray(times, dtype=float), values.shape)
+
+    w = ~np.isnan(values) & ~np.isnan(times)
+    if mask is not None:
+        w &= np.asarray(mask, dtype=bool)
+    # missing times would make sums NaN even with zero weight
+    times = np.where(w, times, 0)
+    w = w.astype(float)
+
+    n = w.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (w * np.nan_to_num(values)).sum(axis=1) / n
+        var = (w * np.nan_to_num(values - mean[:, None])**2).sum(axis=1) /\
+            (n - 1)
+    y = w * np.nan_to_num(values - mean[:, None])
+
+    omegas = 2 * np.pi / np.asarray(periods, dtype=float)
+    r = np.empty((len(values), len(omegas)))
+
+    step = max(1, block_size // max(1, values.size))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(0, len(omegas), step):
+            # shape: (periods, users, samples)
+            wt = omegas[i:i + step, None, None] * times[None]
+            tau = np.arctan2((w * np.sin(2 * wt)).sum(axis=2),
+                             (w * np.cos(2 * wt)).sum(axis=2)) / 2
+            arg = wt - tau[:, :, None]
+            c, s = np.cos(arg), np.sin(arg)
+
+            power = (y * c).sum(axis=2)**2 / (w * c**2).sum(axis=2) +\
+                (y * s).sum(axis=2)**2 / (w * s**2).sum(axis=2)
+            r[:, i:i + step] = (power / (2 * var)).T
+
+    return r
+
+
+def sleep_regularity_index(states, mask=None, epochs_per_day=1440,
+                           block_size=256):
+    """
+    Calculates Sleep Regularity Index (SRI) for many users at once.
+
+    SRI is the probability of being in the same state (sleep or wake)
+    at two time points 24 hours apart, scaled to [-100, 100]: 100 for
+    the same pattern every day and 0 for random states. Only pairs
+    of epochs where both states are known are used.
+
+    Phillips, A. J., et al. "Irregular sleep/wake patterns are
+    associated with poorer academic performance and delayed circadian
+    and sleep/wake timing." Scientific reports 7.1 (2017): 3216.
+
+    Parameters
+    ----------
+    states : ndarray
+        Array of shape (users, days, epochs_per_day) (or of shape
+        (users, epochs) starting at midnight) where nonzero values
+        indicate sleep. NaN indicates missing epochs.
+    mask : ndarray
+        Boolean array with the same shape as `states` where False
+        indicates missing data. Default is None.
+    epochs_per_day : int
+        Number of epochs in a day, e.g., 1440 for minutes or 2880
+        for 30 seconds epochs. Default is 1440.
+    block_size : int
+        Number of users processed at a time, which bounds memory
+        usage. Default is 256.
+
+    Returns
+    -------
+    ndarray
+        SRI of each user. It is NaN for users without any pair of
+        known epochs 24 hours apart.
+    """
+
+    states = np.asarray(states)
+    states = states.reshape(len(states), -1, epochs_per_day)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).reshape(states.shape)
+
+    agree = np.zeros(len(states))
+    pairs = np.zeros(len(states))
+    for i in range(0, len(states), block_size):
+        x = states[i:i + block_size]
+        known = np.ones(x.shape, dtype=bool)
+        if x.dtype.kind == 'f':
+            known &= ~np.isnan(x)
+        if mask is not None:
+            known &= mask[i:i + block_size]
+        asleep = x != 0
+
+        # the same epoch on successive days
+        valid = known[:, 1:] & known[:, :-1]
+        same = (asleep[:, 1:] == asleep[:, :-1]) & valid
+        agree[i:i + block_size] = same.sum(axis=(1, 2))
+        pairs[i:i + block_size] = valid.sum(axis=(1, 2))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -100 + 200 * agree / pairs
+
+
 def _convert_timestamp_to_decimal(timeseries,
                                   should_convert=False):
     """
@@ -190,7 +877,8 @@ def _purge_srm_outliers(series,
     return series[series.map(filtering_f)]
 
 
-def _srm_preprocssing(series):
+def _srm_preprocssing(series, is_decimal=False, outlier_factor=1.5,
+                      min_std=0.5):
     """
     Pre-processing for SRM calculation.
 
@@ -202,6 +890,15 @@ def _srm_preprocssing(series):
     ----------
     series: Series
         Timestamps of a given SRM event.
+    is_decimal : bool
+        If the series already contains decimal values
+        (see `_convert_timestamp_to_decimal`). Default is False.
+    outlier_factor : float
+        Values beyond mean ± outlier_factor * SD are outliers.
+        Default is 1.5.
+    min_std : float
+        Outliers are only removed if SD is at least `min_std` (hours).
+        Default is 0.5.
 
     Returns
     -------
@@ -210,15 +907,16 @@ def _srm_preprocssing(series):
         decimals and outliers purged.
     """
 
-    series = _convert_timestamp_to_decimal(series)
+    if not is_decimal:
+        series = _convert_timestamp_to_decimal(series)
     mean = series.mean()
     std = series.std()
 
-    if std < 0.5:
+    if std < min_std:
         return series
 
-    lower_limit = mean - 1.5 * std
-    upper_limit = mean + 1.5 * std
+    lower_limit = mean - outlier_factor * std
+    upper_limit = mean + outlier_factor * std
     series = _purge_srm_outliers(series, lower_limit=lower_limit,
                                  upper_limit=upper_limit)
 
@@ -253,9 +951,60 @@ def _calculate_srm_hit(series,
     return sum(series.map(filtering_f))
 
 
+def _calculate_srm_from_decimals(groups, min_samples=3,
+                                 hit_range=45/60, outlier_factor=1.5,
+                                 min_std=0.5):
+    """
+    Calculates SRM score from decimal event times.
+
+    Parameters
+    ----------
+    groups : iterable
+        Series of decimal values (see `_convert_timestamp_to_decimal`),
+        one for each target.
+    min_samples : int
+        Minimum samples for calculating hit
+        for a given column. Default is 3.
+    hit_range : float
+        See `calculate_srm`.
+    outlier_factor : float
+        See `calculate_srm`.
+    min_std : float
+        See `calculate_srm`.
+
+    Returns
+    -------
+    float
+        Value within [0, 7] range indicating overall SRM stability.
+    """
+
+    l = []
+
+    for series in groups:
+        series = _srm_preprocssing(series, is_decimal=True,
+                                   outlier_factor=outlier_factor,
+                                   min_std=min_std)
+        if len(series) >= min_samples:
+
+            mean = series.mean()
+
+            lower = mean - hit_range
+            upper = mean + hit_range
+
+            hit = _calculate_srm_hit(series, lower_limit=lower,
+                                     upper_limit=upper)
+            l.append(hit)
+
+    return sum(l)/len(l)
+
+
 def calculate_srm(df, target_col,
                   time_col='completion_time',
-                  min_samples=3):
+                  min_samples=3,
+                  hit_range=45/60,
+                  outlier_factor=1.5,
+                  valid_dates=None,
+                  min_std=0.5):
     """
     Calculates SRM score.
 
@@ -272,36 +1021,186 @@ def calculate_srm(df, target_col,
         Minimum samples for calculating hit
         for a given column. Default is 3 (40%
         of a week).
+    hit_range : float
+        An event is a "hit" if it falls within `hit_range` hours
+        of the mean. Default is 45/60 (45 minutes).
+    outlier_factor : float
+        Events beyond mean ± outlier_factor * SD are removed before
+        calculating hits. Default is 1.5.
+    valid_dates : iterable or DataFrame
+        If given, only the events of these dates are used (see
+        `anvil.utils.filter_valid_dates` and
+        `anvil.utils.select_valid_days`). Default is None.
+    min_std : float
+        Outliers of a target are only removed if the SD of its events
+        is at least `min_std` (hours). Default is 0.5.
 
     Returns
     -------
     float
         Value within [0, 7] range indicating overall SRM stability.
+        Events without time or target are ignored.
     """
 
-    hit_range = 45/60  # "hit" if falls within 45 minute
+    df = df[df[time_col].notnull()]
+    if valid_dates is not None:
+        df = filter_valid_dates(df, valid_dates, time_col=time_col)
 
-    l = []
+    groups = (_convert_timestamp_to_decimal(v.loc[:, time_col])
+              for k, v in df.groupby(target_col, observed=True))
 
-    for k, v in df.groupby(target_col):
-        series = v.loc[:, time_col]
-        series = _srm_preprocssing(series)
-        if len(series) >= min_samples:
+    return _calculate_srm_from_decimals(groups, min_samples=min_samples,
+                                        hit_range=hit_range,
+                                        outlier_factor=outlier_factor,
+                                        min_std=min_std)
 
-            mean = series.mean()
 
-            lower = mean - hit_range
-            upper = mean + hit_range
+def srm_parameter_sweep(df, target_col, hit_ranges=(45/60,),
+                        outlier_factors=(1.5,), min_samples_values=(3,),
+                        min_std_values=(0.5,), time_col='completion_time',
+                        user_col='user_id'):
+    """
+    Calculates SRM for a grid of parameters.
 
-            hit = _calculate_srm_hit(series, lower_limit=lower,
-                                     upper_limit=upper)
-            l.append(hit)
+    Timestamps are converted and sorted (by user, target and time of
+    day) only once. For each parameter combination, the outlier window
+    and hits of every user and target are counted with binary search
+    on the sorted array, so no event is revisited. For each
+    combination, the SRM is the same as `calculate_srm` on the rows
+    of the user. Rows without user id, target or time are ignored.
 
-    return sum(l)/len(l)
+    Parameters
+    ----------
+    df : DataFrame
+    target_col : str
+        Column with target names.
+    hit_ranges : iterable
+        Values of `hit_range` (hours). Default is (45/60,).
+    outlier_factors : iterable
+        Values of `outlier_factor`. Default is (1.5,).
+    min_samples_values : iterable
+        Values of `min_samples`. Default is (3,).
+    min_std_values : iterable
+        Values of `min_std`. Default is (0.5,).
+    time_col : str
+        Column containing timestamps. Default is 'completion_time'.
+    user_col : str
+        User id column. Default is 'user_id'.
+
+    Returns
+    -------
+    DataFrame
+        It contains user_id, hit_range, outlier_factor, min_std,
+        min_samples and srm columns, with one row for each user and
+        combination. SRM is
+        NaN if no target has enough samples. Use `pivot_table` to get a
+        cube for each user.
+    """
+
+    times = pd.to_datetime(df[time_col])
+    keep = (df[user_col].notnull() & df[target_col].notnull() &
+            times.notnull()).values
+    df, times = df[keep], times[keep]
+    minutes = (times.dt.hour * 60 + times.dt.minute).values
+
+    # decimal value of every minute of the day, computed in the same
+    # way as `_convert_timestamp_to_decimal`
+    table = np.array([h + m/60 for h in range(24) for m in range(60)])
+
+    user_codes, users = pd.factorize(df[user_col], sort=True)
+    target_codes, _ = pd.factorize(df[target_col])
+    _, group_codes = np.unique(np.column_stack([user_codes, target_codes]),
+                               axis=0, return_inverse=True)
+    group_codes = group_codes.ravel()
+
+    # integer keys keep the comparisons exact
+    keys = group_codes.astype('i8') * 1440 + minutes
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    decimals = table[minutes[order]]
+
+    n_groups = group_codes.max() + 1 if len(df) > 0 else 0
+    group_user = np.zeros(n_groups, dtype=int)
+    group_user[group_codes] = user_codes
+    start = np.searchsorted(keys, np.arange(n_groups) * 1440, 'left')
+    end = np.r_[start[1:], len(keys)]
+    n = end - start
+
+    def range_sum(values, first, last):
+        # sum of values[first:last] for each group (0 if empty)
+        idx = np.column_stack([first, last]).ravel()
+        r = np.add.reduceat(np.r_[values, 0], idx)[::2]
+        return np.where(last > first, r, 0)
+
+    def count_range(lower, upper):
+        # [first, last) positions of values within [lower, upper]
+        base = np.arange(n_groups) * 1440
+        lo = np.searchsorted(keys, base + np.searchsorted(table, lower,
+                                                          'left'), 'left')
+        hi = np.searchsorted(keys, base + np.searchsorted(table, upper,
+                                                          'right'), 'left')
+        return lo, hi
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = range_sum(decimals, start, end) / n
+        deviation = (decimals - np.repeat(mean, n))**2
+        std = np.sqrt(range_sum(deviation, start, end) / (n - 1))
+
+    l = []
+    for min_std, factor in itertools.product(min_std_values,
+                                             outlier_factors):
+        with np.errstate(invalid='ignore'):
+            is_filtered = ~(std < min_std)
+        lo, hi = count_range(np.where(is_filtered, mean - factor * std, 0),
+                             np.where(is_filtered, mean + factor * std, 24))
+        lo, hi = np.where(is_filtered, lo, start), np.where(is_filtered, hi,
+                                                            end)
+        k = hi - lo
+        with np.errstate(divide='ignore', invalid='ignore'):
+            kept_mean = range_sum(decimals, lo, hi) / k
+
+        for hit_range in hit_ranges:
+            first, last = count_range(kept_mean - hit_range,
+                                      kept_mean + hit_range)
+            hits = np.clip(last, lo, hi) - np.clip(first, lo, hi)
+
+            for min_samples in min_samples_values:
+                valid = k >= min_samples
+                total = np.bincount(group_user[valid], weights=hits[valid],
+                                    minlength=len(users))
+                count = np.bincount(group_user[valid], minlength=len(users))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    srm = total / count
+
+                l.append(pd.DataFrame({'user_id': users,
+                                       'hit_range': hit_range,
+                                       'outlier_factor': factor,
+                                       'min_std': min_std,
+                                       'min_samples': min_samples,
+                                       'srm': srm}))
+
+    return pd.concat(l, ignore_index=True)
+
+
+def _calculate_user_srm(df, **srm_args):
+    """
+    Calculates SRM score of a user.
+
+    It is `calculate_srm`, but NaN is returned if no target has
+    enough samples.
+    """
+
+    try:
+        return calculate_srm(df, **srm_args)
+    except ZeroDivisionError:
+        return np.nan
 
 
 def _calculate_srm_across_users(df,
                                 user_col='user_id',
+                                n_jobs=1,
+                                sink=None,
+                                batch_size=1000,
                                 **srm_args):
     """
     Calculates SRM score across users.
@@ -311,26 +1210,117 @@ def _calculate_srm_across_users(df,
     df : DataFrame
     user_col : str
         User id column. Default is 'user_id'.
+    n_jobs : int
+        Number of worker processes. If it is not 1, users are
+        processed in parallel using `anvil.parallel.apply_by_user`.
+        Default is 1.
+    sink : function
+        If given, results are passed to `sink` in DataFrame batches
+        of (at most) `batch_size` rows instead of being returned.
+        See `anvil.utils.csv_sink`. Default is None.
+    batch_size : int
+        Number of rows in each batch passed to `sink`. Default is 1000.
     **srm_args
-        Variable args. See `calculate_srm` for options.
+        Variable args. See `calculate_srm` for options. If
+        `valid_dates` is a DataFrame with `user_col` column (e.g.,
+        from `anvil.utils.select_valid_days`), user-days are matched.
 
     Returns
     -------
     DataFrame
-        A DataFrame with user_id and srm columns.
+        A DataFrame with user_id and srm columns. SRM is NaN for users
+        without any target having enough samples. If `sink` is given,
+        `None` is returned.
     """
 
-    l = []
-    for k, v in df.groupby(user_col):
-        srm = calculate_srm(v, **srm_args)
-        l.append({'user_id': k, 'srm': srm})
+    valid_dates = srm_args.pop('valid_dates', None)
+    if valid_dates is not None:
+        df = filter_valid_dates(
+            df, valid_dates, user_col=user_col,
+            time_col=srm_args.get('time_col', 'completion_time'))
+
+    if n_jobs != 1:
+        r = apply_by_user(df, _calculate_user_srm, user_col=user_col,
+                          n_jobs=n_jobs, **srm_args)
+        if sink is None:
+            return pd.DataFrame({'user_id': r.index.values,
+                                 'srm': r.values})
+        records = ({'user_id': k, 'srm': v} for k, v in r.items())
+    else:
+        records = ({'user_id': k, 'srm': _calculate_user_srm(v, **srm_args)}
+                   for k, v in df.groupby(user_col, observed=True))
+
+    batches = iter_batches(records,
+                           batch_size if sink is not None else None)
+
+    if sink is None:
+        return next(batches)
+
+    for b in batches:
+        sink(b)
+
+
+def iter_rolling_srm_across_users(df, start_date,
+                                  how_many_days,
+                                  time_col='completion_time',
+                                  compact=False,
+                                  **srm_args):
+    """
+    Lazily calculates rolling SRM across days.
+
+    It yields the SRM of each week as soon as it is computed, so
+    results of long ranges need not be kept in memory.
 
-    return pd.DataFrame(l)
+    Parameters
+    ----------
+    See `rolling_srm_across_users`.
+
+    Returns
+    -------
+    generator
+        One DataFrame (with user_id, srm, date columns) for each
+        week.
+    """
+    # invalid days are removed once, instead of in each week
+    valid_dates = srm_args.pop('valid_dates', None)
+    if valid_dates is not None:
+        df = filter_valid_dates(df, valid_dates, time_col=time_col,
+                                user_col=srm_args.get('user_col',
+                                                      'user_id'))
+
+    if compact:
+        user_col = srm_args.get('user_col', 'user_id')
+        target_col = srm_args['target_col']
+        df = compact_frame(df[[user_col, target_col, time_col]],
+                           categorical_cols=[user_col, target_col])
+        users = df[user_col].cat.categories
+
+    for i in range(how_many_days):
+        s = start_date + dt.timedelta(days=i)
+        e = s + dt.timedelta(days=7)
+
+        if compact:
+            w = df[(df[time_col] >= s) & (df[time_col] < e)]
+        else:
+            w = df[df[time_col].map(lambda z: z >= s and z < e)]
+        df_w = _calculate_srm_across_users(w, time_col=time_col, **srm_args)
+
+        if compact:
+            if len(df_w) > 0:
+                df_w['user_id'] = pd.Categorical(df_w['user_id'],
+                                                 categories=users)
+                df_w['srm'] = df_w['srm'].astype('f4')
+            df_w['date'] = to_day_number([s])[0]
+        else:
+            df_w['date'] = s.date()
+        yield df_w
 
 
 def rolling_srm_across_users(df, start_date,
                              how_many_days,
                              time_col='completion_time',
+                             compact=False,
+                             sink=None,
                              **srm_args):
     """
     Calculates rolling SRM across days for given days.
@@ -346,25 +1336,39 @@ def rolling_srm_across_users(df, start_date,
         at d where start_date <= d <= start_date + how_many_days.
     time_col : str
         Column indicating completion time. Default is 'completion_time'.
+    compact : bool
+        If compact dtypes should be used. Only the user, target and
+        time columns are kept, user and target columns are converted
+        to categoricals and the returned DataFrame contains categorical
+        user_id, float32 srm and int32 day numbers as date (see
+        `anvil.utils.to_day_number`). Default is False.
+    sink : function
+        If given, the result of each week is passed to `sink` as soon
+        as it is computed, instead of being returned. See
+        `anvil.utils.csv_sink` and `anvil.utils.parquet_sink`.
+        Default is None.
     **srm_args
-        Variable args. For options, see `calculate_srm`.
+        Variable args. For options, see `calculate_srm` and
+        `_calculate_srm_across_users` (e.g., `n_jobs`).
 
     Returns
     -------
     DataFrame
         A DataFrame with user_id, srm, date columns. The date column
         indicate the first day of each week on which SRM has
-        been calculated.
+        been calculated. If `sink` is given, `None` is returned.
     """
-    srm_df = None
-    for i in range(how_many_days):
-        s = start_date + dt.timedelta(days=i)
-        e = s + dt.timedelta(days=7)
+    frames = iter_rolling_srm_across_users(df, start_date, how_many_days,
+                                           time_col=time_col,
+                                           compact=compact, **srm_args)
 
-        w = df[df[time_col].map(lambda z: z >= s and z < e)]
-        df_w = _calculate_srm_across_users(w, time_col=time_col, **srm_args)
+    if sink is not None:
+        for df_w in frames:
+            sink(df_w)
+        return None
 
-        df_w['date'] = s.date()
-        srm_df = pd.concat([srm_df, df_w], ignore_index=True)
+    l = list(frames)
+    if len(l) == 0:
+        return None
 
-    return srm_df
+    return pd.concat(l, ignore_index=True)
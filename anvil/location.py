@@ -9,11 +9,18 @@
 
 """
 
-from geopy.distance import vincenty, great_circle
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from geopy.distance import vincenty, great_circle, EARTH_RADIUS
 import numpy as np
 import pandas as pd
-from scipy import spatial
-from sklearn import cluster
+from scipy import sparse, spatial
+from scipy.sparse import csgraph
+from sklearn import cluster, neighbors
+
+from .utils import compact_frame, filter_valid_dates, iter_batches,\
+    to_day_number
 
 
 """
@@ -23,9 +30,168 @@ Uses code from http://geoffboeing.com/2014/08/clustering-to-reduce-spatial-data-
 """
 
 
+def _geodesic_distance_function(distance_method):
+    """
+    Gets geodesic distance function.
+
+    Parameters
+    ----------
+    distance_method : str
+        Either 'vincenty' or 'great_circle'.
+
+    Returns
+    -------
+    function
+    """
+
+    if distance_method == 'vincenty':
+        return vincenty
+    elif distance_method == 'great_circle':
+        return great_circle
+    else:
+        raise ValueError('Unknown distance method: {0}. Must be '
+                         'either vincenty or great_circle')
+
+
+def _geodesic_distance_matrix(c_matrix, distance_method):
+    """
+    Computes pairwise geodesic distance matrix.
+
+    Parameters
+    ----------
+    c_matrix : ndarray
+        Coordinates (one point per row).
+    distance_method : str
+        See `_geodesic_distance_function`.
+
+    Returns
+    -------
+    ndarray
+        Square matrix where (i, j) entry denotes the distance
+        between point i and j in km.
+    """
+
+    geodesic_distance = _geodesic_distance_function(distance_method)
+    v = spatial.distance.pdist(c_matrix,
+                               lambda x, y: geodesic_distance(x, y).km)
+    return spatial.distance.squareform(v)
+
+
+def vectorized_metric(func):
+    """
+    Marks a distance function as vectorized.
+
+    A vectorized metric is called with two coordinate arrays of shapes
+    (m, k) and (n, k) and returns the (m, n) array of distances, so
+    `do_location_clustering` can compute distances in blocks without
+    calling a Python function for each pair of points. For example,
+    an altitude-aware distance (with `metric_cols=[lon_c, lat_c,
+    'altitude']` in `do_location_clustering`) could be:
+
+        @vectorized_metric
+        def distance_3d(x, y):
+            d = haversine_metric(x, y)
+            h = (x[:, 2, None] - y[None, :, 2]) / 1000
+            return np.sqrt(d ** 2 + h ** 2)
+
+    Parameters
+    ----------
+    func : function
+
+    Returns
+    -------
+    function
+        The same function with `vectorized` attribute set to True.
+    """
+
+    func.vectorized = True
+    return func
+
+
+@vectorized_metric
+def haversine_metric(x, y):
+    """
+    Calculates great circle distances between two sets of points.
+
+    Parameters
+    ----------
+    x : ndarray
+        Array of shape (m, 2) with (longitude, latitude) in degrees,
+        i.e., the column order used by `do_location_clustering`.
+        Other columns are ignored.
+    y : ndarray
+        Array of shape (n, 2), as `x`.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (m, n) with distances in km.
+    """
+
+    x = np.radians(np.asarray(x, dtype=float)[:, :2])
+    y = np.radians(np.asarray(y, dtype=float)[:, :2])
+
+    dlon = x[:, 0, None] - y[None, :, 0]
+    dlat = x[:, 1, None] - y[None, :, 1]
+    a = np.sin(dlat / 2) ** 2 + \
+        np.cos(x[:, 1, None]) * np.cos(y[None, :, 1]) * np.sin(dlon / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _radius_neighbors_graph(c_matrix, metric, eps, block_size=1024):
+    """
+    Computes sparse neighbor graph with a vectorized metric.
+
+    Parameters
+    ----------
+    c_matrix : ndarray
+        Coordinates (one point per row).
+    metric : function
+        Vectorized metric (see `vectorized_metric`).
+    eps : float
+        Maximum distance of neighbors.
+    block_size : int
+        Distances are computed in tiles of `block_size` x `block_size`
+        points, so at most `block_size`**2 distances are kept in
+        memory (besides the neighbors). Default is 1024.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Distances of the neighbors. Zero distances (e.g., of
+        duplicate points) are stored explicitly.
+    """
+
+    n = len(c_matrix)
+    rows = [np.empty(0, dtype=int)]
+    cols = [np.empty(0, dtype=int)]
+    dist = [np.empty(0)]
+
+    for i in range(0, n, block_size):
+        x = c_matrix[i:i + block_size]
+        for j in range(0, n, block_size):
+            y = c_matrix[j:j + block_size]
+            d = np.asarray(metric(x, y), dtype=float)
+            if d.shape != (len(x), len(y)):
+                raise ValueError(
+                    'Vectorized metric must return an array of shape '
+                    '{0}, got {1}'.format((len(x), len(y)), d.shape))
+
+            r, c = np.nonzero(d <= eps)
+            rows.append(r + i)
+            cols.append(c + j)
+            dist.append(d[r, c])
+
+    return sparse.csr_matrix((np.concatenate(dist),
+                              (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n, n))
+
+
 def do_location_clustering(df, eps=None, min_samples=None,
                            metric=None, lat_c='latitude',
-                           lon_c='longitude', distance_method='vincenty'):
+                           lon_c='longitude', distance_method='vincenty',
+                           metric_cols=None, block_size=1024):
     """
     Performs location based clustering.
 
@@ -44,7 +210,10 @@ def do_location_clustering(df, eps=None, min_samples=None,
         Default is 3.
 
     metric : Pairwise distance calculator between two points.
-        If `None`, the vincent distance is used. Default is
+        If `None`, the vincent distance is used. If the metric is
+        vectorized (see `vectorized_metric` and `haversine_metric`),
+        distances are computed in tiles of `block_size` x `block_size`
+        points and only neighbors within `eps` are kept. Default is
         None.
 
     lat_c : str
@@ -57,6 +226,15 @@ def do_location_clustering(df, eps=None, min_samples=None,
         Distance calculation method to use. The options are
         'vincenty' or 'great_circle'.
 
+    metric_cols : list
+        Columns passed to a custom `metric`. Default is None, i.e.,
+        [lon_c, lat_c].
+
+    block_size : int
+        Tile size for vectorized metrics, i.e., at most
+        `block_size`**2 distances are computed at a time, regardless
+        of the number of points. Default is 1024.
+
     Returns
     -------
 
@@ -81,23 +259,21 @@ def do_location_clustering(df, eps=None, min_samples=None,
     if min_samples is None:
         min_samples = 3
 
-    c_matrix = df.as_matrix(columns=[lon_c, lat_c])
-
-    if distance_method == 'vincenty':
-        geodesic_distance = vincenty
-    elif distance_method == 'great_circle':
-        geodesic_distance = great_circle
-    else:
-        raise ValueError('Unknown distance method: {0}. Must be '
-                         'either vincenty or great_circle')
+    if metric is None or metric_cols is None:
+        metric_cols = [lon_c, lat_c]
+    c_matrix = df[metric_cols].values
 
-    # Pre-computed distance matrix where (i, j) entry
-    # denotes the distance between point i and j in km.
     if metric is None:
-        v = spatial.distance.pdist(c_matrix,
-                                   lambda x, y: geodesic_distance(x, y).km)
-        c_matrix = spatial.distance.squareform(v)
+        c_matrix = _geodesic_distance_matrix(c_matrix, distance_method)
+        metric = 'precomputed'
+    elif getattr(metric, 'vectorized', False):
+        _geodesic_distance_function(distance_method)
+        c_matrix = _radius_neighbors_graph(c_matrix, metric, eps,
+                                           block_size=block_size)
         metric = 'precomputed'
+    else:
+        # only validates distance_method
+        _geodesic_distance_function(distance_method)
 
     return cluster.DBSCAN(eps=eps,
                           metric=metric,
@@ -105,7 +281,10 @@ def do_location_clustering(df, eps=None, min_samples=None,
 
 
 def daily_location_cluster_count(df, lat_c="latitude",
-                                 lon_c="longitude", **kwargs):
+                                 lon_c="longitude", compact=False,
+                                 sink=None, batch_size=1000,
+                                 valid_dates=None, sample_size=None,
+                                 n_samples=5, random_state=None, **kwargs):
     """
     Counts number of location cluster in a day.
 
@@ -121,6 +300,44 @@ def daily_location_cluster_count(df, lat_c="latitude",
     lon_c : str
         Column name for longitude data.
 
+    compact : bool
+        If compact dtypes should be used. Only latitude and longitude
+        are kept (as float32 where precision allows) and the returned
+        date and cluster columns contain int32 day numbers (see
+        `anvil.utils.to_day_number`) and int32 counts. Default is False.
+
+    sink : function
+        If given, results are passed to `sink` in DataFrame batches as
+        they are computed, instead of being returned. See
+        `anvil.utils.csv_sink`. Default is None.
+
+    batch_size : int
+        Number of rows in each batch passed to `sink`. Default is 1000.
+
+    valid_dates : iterable or DataFrame
+        If given, only these dates are clustered (see
+        `anvil.utils.filter_valid_dates` and
+        `anvil.utils.select_valid_days`). Default is None.
+
+    sample_size : int
+        If given, counts are approximated for large days: they are
+        clustered on `n_samples` independent samples of `sample_size`
+        points, and the count is the mean over the samples. Since the
+        cost of clustering is quadratic in the number of points,
+        sampling is only used for days with more than
+        `sample_size * sqrt(n_samples)` points; smaller days are
+        clustered exactly. `min_samples` is scaled by the sampling
+        fraction (but kept at least 2 unless it is 1), so the density
+        needed for a cluster is the same as in the full day.
+        Default is None, i.e., exact counts.
+
+    n_samples : int
+        Number of samples of each day if `sample_size` is given.
+        Default is 5.
+
+    random_state : int or np.random.RandomState
+        Seed of random numbers for sampling. Default is None.
+
     **kwargs
         Keyword arguments that will be passed to `do_location_clustering`.
 
@@ -128,15 +345,890 @@ def daily_location_cluster_count(df, lat_c="latitude",
     Returns
     -------
     DataFrame
-        It contains date and cluster columns.
+        It contains date and cluster columns. If `sample_size` is
+        given, cluster is the mean count (float) and a cluster_se
+        column contains its standard error estimated from the
+        variation between the samples (zero for exact days). If
+        `sink` is given, `None` is returned.
+
+    Notes
+    -----
+        The standard error only covers the sampling variance. If
+        `min_samples` is not reduced in proportion to the sample
+        (e.g., it is small or `sample_size` is small), sparse
+        clusters may still be missed, and clusters much wider than
+        `eps` may be split since sampled points are further apart.
+
+    """
+    batches = iter_daily_location_cluster_count(
+        df, lat_c=lat_c, lon_c=lon_c, compact=compact,
+        batch_size=batch_size if sink is not None else None,
+        valid_dates=valid_dates, sample_size=sample_size,
+        n_samples=n_samples, random_state=random_state, **kwargs)
+
+    if sink is not None:
+        for r in batches:
+            sink(r)
+        return None
 
+    return next(batches)
+
+
+def _count_location_clusters(df, **kwargs):
+    """
+    Counts clusters of `do_location_clustering` (without noise).
+    """
+
+    # Get cluster labels for each data points
+    clusters = do_location_clustering(df, **kwargs).labels_
+    # -1 indicates noise, so we do not want to count that
+    return len(np.unique(clusters)) - (-1 in clusters)
+
+
+def _daily_location_cluster_records(df, lat_c, lon_c, compact,
+                                    sample_size=None, n_samples=5,
+                                    random_state=None, **kwargs):
+    """
+    Generates rows of `daily_location_cluster_count` as dictionaries.
+    """
+
+    if compact:
+        df = compact_frame(df[[lat_c, lon_c]], float_cols=[lat_c, lon_c])
+        keys = to_day_number(df.index)
+    else:
+        keys = lambda z: z.date()
+
+    if sample_size is not None and \
+            not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    min_samples = kwargs.pop('min_samples', None) or 3
+
+    for k, v in df.groupby(keys):
+        if sample_size is None or \
+                n_samples * sample_size ** 2 >= len(v) ** 2:
+            counts = [_count_location_clusters(
+                v, lat_c=lat_c, lon_c=lon_c, min_samples=min_samples,
+                **kwargs)]
+        else:
+            # same density threshold as the full day
+            scaled = max(min(min_samples, 2),
+                         int(round(min_samples * sample_size / len(v))))
+            counts = [_count_location_clusters(
+                v.iloc[np.sort(random_state.choice(len(v), sample_size,
+                                                   replace=False))],
+                lat_c=lat_c, lon_c=lon_c, min_samples=scaled, **kwargs)
+                for _ in range(n_samples)]
+
+        if sample_size is None:
+            yield {'date': k, 'cluster': counts[0]}
+        else:
+            se = np.std(counts, ddof=1) / np.sqrt(len(counts)) \
+                if len(counts) > 1 else 0.0
+            yield {'date': k, 'cluster': np.mean(counts),
+                   'cluster_se': se}
+
+
+def iter_daily_location_cluster_count(df, lat_c="latitude",
+                                      lon_c="longitude", compact=False,
+                                      batch_size=1000, valid_dates=None,
+                                      sample_size=None, n_samples=5,
+                                      random_state=None, **kwargs):
+    """
+    Counts number of location cluster in a day in batches.
+
+    It yields the rows of `daily_location_cluster_count` as DataFrame
+    batches while they are computed.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with DateTimeIndex.
+    lat_c : str
+        Column name for latitude data.
+    lon_c : str
+        Column name for longitude data.
+    compact : bool
+        See `daily_location_cluster_count`.
+    batch_size : int
+        Maximum number of rows in each batch. If `None`, a single
+        batch (possibly empty) with all rows is yielded.
+        Default is 1000.
+    valid_dates : iterable or DataFrame
+        See `daily_location_cluster_count`.
+    sample_size : int
+        See `daily_location_cluster_count`.
+    n_samples : int
+        See `daily_location_cluster_count`.
+    random_state : int or np.random.RandomState
+        See `daily_location_cluster_count`.
+    **kwargs
+        Keyword arguments that will be passed to `do_location_clustering`.
+
+    Returns
+    -------
+    generator
+        DataFrame batches with date and cluster (and cluster_se if
+        `sample_size` is given) columns.
+    """
+
+    if valid_dates is not None:
+        df = filter_valid_dates(df, valid_dates)
+
+    records = _daily_location_cluster_records(
+        df, lat_c, lon_c, compact, sample_size=sample_size,
+        n_samples=n_samples, random_state=random_state, **kwargs)
+    for r in iter_batches(records, batch_size):
+        if compact and len(r) > 0:
+            r = r.astype({'date': 'i4'} if sample_size is not None
+                         else {'date': 'i4', 'cluster': 'i4'})
+        yield r
+
+
+def location_clustering_sweep(df, eps_values, min_samples_values,
+                              lat_c='latitude', lon_c='longitude',
+                              distance_method='vincenty', metric=None,
+                              metric_cols=None, block_size=1024):
     """
+    Performs location clustering for a grid of parameters.
+
+    The neighbor graph at the largest `eps` is computed once and kept
+    as a sparse matrix. For every (eps, min_samples) combination,
+    DBSCAN runs on the graph restricted to eps, so distances are never
+    recomputed. Great circle distances (and vectorized metrics) are
+    computed in tiles of `block_size` x `block_size` points with
+    NumPy, while vincenty distances need the full pairwise matrix
+    from geopy.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with latitude and longitude information.
+    eps_values : iterable
+        Values of eps (km). It must not be empty.
+    min_samples_values : iterable
+        Values of min_samples.
+    lat_c : str
+        Column name for latitude data.
+    lon_c : str
+        Column name for longitude data.
+    distance_method : str
+        Either 'vincenty' or 'great_circle'.
+    metric : function
+        Vectorized metric (see `vectorized_metric`) used instead of
+        `distance_method`. Default is None.
+    metric_cols : list
+        Columns passed to `metric`. Default is None, i.e.,
+        [lon_c, lat_c].
+    block_size : int
+        Tile size for vectorized distances, i.e., at most
+        `block_size`**2 distances are computed at a time.
+        Default is 1024.
+
+    Returns
+    -------
+    DataFrame
+        It contains eps, min_samples, cluster (number of clusters),
+        noise (number of noise points) and labels (array of cluster
+        labels) columns with one row for each combination. The labels
+        are the same as `do_location_clustering` with the same
+        parameters (up to rounding of distances at eps).
+    """
+
+    eps_values = sorted(eps_values)
+    if len(eps_values) == 0:
+        raise ValueError('eps_values must not be empty')
+
+    _geodesic_distance_function(distance_method)
+    if metric is not None and not getattr(metric, 'vectorized', False):
+        raise ValueError('metric must be vectorized (see '
+                         'vectorized_metric)')
+    n = len(df)
+
+    if n == 0:
+        rows = cols = np.empty(0, dtype=int)
+        dist = np.empty(0)
+    elif metric is not None or distance_method == 'great_circle':
+        if metric is None:
+            # same as geopy with (longitude, latitude) points (see
+            # `_geodesic_distance_matrix`), i.e., latitude is used as
+            # longitude by `haversine_metric`
+            metric, metric_cols = haversine_metric, [lat_c, lon_c]
+        elif metric_cols is None:
+            metric_cols = [lon_c, lat_c]
+        graph = _radius_neighbors_graph(df[metric_cols].values, metric,
+                                        eps_values[-1],
+                                        block_size=block_size).tocoo()
+        rows, cols, dist = graph.row, graph.col, graph.data
+    else:
+        d = _geodesic_distance_matrix(df[[lon_c, lat_c]].values,
+                                      distance_method)
+        rows, cols = np.nonzero(d <= eps_values[-1])
+        dist = d[rows, cols]
+        del d
+
     l = []
+    for eps in eps_values:
+        keep = dist <= eps
+        # explicit zeros (e.g., duplicate points) are neighbors
+        graph = sparse.csr_matrix((dist[keep], (rows[keep], cols[keep])),
+                                  shape=(n, n))
+
+        for min_samples in min_samples_values:
+            if n > 0:
+                labels = cluster.DBSCAN(eps=eps, min_samples=min_samples,
+                                        metric='precomputed').fit(
+                    graph).labels_
+            else:
+                labels = np.empty(0, dtype=int)
+
+            l.append({'eps': eps, 'min_samples': min_samples,
+                      'cluster': len(np.unique(labels)) - (-1 in labels),
+                      'noise': int(np.sum(labels == -1)),
+                      'labels': labels})
+
+    return pd.DataFrame(l, columns=['eps', 'min_samples', 'cluster',
+                                    'noise', 'labels'])
+
+
+def daily_location_clustering_sweep(df, eps_values, min_samples_values,
+                                    **kwargs):
+    """
+    Performs location clustering sweep for each day.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with DateTimeIndex. The index would be used for
+        grouping rows by dates.
+    eps_values : iterable
+        Values of eps (km).
+    min_samples_values : iterable
+        Values of min_samples.
+    **kwargs
+        Keyword arguments passed to `location_clustering_sweep`.
+
+    Returns
+    -------
+    DataFrame
+        It contains date, eps, min_samples, cluster and noise
+        columns. For a given eps and min_samples, the cluster column
+        is the same as `daily_location_cluster_count`.
+    """
+
+    frames = []
     for k, v in df.groupby(lambda z: z.date()):
-        # Get cluster labels for each data points
-        clusters = do_location_clustering(v, **kwargs).labels_
-        # -1 indicates noise, so we do not want to count that
-        num_clusters = len(np.unique(clusters)) - (-1 in clusters)
-        l.append({'date': k, 'cluster': num_clusters})
+        r = location_clustering_sweep(v, eps_values, min_samples_values,
+                                      **kwargs)
+        r.insert(0, 'date', k)
+        frames.append(r.drop('labels', axis=1))
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['date', 'eps', 'min_samples',
+                                     'cluster', 'noise'])
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_location_visits(df, labels, include_noise=False, max_gap=None):
+    """
+    Segments time-ordered location clusters into visits.
+
+    A visit is a run of consecutive points with the same cluster
+    label. Runs are found with vectorized comparisons of consecutive
+    labels (run-length encoding).
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` sorted ascending.
+    labels : array-like
+        Cluster label of each row, e.g., `labels_` attribute from
+        `do_location_clustering`.
+    include_noise : bool
+        If noise points (label -1) should form visits. Otherwise,
+        they are dropped before segmentation, so noise does not split
+        visits. Default is False.
+    max_gap : Timedelta
+        If the time between consecutive points is larger than
+        `max_gap`, a new visit is started. Default is None.
+
+    Returns
+    -------
+    DataFrame
+        It contains cluster, start, end, duration (end - start) and
+        n_points columns with one row for each visit.
+    """
+
+    index = pd.DatetimeIndex(df.index)
+    labels = np.asarray(labels)
+
+    if not include_noise:
+        keep = labels != -1
+        index, labels = index[keep], labels[keep]
+
+    if len(labels) == 0:
+        return pd.DataFrame({'cluster': [], 'start': [], 'end': [],
+                             'duration': [], 'n_points': []})
+
+    change = np.r_[True, labels[1:] != labels[:-1]]
+    if max_gap is not None:
+        gaps = index[1:] - index[:-1]
+        change[1:] |= np.asarray(gaps > pd.Timedelta(max_gap))
+
+    starts = np.flatnonzero(change)
+    ends = np.r_[starts[1:], len(labels)] - 1
+
+    return pd.DataFrame({'cluster': labels[starts],
+                         'start': index[starts],
+                         'end': index[ends],
+                         'duration': index[ends] - index[starts],
+                         'n_points': ends - starts + 1})
+
+
+def location_dwell_time(visits):
+    """
+    Computes total dwell time in each cluster.
+
+    Parameters
+    ----------
+    visits : DataFrame
+        Visits from `get_location_visits`.
+
+    Returns
+    -------
+    Series
+        Total duration (Timedelta) indexed by cluster label.
+    """
+
+    codes, clusters = pd.factorize(visits['cluster'], sort=True)
+    seconds = pd.to_timedelta(visits['duration']).dt.total_seconds().values
+    total = np.bincount(codes, weights=seconds, minlength=len(clusters))
+
+    return pd.Series(pd.to_timedelta(total, unit='s'),
+                     index=pd.Index(clusters, name='cluster'))
+
+
+def location_transition_matrix(visits):
+    """
+    Counts transitions between clusters.
+
+    A transition is counted for every pair of consecutive visits.
+
+    Parameters
+    ----------
+    visits : DataFrame
+        Visits from `get_location_visits`.
+
+    Returns
+    -------
+    DataFrame
+        Square matrix where (i, j) entry is the number of transitions
+        from cluster i to cluster j.
+    """
+
+    codes, clusters = pd.factorize(visits['cluster'], sort=True)
+    k = len(clusters)
+
+    counts = np.bincount(codes[:-1] * k + codes[1:],
+                         minlength=k * k) if k > 0 else np.zeros(0)
+
+    index = pd.Index(clusters, name='cluster')
+    return pd.DataFrame(counts.reshape(k, k), index=index, columns=index)
+
+
+def _tile_core_counts(coords, n_owned, eps):
+    """
+    Counts neighbors of owned points within a tile.
+
+    Parameters
+    ----------
+    coords : ndarray
+        (latitude, longitude) in radians of the tile points. The
+        first `n_owned` points are owned by the tile and the rest
+        are halo points.
+    n_owned : int
+    eps : float
+        Radius in radians.
+
+    Returns
+    -------
+    ndarray
+        Number of neighbors (including the point itself) of each
+        owned point.
+    """
+
+    tree = neighbors.BallTree(coords, metric='haversine')
+    return tree.query_radius(coords[:n_owned], eps, count_only=True)
+
+
+def _tile_links(coords, index, n_owned, is_core, eps):
+    """
+    Finds core connections and border candidates within a tile.
+
+    Core points reachable from owned core points are grouped into
+    local components, so the number of returned links is linear in
+    the number of tile points.
+
+    Parameters
+    ----------
+    coords : ndarray
+        See `_tile_core_counts`.
+    index : ndarray
+        Global index of the tile points.
+    n_owned : int
+    is_core : ndarray
+        Boolean array indicating core points (of all tile points).
+    eps : float
+        Radius in radians.
+
+    Returns
+    -------
+    tuple
+        (links, borders) where links is a (2, k) array of global
+        indices of core points in the same cluster and borders is a
+        (2, m) array of (owned non-core point, core neighbor) pairs.
+    """
+
+    tree = neighbors.BallTree(coords, metric='haversine')
+    owned = np.arange(n_owned)
+    links, borders = np.empty((2, 0), dtype=int), np.empty((2, 0), dtype=int)
+
+    core = owned[is_core[:n_owned]]
+    if len(core) > 0:
+        nbrs = tree.query_radius(coords[core], eps)
+        rows = np.repeat(core, [len(z) for z in nbrs])
+        cols = np.concatenate(nbrs)
+        keep = is_core[cols]
+        graph = sparse.coo_matrix((np.ones(keep.sum()),
+                                   (rows[keep], cols[keep])),
+                                  shape=(len(coords), len(coords)))
+        _, component = csgraph.connected_components(graph,
+                                                    directed=False)
+        # link every core point to the first core point of its component
+        members = np.flatnonzero(is_core)
+        _, first, inverse = np.unique(component[members], return_index=True,
+                                      return_inverse=True)
+        links = np.vstack([index[members[first][inverse]], index[members]])
+
+    border = owned[~is_core[:n_owned]]
+    if len(border) > 0:
+        nbrs = tree.query_radius(coords[border], eps)
+        rows = np.repeat(border, [len(z) for z in nbrs])
+        cols = np.concatenate(nbrs)
+        keep = is_core[cols]
+        borders = np.vstack([index[rows[keep]], index[cols[keep]]])
+
+    return links, borders
+
+
+def _location_tiles(lat, lon, eps, tile_size):
+    """
+    Partitions points into tiles with halos.
+
+    Parameters
+    ----------
+    lat : ndarray
+        Latitude in degrees.
+    lon : ndarray
+        Longitude in degrees.
+    eps : float
+        Radius in km.
+    tile_size : float
+        Tile size in degrees.
+
+    Returns
+    -------
+    list
+        List of (owned indices, halo indices) for non-empty tiles.
+    """
+
+    eps_deg = np.degrees(eps / EARTH_RADIUS)
+
+    row = np.floor((lat - lat.min()) / tile_size).astype(int)
+    col = np.floor((lon - lon.min()) / tile_size).astype(int)
+
+    order = np.argsort(lat, kind='stable')
+    sorted_lat = lat[order]
+
+    tiles = []
+    for r in np.unique(row):
+        lower = lat.min() + r * tile_size - eps_deg
+        upper = lat.min() + (r + 1) * tile_size + eps_deg
+        candidates = order[np.searchsorted(sorted_lat, lower, 'left'):
+                           np.searchsorted(sorted_lat, upper, 'right')]
+
+        # a degree of longitude shrinks with latitude
+        max_lat = min(90.0, max(abs(lower), abs(upper)))
+        cos = np.cos(np.radians(max_lat))
+        halo = eps_deg / cos if cos > eps_deg / 180 else 360.0
+
+        in_row = candidates[row[candidates] == r]
+        for c in np.unique(col[in_row]):
+            owned = in_row[col[in_row] == c]
+            left = lon.min() + c * tile_size - halo
+            right = lon.min() + (c + 1) * tile_size + halo
+            z = lon[candidates]
+            is_halo = (z >= left) & (z <= right) & \
+                ~((row[candidates] == r) & (col[candidates] == c))
+            tiles.append((owned, candidates[is_halo]))
+
+    return tiles
+
+
+def _map_tiles(func, args, n_jobs):
+    """
+    Applies `func` on tile arguments (in parallel if n_jobs != 1).
+    """
+
+    if n_jobs == 1:
+        return [func(*a) for a in args]
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(func, *zip(*args)))
+
+
+def tiled_location_clustering(df, eps=1.0, min_samples=3,
+                              lat_c='latitude', lon_c='longitude',
+                              n_jobs=None, tile_size=None):
+    """
+    Performs DBSCAN clustering on spatial tiles in parallel.
+
+    Points are partitioned into tiles of `tile_size` degrees and each
+    tile is extended with a halo of `eps` (in all directions), so that
+    neighbors of every point are found within the tile of the point.
+    Core points are determined per tile and clusters spanning tiles are
+    merged through their shared core points (union-find using connected
+    components). It produces the same labels as DBSCAN with the
+    haversine (great circle) metric on (latitude, longitude), e.g.,
+    `do_location_clustering(df, metric=haversine_metric)`, including
+    the numbering of clusters and the assignment of border points.
+    Note that `do_location_clustering` with `distance_method` passes
+    (longitude, latitude) to geopy, which expects (latitude,
+    longitude), so its labels can differ.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with latitude and longitude information.
+    eps : float
+        Maximum distance (km) between two points to be in the
+        same cluster. Default is 1.0.
+    min_samples : int
+        The minimum number of points in a cluster. Default is 3.
+    lat_c : str
+        Column name for latitude data.
+    lon_c : str
+        Column name for longitude data.
+    n_jobs : int
+        Number of worker processes. If `None`, `os.cpu_count()` is
+        used. If 1, everything runs in the current process.
+    tile_size : float
+        Tile size in degrees. Default is None, i.e., the bounding box is
+        split into about four tiles per worker (and tiles are at least
+        2 * eps wide).
+
+    Returns
+    -------
+    ndarray
+        Cluster label of each point, where -1 indicates noise.
+
+    Notes
+    -----
+        Tiles do not wrap around the antimeridian, so points within
+        `eps` across longitude ±180 are not considered neighbors.
+    """
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    lat = df[lat_c].values.astype(float)
+    lon = df[lon_c].values.astype(float)
+    n = len(df)
+    if n == 0:
+        return np.empty(0, dtype=int)
+
+    if tile_size is None:
+        span = max(np.ptp(lat), np.ptp(lon))
+        tile_size = span / np.ceil(np.sqrt(4 * n_jobs))
+        tile_size = max(tile_size, 2 * np.degrees(eps / EARTH_RADIUS), 1e-9)
+
+    coords = np.radians(np.column_stack([lat, lon]))
+    eps_rad = eps / EARTH_RADIUS
+    tiles, n_owned = [], []
+    for owned, halo in _location_tiles(lat, lon, eps, tile_size):
+        tiles.append(np.concatenate([owned, halo]))
+        n_owned.append(len(owned))
+
+    # Phase 1: core points
+    counts = _map_tiles(_tile_core_counts,
+                        [(coords[t], k, eps_rad)
+                         for t, k in zip(tiles, n_owned)], n_jobs)
+    is_core = np.zeros(n, dtype=bool)
+    for t, k, c in zip(tiles, n_owned, counts):
+        is_core[t[:k]] = c >= min_samples
+
+    # Phase 2: links between core points and border candidates
+    results = _map_tiles(_tile_links,
+                         [(coords[t], t, k, is_core[t], eps_rad)
+                          for t, k in zip(tiles, n_owned)], n_jobs)
+    links = np.hstack([r[0] for r in results])
+    borders = np.hstack([r[1] for r in results])
+
+    graph = sparse.coo_matrix((np.ones(links.shape[1]), (links[0], links[1])),
+                              shape=(n, n))
+    _, component = csgraph.connected_components(graph, directed=False)
+
+    # Clusters are numbered by their first core point (as DBSCAN does)
+    labels = np.full(n, -1)
+    core_index = np.flatnonzero(is_core)
+    _, first = np.unique(component[core_index], return_index=True)
+    rank = np.empty(component.max() + 1, dtype=int)
+    rank[component[core_index[np.sort(first)]]] = np.arange(len(first))
+    labels[core_index] = rank[component[core_index]]
+
+    # Border points get the first cluster that reaches them
+    if borders.shape[1] > 0:
+        candidate = labels[borders[1]]
+        best = np.full(n, np.iinfo(int).max)
+        np.minimum.at(best, borders[0], candidate)
+        has_cluster = best < np.iinfo(int).max
+        labels[has_cluster] = best[has_cluster]
+
+    return labels
+
+
+def _circle_bbox(lat, lon, radius):
+    """
+    Computes (min lat, min lon, max lat, max lon) of a circle in km.
+    """
+
+    d = np.degrees(radius / EARTH_RADIUS)
+    cos_lat = np.cos(np.radians(min(abs(lat) + d, 90.0)))
+    dlon = 180.0 if cos_lat < 1e-12 else min(d / cos_lat, 180.0)
+    return lat - d, lon - dlon, lat + d, lon + dlon
+
+
+def _cell_key(rows, cols):
+    """
+    Combines grid cell row and column into a single integer key.
+    """
+
+    return rows * (1 << 32) + cols
+
+
+def build_geofence_index(places, cell_size=None):
+    """
+    Builds grid index of places for `label_geofences`.
+
+    Parameters
+    ----------
+    places : list
+        Dictionaries with a 'name' key, and either 'latitude',
+        'longitude' and 'radius' (in km) keys for circular places or
+        a 'polygon' key with a list of (latitude, longitude) vertices.
+        If places overlap, the earlier place is used.
+    cell_size : float
+        Size of grid cells in degrees. Default is None, i.e., the
+        median extent of the places.
+
+    Returns
+    -------
+    dict
+        Index to be used with `label_geofences`.
+    """
+
+    names, bboxes, circles, polygons = [], [], {}, {}
+    for i, p in enumerate(places):
+        names.append(p['name'])
+        if 'polygon' in p:
+            vertices = np.asarray(p['polygon'], dtype=float)
+            if vertices.ndim != 2 or len(vertices) < 3:
+                raise ValueError('Polygon of {0} must have at least '
+                                 'three vertices'.format(p['name']))
+            polygons[i] = vertices
+            bboxes.append(np.r_[vertices.min(axis=0), vertices.max(axis=0)])
+        else:
+            circles[i] = (p['latitude'], p['longitude'], p['radius'])
+            bboxes.append(_circle_bbox(*circles[i]))
+
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    if cell_size is None:
+        extent = np.maximum(bboxes[:, 2] - bboxes[:, 0],
+                            bboxes[:, 3] - bboxes[:, 1])
+        cell_size = np.median(extent) if len(extent) > 0 else 1.0
+    cell_size = max(cell_size, 1e-6)
+
+    # (cell, place) pairs of all cells overlapping the bounding boxes
+    lo = np.floor(bboxes[:, :2] / cell_size).astype('i8')
+    hi = np.floor(bboxes[:, 2:] / cell_size).astype('i8')
+    keys, ids = [np.empty(0, dtype='i8')], [np.empty(0, dtype=int)]
+    for i in range(len(bboxes)):
+        rows, cols = np.meshgrid(np.arange(lo[i, 0], hi[i, 0] + 1),
+                                 np.arange(lo[i, 1], hi[i, 1] + 1))
+        keys.append(_cell_key(rows.ravel(), cols.ravel()))
+        ids.append(np.full(rows.size, i))
+
+    keys, ids = np.concatenate(keys), np.concatenate(ids)
+    order = np.lexsort((ids, keys))
+
+    return {'names': np.asarray(names, dtype=object),
+            'bboxes': bboxes,
+            'circles': circles,
+            'polygons': polygons,
+            'cell_size': cell_size,
+            'cell_keys': keys[order],
+            'cell_places': ids[order]}
+
+
+def _points_in_polygon(lat, lon, vertices):
+    """
+    Tests if points are in a polygon (ray casting).
+    """
+
+    inside = np.zeros(len(lat), dtype=bool)
+    v0 = vertices
+    v1 = np.roll(vertices, -1, axis=0)
+    for (a_lat, a_lon), (b_lat, b_lon) in zip(v0, v1):
+        crosses = (a_lat > lat) != (b_lat > lat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = a_lon + (lat - a_lat) * (b_lon - a_lon) / (b_lat - a_lat)
+        inside ^= crosses & (lon < x)
+    return inside
+
+
+def label_geofences(df, index, lat_c='latitude', lon_c='longitude'):
+    """
+    Labels points with the places containing them.
+
+    Candidate places of each point are found from the grid cell of
+    the point and filtered by bounding boxes, so exact (distance or
+    point-in-polygon) tests are only done for nearby places.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with latitude and longitude information.
+    index : dict
+        See `build_geofence_index`.
+    lat_c : str
+        Column name for latitude data.
+    lon_c : str
+        Column name for longitude data.
+
+    Returns
+    -------
+    Series
+        Name of the place of each point (with the index of `df`).
+        Points outside all places are missing (null).
+    """
+
+    lat = df[lat_c].values.astype(float)
+    lon = df[lon_c].values.astype(float)
+    size = index['cell_size']
+    keys = _cell_key(np.floor(lat / size).astype('i8'),
+                     np.floor(lon / size).astype('i8'))
+
+    # candidate (point, place) pairs
+    start = np.searchsorted(index['cell_keys'], keys, side='left')
+    end = np.searchsorted(index['cell_keys'], keys, side='right')
+    count = end - start
+    points = np.repeat(np.arange(len(df)), count)
+    offset = np.arange(len(points)) - np.repeat(np.cumsum(count) - count,
+                                                count)
+    places = index['cell_places'][np.repeat(start, count) + offset]
+
+    bbox = index['bboxes'][places]
+    keep = (lat[points] >= bbox[:, 0]) & (lon[points] >= bbox[:, 1]) & \
+        (lat[points] <= bbox[:, 2]) & (lon[points] <= bbox[:, 3])
+    points, places = points[keep], places[keep]
+
+    hit = np.zeros(len(points), dtype=bool)
+    for i in np.unique(places):
+        k = np.flatnonzero(places == i)
+        p = points[k]
+        if i in index['polygons']:
+            hit[k] = _points_in_polygon(lat[p], lon[p],
+                                        index['polygons'][i])
+        else:
+            c_lat, c_lon, radius = index['circles'][i]
+            d = haversine_metric(np.column_stack([lon[p], lat[p]]),
+                                 [[c_lon, c_lat]])[:, 0]
+            hit[k] = d <= radius
+
+    # the earliest place wins
+    best = np.full(len(df), len(index['names']))
+    np.minimum.at(best, points[hit], places[hit])
+
+    names = np.append(index['names'], None)
+    return pd.Series(names[best], index=df.index)
+
+
+def _to_unit_vectors(lat, lon):
+    """
+    Converts latitude and longitude (in degrees) to 3D unit vectors.
+    """
+
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+
+def assign_to_clusters(df, labels, new_df, lat_c='latitude',
+                       lon_c='longitude', max_distance=None):
+    """
+    Assigns new points to the nearest existing cluster.
+
+    The centroid of each cluster (e.g., from `do_location_clustering`)
+    is computed and new points are matched to the nearest centroid
+    using a KD-tree.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with latitude and longitude information of the
+        clustered points.
+    labels : ndarray
+        Cluster label of each point of `df`. Noise (-1) is ignored.
+    new_df : DataFrame
+        DataFrame with latitude and longitude information of the
+        new points.
+    lat_c : str
+        Column name for latitude data.
+    lon_c : str
+        Column name for longitude data.
+    max_distance : float
+        Maximum (great circle) distance in km between a point and the
+        centroid. Farther points are labeled -1. Default is None,
+        i.e., no limit.
+
+    Returns
+    -------
+    tuple
+        (labels, distances) where labels is the cluster label of each
+        new point and distances is the distance (km) to the centroid.
+    """
+
+    labels = np.asarray(labels)
+    clustered = labels != -1
+    n = len(new_df)
+    if not clustered.any():
+        return np.full(n, -1), np.full(n, np.inf)
+
+    v = _to_unit_vectors(df[lat_c].values[clustered],
+                         df[lon_c].values[clustered])
+    cluster_ids, inverse = np.unique(labels[clustered], return_inverse=True)
+    centroids = np.zeros((len(cluster_ids), 3))
+    np.add.at(centroids, inverse, v)
+    centroids /= np.linalg.norm(centroids, axis=1)[:, None]
+
+    tree = spatial.cKDTree(centroids)
+    chord, nearest = tree.query(_to_unit_vectors(new_df[lat_c].values,
+                                                 new_df[lon_c].values))
+    distances = 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+    r = cluster_ids[nearest]
+    if max_distance is not None:
+        r = np.where(distances <= max_distance, r, -1)
 
-    return pd.DataFrame(l)
+    return r, distances
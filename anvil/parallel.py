@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.parallel
+    ~~~~~~~~~~~~~~
+
+    Collection of utilities for running per-user computations
+    across processes.
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+from multiprocessing import shared_memory
+import os
+
+import numpy as np
+import pandas as pd
+
+
+_INDEX_KEY = '__index__'
+
+
+def _to_shareable(series):
+    """
+    Converts a Series (or Index) into a plain NumPy array.
+
+    Numeric and boolean values are used as they are. Datetime values
+    are stored as UTC nanoseconds, categoricals as their codes and
+    everything else is factorized into integer codes. The dtype is
+    kept in meta, so `_from_shareable` returns values of the same
+    dtype.
+
+    Parameters
+    ----------
+    series : Series or Index
+
+    Returns
+    -------
+    tuple
+        (array, meta) where meta contains the information needed by
+        `_from_shareable` to reconstruct the values.
+    """
+
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        tz = getattr(series.dtype, 'tz', None)
+        values = pd.DatetimeIndex(series)
+        if tz is not None:
+            values = values.tz_convert('UTC').tz_localize(None)
+        arr = np.asarray(values, dtype='datetime64[ns]').view('i8')
+        return arr, {'kind': 'datetime', 'tz': tz}
+
+    dtype = getattr(series, 'dtype', None)
+    if isinstance(dtype, np.dtype) and dtype.kind in 'biuf':
+        return np.ascontiguousarray(series), {'kind': 'plain'}
+
+    if isinstance(dtype, pd.CategoricalDtype):
+        codes = pd.Categorical(series, dtype=dtype).codes
+        return codes.astype('i8'), {'kind': 'categorical', 'dtype': dtype}
+
+    codes, uniques = pd.factorize(series)
+    return codes.astype('i8'), {'kind': 'codes',
+                                'uniques': np.asarray(uniques, dtype=object),
+                                'dtype': dtype}
+
+
+def _from_shareable(arr, meta):
+    """
+    Inverse of `_to_shareable`.
+
+    Parameters
+    ----------
+    arr : ndarray
+    meta : dict
+
+    Returns
+    -------
+    ndarray or DatetimeIndex
+    """
+
+    if meta['kind'] == 'datetime':
+        values = pd.DatetimeIndex(arr.view('datetime64[ns]'))
+        if meta['tz'] is not None:
+            values = values.tz_localize('UTC').tz_convert(meta['tz'])
+        return values
+
+    if meta['kind'] == 'categorical':
+        return pd.Categorical.from_codes(np.array(arr), dtype=meta['dtype'])
+
+    if meta['kind'] == 'codes':
+        # code -1 is used for missing values, which maps to the
+        # trailing None.
+        lookup = np.append(meta['uniques'], None)
+        values = lookup[arr]
+        if meta['dtype'] == object:
+            return values
+        return pd.array(values, dtype=meta['dtype'])
+
+    return np.array(arr)
+
+
+def _balanced_chunks(sizes, n_chunks):
+    """
+    Partitions groups into chunks with similar total size.
+
+    Uses the greedy longest-processing-time rule: groups are
+    assigned (largest first) to the chunk with smallest load.
+
+    Parameters
+    ----------
+    sizes : array-like
+        Size of each group.
+    n_chunks : int
+        Number of chunks.
+
+    Returns
+    -------
+    list
+        List of non-empty lists of group positions. Each list
+        is sorted ascending.
+    """
+
+    n_chunks = max(1, min(n_chunks, len(sizes)))
+    heap = [(0, i) for i in range(n_chunks)]
+    chunks = [[] for _ in range(n_chunks)]
+
+    for g in np.argsort(-np.asarray(sizes), kind='stable'):
+        load, i = heapq.heappop(heap)
+        chunks[i].append(int(g))
+        heapq.heappush(heap, (load + int(sizes[g]), i))
+
+    return [sorted(c) for c in chunks if c]
+
+
+# state of a worker process (see `_init_worker`)
+_WORKER = {}
+
+
+def _init_worker(spec, func, kwargs):
+    """
+    Worker initializer.
+
+    Attaches to the shared memory blocks once, so the spec (including
+    the unique values of factorized columns), `func` and `kwargs` are
+    sent once per worker instead of once per chunk.
+
+    Parameters
+    ----------
+    spec : dict
+        Column name -> (shared memory name, dtype, length, meta).
+    func : function
+    kwargs : dict
+        Keyword arguments for `func`.
+    """
+
+    blocks, arrays = {}, {}
+    for k, (name, dtype, length, meta) in spec.items():
+        blocks[k] = shared_memory.SharedMemory(name=name)
+        arrays[k] = (np.ndarray(length, dtype=dtype, buffer=blocks[k].buf),
+                     meta)
+
+    # blocks are kept open (and closed at exit) with the worker
+    _WORKER.update(blocks=blocks, arrays=arrays, func=func, kwargs=kwargs)
+
+
+def _run_chunk(groups):
+    """
+    Worker entry point.
+
+    Rebuilds the rows of each group from the shared memory blocks
+    (see `_init_worker`) and applies `func` on them.
+
+    Parameters
+    ----------
+    groups : list
+        List of (group position, start, stop) tuples.
+
+    Returns
+    -------
+    list
+        List of (group position, result) tuples.
+    """
+
+    arrays = _WORKER['arrays']
+    func, kwargs = _WORKER['func'], _WORKER['kwargs']
+    index_arr, index_meta = arrays[_INDEX_KEY]
+
+    results = []
+    for g, start, stop in groups:
+        # Only the slice of the current group is copied.
+        columns = {k: _from_shareable(arr[start:stop], meta)
+                   for k, (arr, meta) in arrays.items() if k != _INDEX_KEY}
+        index = _from_shareable(index_arr[start:stop], index_meta)
+        df = pd.DataFrame(columns, index=index,
+                          columns=index_meta['columns'])
+        df.index.name = index_meta['name']
+        results.append((g, func(df, **kwargs)))
+
+    return results
+
+
+def _assemble_results(keys, results, user_col):
+    """
+    Combines per-user results in the given key order.
+
+    Parameters
+    ----------
+    keys : list
+        User ids.
+    results : list
+        Results of each user (same order as keys).
+    user_col : str
+        Name of the user column in the returned value.
+
+    Returns
+    -------
+    DataFrame or Series
+        If `func` returned DataFrames, they are concatenated with
+        `user_col` as the first column. Dictionaries are turned into
+        rows of a DataFrame. Otherwise, a Series indexed by user ids
+        is returned.
+    """
+
+    if len(results) > 0 and all(isinstance(r, pd.DataFrame)
+                                for r in results):
+        frames = []
+        for k, r in zip(keys, results):
+            r = r.copy()
+            r.insert(0, user_col, k)
+            frames.append(r)
+        return pd.concat(frames, ignore_index=True)
+
+    if len(results) > 0 and all(isinstance(r, dict) for r in results):
+        l = []
+        for k, r in zip(keys, results):
+            d = {user_col: k}
+            d.update(r)
+            l.append(d)
+        return pd.DataFrame(l)
+
+    return pd.Series(results, index=pd.Index(keys, name=user_col))
+
+
+def apply_by_user(df, func, user_col='user_id', n_jobs=None,
+                  chunks_per_job=4, **kwargs):
+    """
+    Applies a function on rows of each user in a process pool.
+
+    The rows are sorted by user and every column (including the
+    index) is placed in `multiprocessing.shared_memory`, so
+    workers read them without pickling the DataFrame. Users are
+    partitioned into chunks of similar row count and results are
+    returned in sorted user order, i.e., the same order as
+    `df.groupby(user_col)`.
+
+    Parameters
+    ----------
+    df : DataFrame
+    func : function
+        Function applied on the rows of each user. It must be
+        picklable (e.g., a module level function such as
+        `anvil.circadian.calculate_srm`) and take a DataFrame as the
+        first parameter.
+    user_col : str
+        User id column. Default is 'user_id'.
+    n_jobs : int
+        Number of worker processes. If `None`, `os.cpu_count()` is
+        used. If 1, everything runs in the current process.
+    chunks_per_job : int
+        Number of chunks per worker. More chunks give better load
+        balancing at the cost of scheduling overhead. Default is 4.
+    **kwargs
+        Keyword arguments passed to `func`.
+
+    Returns
+    -------
+    DataFrame or Series
+        If `func` returns DataFrames, they are concatenated with
+        `user_col` as the first column. If it returns dictionaries,
+        each user becomes a row. Otherwise, a Series indexed by
+        user ids is returned.
+
+    Notes
+    -----
+        Non-numeric columns are factorized before sharing, so only
+        their unique values are pickled (once per worker, along with
+        `func` and `kwargs`), and column dtypes (e.g., categorical or
+        nullable integers) are restored in the workers. Rows with
+        missing user id are dropped as in `groupby`.
+    """
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    if n_jobs == 1:
+        keys, results = [], []
+        for k, v in df.groupby(user_col):
+            keys.append(k)
+            results.append(func(v, **kwargs))
+        return _assemble_results(keys, results, user_col)
+
+    if isinstance(df.index, pd.MultiIndex):
+        raise ValueError('MultiIndex is not supported')
+
+    codes, keys = pd.factorize(df[user_col], sort=True)
+    valid = codes >= 0
+    order = np.flatnonzero(valid)[np.argsort(codes[valid], kind='stable')]
+    sizes = np.bincount(codes[valid], minlength=len(keys))
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+
+    df = df.iloc[order]
+    items = [(c, df[c]) for c in df.columns]
+    items.append((_INDEX_KEY, df.index))
+
+    blocks, spec = [], {}
+    try:
+        for k, series in items:
+            arr, meta = _to_shareable(series)
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(arr.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[:] = arr
+            spec[k] = (block.name, arr.dtype, len(arr), meta)
+        spec[_INDEX_KEY][3]['columns'] = list(df.columns)
+        spec[_INDEX_KEY][3]['name'] = df.index.name
+
+        chunks = _balanced_chunks(sizes, n_jobs * chunks_per_job)
+        results = [None] * len(keys)
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(spec, func, kwargs)) as executor:
+            futures = [executor.submit(_run_chunk,
+                                       [(g, bounds[g], bounds[g + 1])
+                                        for g in chunk])
+                       for chunk in chunks]
+            for f in futures:
+                for g, r in f.result():
+                    results[g] = r
+    finally:
+        for b in blocks:
+            b.close()
+            b.unlink()
+
+    return _assemble_results(list(keys), results, user_col)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.pipeline
+    ~~~~~~~~~~~~~~
+
+    Collection of utilities for computing several features together
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from .circadian import inter_daily_stability, intra_daily_variability,\
+    sort_by_hourly_values, _calculate_srm_across_users
+from .location import daily_location_cluster_count
+from .utils import convert_time_zone, get_hourly_distribution,\
+    get_hourly_tensor
+
+
+"""
+Feature pipeline.
+
+Features are computed from a graph of stages. Each stage is computed
+once from the results of its dependencies, e.g., IS, IV and sorted
+hourly values all use the same hourly bins, and stages that do not
+depend on each other (e.g., SRM and location clusters) run in
+parallel threads. Threads only overlap where the GIL is released
+(mostly NumPy code), so SRM and per-user clustering gain little from
+them; the main benefit is that shared stages are computed once. SRM
+users can be computed in worker processes with `n_jobs` in
+`srm_args`.
+
+The input DataFrames are:
+
+    activity: DateTimeIndex, user and value columns.
+    events: user, target and time columns (for SRM).
+    gps: DateTimeIndex, user, latitude and longitude columns.
+"""
+
+
+SOURCES = ('activity', 'events', 'gps')
+
+
+def _to_local(df, params, column_name=None):
+    """
+    Converts timestamps (index or column) to local time index.
+    """
+
+    if params['time_zone'] is None:
+        if column_name is None:
+            return df
+        return df.set_index(pd.to_datetime(df[column_name]))
+
+    return convert_time_zone(df, column_name=column_name,
+                             should_localize=params['should_localize'],
+                             to_timezone=params['time_zone'])
+
+
+def _activity_local(r, params):
+    return _to_local(r['activity'], params)
+
+
+def _gps_local(r, params):
+    return _to_local(r['gps'], params)
+
+
+def _events_local(r, params):
+    return _to_local(r['events'], params, column_name=params['time_col'])
+
+
+def _hourly_bins(r, params):
+    return get_hourly_tensor(r['activity_local'], params['value_col'],
+                             user_col=params['user_col'],
+                             how=params['hourly_how'])
+
+
+def _is(r, params):
+    tensor, users, days = r['hourly_bins']
+    return pd.Series(inter_daily_stability(tensor), index=users)
+
+
+def _iv(r, params):
+    tensor, users, days = r['hourly_bins']
+    return pd.Series(intra_daily_variability(tensor), index=users)
+
+
+def _sorted_hours(r, params):
+    tensor, users, days = r['hourly_bins']
+    return pd.Series(sort_by_hourly_values(tensor), index=users)
+
+
+def _srm(r, params):
+    df = r['events_local']
+    # local (wall) time of the index
+    index = pd.DatetimeIndex(df.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    df = df.assign(**{params['time_col']: index})
+
+    srm = _calculate_srm_across_users(df, user_col=params['user_col'],
+                                      target_col=params['target_col'],
+                                      time_col=params['time_col'],
+                                      **params['srm_args'])
+    return pd.Series(srm['srm'].values, index=srm['user_id'].values,
+                     dtype=float)
+
+
+def _per_user_frames(df, user_col, func):
+    """
+    Applies `func` to the rows of each user and concatenates results.
+    """
+
+    frames = []
+    for k, v in df.groupby(user_col, sort=True):
+        r = func(v)
+        r.insert(0, user_col, k)
+        frames.append(r)
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=[user_col])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _daily_clusters(r, params):
+    return _per_user_frames(
+        r['gps_local'], params['user_col'],
+        lambda v: daily_location_cluster_count(v, **params['cluster_args']))
+
+
+def _hourly_distribution(r, params):
+    if params['hourly_func'] is None:
+        raise ValueError('hourly_func is required for hourly_distribution')
+    return _per_user_frames(
+        r['activity_local'], params['user_col'],
+        lambda v: get_hourly_distribution(v, params['hourly_func']))
+
+
+# stage -> (dependencies, function)
+_STAGES = {
+    'activity_local': (('activity',), _activity_local),
+    'events_local': (('events',), _events_local),
+    'gps_local': (('gps',), _gps_local),
+    'hourly_bins': (('activity_local',), _hourly_bins),
+    'is': (('hourly_bins',), _is),
+    'iv': (('hourly_bins',), _iv),
+    'sorted_hours': (('hourly_bins',), _sorted_hours),
+    'srm': (('events_local',), _srm),
+    'daily_clusters': (('gps_local',), _daily_clusters),
+    'hourly_distribution': (('activity_local',), _hourly_distribution),
+}
+
+FEATURES = ('is', 'iv', 'sorted_hours', 'srm', 'daily_clusters',
+            'hourly_distribution')
+
+
+def plan_features(features):
+    """
+    Finds the stages needed for the features.
+
+    Parameters
+    ----------
+    features : iterable
+        Feature names (see `FEATURES`).
+
+    Returns
+    -------
+    list
+        Stage (and source) names in the order of computation. Every
+        stage appears once, after all of its dependencies.
+    """
+
+    unknown = set(features) - set(FEATURES)
+    if unknown:
+        raise ValueError('Unknown features: {0}'.format(sorted(unknown)))
+
+    order, seen = [], set()
+
+    def visit(name):
+        if name in seen:
+            return
+        seen.add(name)
+        for dep in _STAGES.get(name, ((), None))[0]:
+            visit(dep)
+        order.append(name)
+
+    for f in features:
+        visit(f)
+
+    return order
+
+
+def compute_features(features, activity=None, events=None, gps=None,
+                     value_col='value', target_col='target',
+                     time_col='completion_time', user_col='user_id',
+                     time_zone=None, should_localize='UTC',
+                     hourly_how='sum', hourly_func=None, srm_args=None,
+                     cluster_args=None, n_jobs=None):
+    """
+    Computes several features with shared intermediate stages.
+
+    Parameters
+    ----------
+    features : iterable
+        Any of 'is', 'iv', 'sorted_hours' (see
+        `anvil.circadian.sort_by_hourly_values`), 'srm',
+        'daily_clusters' (see
+        `anvil.location.daily_location_cluster_count`) and
+        'hourly_distribution' (see `anvil.utils.get_hourly_distribution`).
+    activity : DataFrame
+        Activity values with `DateTimeIndex`. Required for 'is', 'iv',
+        'sorted_hours' and 'hourly_distribution'.
+    events : DataFrame
+        Events with target and time columns. Required for 'srm'.
+    gps : DataFrame
+        Locations with `DateTimeIndex`. Required for 'daily_clusters'.
+    value_col : str
+        Column with activity values. Default is 'value'.
+    target_col : str
+        Column with event targets. Default is 'target'.
+    time_col : str
+        Column with event times. Default is 'completion_time'.
+    user_col : str
+        User id column of all inputs. Default is 'user_id'.
+    time_zone : str
+        If given, timestamps are converted to this time zone (see
+        `anvil.utils.convert_time_zone`) once for all features.
+        Otherwise, timestamps must already be in local time.
+        Default is None.
+    should_localize : str
+        See `anvil.utils.convert_time_zone`. Default is 'UTC'.
+    hourly_how : str
+        Aggregation of hourly bins used for 'is', 'iv' and
+        'sorted_hours'. See `anvil.utils.get_hourly_tensor`.
+        Default is 'sum'.
+    hourly_func : function
+        Function for 'hourly_distribution'. Default is None.
+    srm_args : dict
+        Keyword arguments for SRM (see `anvil.circadian.calculate_srm`),
+        and `n_jobs` to compute users in worker processes (see
+        `anvil.parallel.apply_by_user`). Default is None.
+    cluster_args : dict
+        Keyword arguments passed to `daily_location_cluster_count`.
+        Default is None.
+    n_jobs : int
+        Number of threads used for independent stages. They only run
+        concurrently where the GIL is released. If 1, stages run
+        sequentially. Default is None, i.e., chosen by
+        `ThreadPoolExecutor`.
+
+    Returns
+    -------
+    dict
+        Feature name -> result. Results of 'is', 'iv', 'sorted_hours'
+        and 'srm' are Series indexed by user; 'daily_clusters' and
+        'hourly_distribution' are DataFrames with a user column.
+    """
+
+    features = list(features)
+    order = plan_features(features)
+
+    results = {'activity': activity, 'events': events, 'gps': gps}
+    missing = [s for s in SOURCES if s in order and results[s] is None]
+    if missing:
+        raise ValueError('Missing inputs for {0}: {1}'.format(features,
+                                                             missing))
+
+    params = {'value_col': value_col, 'target_col': target_col,
+              'time_col': time_col, 'user_col': user_col,
+              'time_zone': time_zone, 'should_localize': should_localize,
+              'hourly_how': hourly_how, 'hourly_func': hourly_func,
+              'srm_args': srm_args or {}, 'cluster_args': cluster_args or {}}
+
+    pending = [s for s in order if s not in SOURCES]
+
+    if n_jobs == 1:
+        for s in pending:
+            results[s] = _STAGES[s][1](results, params)
+    else:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            running = {}
+            while pending or running:
+                # submit every stage whose dependencies are done
+                for s in list(pending):
+                    deps = _STAGES[s][0]
+                    if all(d in results for d in deps):
+                        pending.remove(s)
+                        running[executor.submit(_STAGES[s][1],
+                                                dict(results), params)] = s
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+
+    return {f: results[f] for f in features}
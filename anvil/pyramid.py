@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.pyramid
+    ~~~~~~~~~~~~~
+
+    Collection of utilities for multi-resolution aggregation
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+"""
+Aggregation pyramid.
+
+Sensor values are summarized once per user at minute, hour, day and
+week resolution. Each level keeps count, sum, sum of squares, minimum
+and maximum, and each level is computed from the level below it. Since
+these statistics are additive (or idempotent), a query for any range
+and resolution can be answered from the coarsest level whose bins align
+with the requested bins, without touching the raw data.
+
+Weeks start on Monday. Timestamps are expected in local time; time
+zone aware timestamps are binned by their local (wall) time.
+"""
+
+
+PYRAMID_LEVELS = (('minute', pd.Timedelta(minutes=1)),
+                  ('hour', pd.Timedelta(hours=1)),
+                  ('day', pd.Timedelta(days=1)),
+                  ('week', pd.Timedelta(days=7)))
+
+# A Monday, so that all levels (including weeks) are aligned to it.
+_ORIGIN = pd.Timestamp('1970-01-05')
+
+_STATS = ['count', 'sum', 'sumsq', 'min', 'max']
+
+
+def _floor(index, period):
+    """
+    Floors timestamps to bins of `period` starting at `_ORIGIN`.
+    """
+
+    return _ORIGIN + ((index - _ORIGIN) // period) * period
+
+
+def _local(times):
+    """
+    Drops time zone, keeping local (wall) time.
+    """
+
+    if times.tz is not None:
+        return times.tz_localize(None)
+    return times
+
+
+def _merge_bins(df, bins):
+    """
+    Merges the statistics of rows with the same bin.
+    """
+
+    g = df.groupby(bins, sort=True)
+    return pd.DataFrame({'count': g['count'].sum(),
+                         'sum': g['sum'].sum(),
+                         'sumsq': g['sumsq'].sum(),
+                         'min': g['min'].min(),
+                         'max': g['max'].max()})
+
+
+def build_aggregation_pyramid(df, value_col, user_col='user_id'):
+    """
+    Builds aggregation pyramid for each user.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time).
+    value_col : str
+        Column with sensor values. Missing values are ignored.
+    user_col : str
+        User id column. Default is 'user_id'.
+
+    Returns
+    -------
+    dict
+        Level name ('minute', 'hour', 'day' or 'week') -> dictionary
+        of user id -> DataFrame. Each DataFrame is indexed by the
+        start of the bins in local time, without time zone (only bins
+        with values are kept), and contains count, sum, sumsq, min
+        and max columns.
+    """
+
+    index = _local(pd.DatetimeIndex(df.index))
+    values = df[value_col].astype('f8')
+    valid = values.notnull().values
+
+    s = pd.DataFrame({'user': df[user_col].values[valid],
+                      'time': index[valid].floor('min'),
+                      'value': values.values[valid]})
+    s['sq'] = s['value'] ** 2
+
+    g = s.groupby(['user', 'time'], sort=True)
+    level = pd.DataFrame({'count': g['value'].count(),
+                          'sum': g['value'].sum(),
+                          'sumsq': g['sq'].sum(),
+                          'min': g['value'].min(),
+                          'max': g['value'].max()})
+
+    pyramid = {}
+    for name, period in PYRAMID_LEVELS:
+        if name != 'minute':
+            times = level.index.get_level_values(1)
+            level = _merge_bins(level, [level.index.get_level_values(0),
+                                        _floor(times, period)])
+
+        pyramid[name] = {k: v.droplevel(0)
+                         for k, v in level.groupby(level=0, sort=False)}
+
+    return pyramid
+
+
+def _pyramid_level(start, end, freq):
+    """
+    Finds the coarsest level that can answer a query.
+    """
+
+    for name, period in reversed(PYRAMID_LEVELS):
+        if freq % period != pd.Timedelta(0):
+            continue
+        if (start - _ORIGIN) % period != pd.Timedelta(0):
+            continue
+        if (end - _ORIGIN) % period != pd.Timedelta(0):
+            continue
+        return name, period
+
+    raise ValueError('Query is not aligned to any level: start and end '
+                     'must be aligned to (at least) minutes and freq must '
+                     'be a multiple of a minute')
+
+
+def query_pyramid(pyramid, user_id, start, end, freq='1h'):
+    """
+    Queries summary statistics for a time range.
+
+    Parameters
+    ----------
+    pyramid : dict
+        See `build_aggregation_pyramid`.
+    user_id : object
+    start : DateTime
+        Start of the range (inclusive).
+    end : DateTime
+        End of the range (exclusive).
+    freq : str or Timedelta
+        Resolution of the result, e.g., '15min', '1h', '1D' or '7D'.
+        Bins start at `start`. Default is '1h'.
+
+    Returns
+    -------
+    DataFrame
+        Indexed by the start of the bins (only bins with values are
+        kept), it contains count, sum, mean, std (with one degree of
+        freedom, as in pandas), min and max columns.
+    """
+
+    start, end = _local(pd.DatetimeIndex([start, end]))
+    freq = pd.Timedelta(freq)
+    if freq <= pd.Timedelta(0):
+        raise ValueError('freq must be positive')
+
+    name, period = _pyramid_level(start, end, freq)
+
+    df = pyramid[name].get(user_id)
+    if df is None:
+        df = pd.DataFrame(columns=_STATS, dtype='f8',
+                          index=pd.DatetimeIndex([]))
+
+    i, j = df.index.searchsorted([start, end])
+    r = df.iloc[i:j]
+
+    if freq != period:
+        r = _merge_bins(r, start + ((r.index - start) // freq) * freq)
+
+    count = r['count']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = r['sum'] / count
+        var = (r['sumsq'] - r['sum'] * mean) / (count - 1)
+
+    return pd.DataFrame({'count': count,
+                         'sum': r['sum'],
+                         'mean': mean,
+                         'std': np.sqrt(var.clip(lower=0)),
+                         'min': r['min'],
+                         'max': r['max']})
+
+
+def query_pyramid_hourly_values(pyramid, user_id, start_date, end_date,
+                                how='sum'):
+    """
+    Queries hourly values for a date range.
+
+    The result can be used with `anvil.circadian.inter_daily_stability`
+    and `anvil.circadian.intra_daily_variability`.
+
+    Parameters
+    ----------
+    pyramid : dict
+        See `build_aggregation_pyramid`.
+    user_id : object
+    start_date : date
+        First date (inclusive).
+    end_date : date
+        Last date (inclusive).
+    how : str
+        Either 'sum' or 'mean' of the values in each hour.
+        Default is 'sum'.
+
+    Returns
+    -------
+    DataFrame
+        It contains date, hour and value columns sorted by date
+        and hour.
+    """
+
+    if how not in ('sum', 'mean'):
+        raise ValueError('Unknown aggregation: {0}. Must be either '
+                         'sum or mean'.format(how))
+
+    start = pd.Timestamp(start_date).normalize()
+    end = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    r = query_pyramid(pyramid, user_id, start, end, freq='1h')
+
+    return pd.DataFrame({'date': r.index.date,
+                         'hour': r.index.hour,
+                         'value': r[how].values})
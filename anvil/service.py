@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.service
+    ~~~~~~~~~~~~~
+
+    Collection of utilities for serving features in real time
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import datetime as dt
+import functools
+import json
+import math
+
+import numpy as np
+import pandas as pd
+
+from .circadian import calculate_srm, inter_daily_stability,\
+    intra_daily_variability
+from .location import do_location_clustering
+
+
+"""
+Real-time feature service.
+
+Clients send JSON objects (one per line) over TCP and receive one
+JSON object per line in reply. Supported messages are:
+
+    {"type": "events", "user_id": u,
+     "events": [{"time": "2016-05-18T08:45:00", "target": "wake"}, ...]}
+
+    {"type": "activity", "user_id": u,
+     "values": [{"time": "2016-05-18T08:45:00", "value": 10}, ...]}
+
+    {"type": "gps", "user_id": u,
+     "points": [{"time": "2016-05-18T08:45:00",
+                 "latitude": 42.44, "longitude": -76.50}, ...]}
+
+    {"type": "query", "user_id": u,
+     "features": ["srm", "is", "iv", "clusters"]}
+
+All times are local times. Per-user state only covers the last
+`window_days` days for SRM and IS/IV, and the current day for location
+clusters. Feature computation runs in a worker pool, so the event loop
+is never blocked.
+"""
+
+
+FEATURES = ('srm', 'is', 'iv', 'clusters')
+
+
+def create_feature_state(window_days=7, min_samples=3, **cluster_args):
+    """
+    Creates an empty feature state.
+
+    Parameters
+    ----------
+    window_days : int
+        Number of days kept for SRM and IS/IV. Default is 7.
+    min_samples : int
+        See `anvil.circadian.calculate_srm`. Default is 3.
+    **cluster_args
+        Keyword arguments passed to `do_location_clustering`.
+
+    Returns
+    -------
+    dict
+        State to be used with `update_feature_state` and
+        `query_features`.
+    """
+
+    return {'window_days': window_days,
+            'min_samples': min_samples,
+            'cluster_args': cluster_args,
+            'users': {}}
+
+
+def _empty_user_state():
+    """
+    Creates the state of a user without any data.
+    """
+
+    return {'events': deque(),
+            'hourly': {},
+            'gps_date': None,
+            'gps': [],
+            'gps_version': 0,
+            'clusters': None}
+
+
+def _user_state(state, user_id):
+    """
+    Gets (or creates) the state of a given user.
+    """
+
+    if user_id not in state['users']:
+        state['users'][user_id] = _empty_user_state()
+    return state['users'][user_id]
+
+
+def _parse_time(value):
+    """
+    Parses a local timestamp.
+
+    Time zone aware timestamps are converted to local (wall) time
+    without time zone, i.e., the offset is dropped.
+    """
+
+    t = pd.Timestamp(value)
+    if t is pd.NaT:
+        raise ValueError('Invalid time: {0!r}'.format(value))
+    if t.tz is not None:
+        t = t.tz_localize(None)
+    return t
+
+
+def _parse_number(value):
+    """
+    Parses a finite number.
+    """
+
+    v = float(value)
+    if not math.isfinite(v):
+        raise ValueError('Invalid value: {0!r}'.format(value))
+    return v
+
+
+def update_feature_state(state, message):
+    """
+    Updates the state with a batch of events, activity or GPS points.
+
+    All records of the batch are parsed before the state is changed,
+    so an invalid record rejects the whole batch (with `ValueError`,
+    `KeyError` or `TypeError`) and leaves the state unchanged.
+
+    Parameters
+    ----------
+    state : dict
+        See `create_feature_state`.
+    message : dict
+        Message with 'events', 'activity' or 'gps' type. Times with
+        an offset are taken as local times (the offset is dropped).
+
+    Returns
+    -------
+    int
+        Number of accepted records.
+    """
+
+    kind = message['type']
+    user_id = message['user_id']
+
+    if kind == 'events':
+        l = [(_parse_time(z['time']), z['target'])
+             for z in message['events']]
+    elif kind == 'activity':
+        l = [(_parse_time(z['time']), _parse_number(z['value']))
+             for z in message['values']]
+    elif kind == 'gps':
+        l = [(_parse_time(z['time']).date(), _parse_number(z['latitude']),
+              _parse_number(z['longitude'])) for z in message['points']]
+    else:
+        raise ValueError('Unknown message type: {0}'.format(kind))
+
+    user = _user_state(state, user_id)
+    window = dt.timedelta(days=state['window_days'])
+
+    if kind == 'events':
+        events = user['events']
+        events.extend(l)
+        if len(l) > 0:
+            latest = max(z[0] for z in events)
+            user['events'] = deque(z for z in events
+                                   if z[0] > latest - window)
+        return len(l)
+
+    if kind == 'activity':
+        hourly = user['hourly']
+        for t, v in l:
+            k = (t.date(), t.hour)
+            hourly[k] = hourly.get(k, 0) + v
+        if len(hourly) > 0:
+            first = max(k[0] for k in hourly) - window + dt.timedelta(days=1)
+            for k in [k for k in hourly if k[0] < first]:
+                del hourly[k]
+        return len(l)
+
+    count = 0
+    for d, lat, lon in l:
+        if user['gps_date'] is None or d > user['gps_date']:
+            user['gps_date'] = d
+            user['gps'] = []
+        if d == user['gps_date']:
+            user['gps'].append((lat, lon))
+            count += 1
+    # cluster count should be recomputed
+    user['gps_version'] += 1
+    user['clusters'] = None
+    return count
+
+
+def _compute_srm(events, min_samples):
+    """
+    Computes SRM from (timestamp, target) tuples.
+    """
+
+    df = pd.DataFrame(list(events), columns=['completion_time', 'target'])
+    try:
+        return calculate_srm(df, 'target', min_samples=min_samples)
+    except ZeroDivisionError:
+        # no target has enough samples
+        return None
+
+
+def _compute_rhythm(hourly):
+    """
+    Computes IS and IV from {(date, hour): value} dictionary.
+    """
+
+    df = pd.DataFrame([(k[0], k[1], v) for k, v in sorted(hourly.items())],
+                      columns=['date', 'hour', 'value'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (inter_daily_stability(df, 'value'),
+                intra_daily_variability(df, 'value'))
+
+
+def _compute_clusters(points, cluster_args):
+    """
+    Counts location clusters from (latitude, longitude) tuples.
+    """
+
+    df = pd.DataFrame(points, columns=['latitude', 'longitude'])
+    clusters = do_location_clustering(df, **cluster_args).labels_
+    # -1 indicates noise, so we do not want to count that
+    return len(np.unique(clusters)) - (-1 in clusters)
+
+
+def _to_json_value(v):
+    """
+    Converts NaN and NumPy values to JSON compatible values.
+    """
+
+    if v is None:
+        return None
+    v = v.item() if hasattr(v, 'item') else v
+    if isinstance(v, float) and (math.isnan(v) or math.isinf(v)):
+        return None
+    return v
+
+
+async def query_features(state, user_id, features=FEATURES,
+                         executor=None):
+    """
+    Computes features for a given user.
+
+    The computation runs in `executor`, so it does not block the
+    event loop. Location cluster count is cached until new GPS
+    points arrive.
+
+    Parameters
+    ----------
+    state : dict
+        See `create_feature_state`.
+    user_id : object
+    features : iterable
+        Any of 'srm', 'is', 'iv' and 'clusters'. Default is all.
+    executor : concurrent.futures.Executor
+        Worker pool. If `None`, the default executor of the loop
+        is used.
+
+    Returns
+    -------
+    dict
+        Feature name -> value. Missing values are `None`. Unknown
+        users get the values of a user without any data (and no
+        state is created for them).
+    """
+
+    unknown = set(features) - set(FEATURES)
+    if unknown:
+        raise ValueError('Unknown features: {0}'.format(sorted(unknown)))
+
+    loop = asyncio.get_running_loop()
+    user = state['users'].get(user_id)
+    if user is None:
+        user = _empty_user_state()
+    r = {}
+
+    if 'srm' in features:
+        r['srm'] = await loop.run_in_executor(
+            executor, _compute_srm, list(user['events']),
+            state['min_samples'])
+
+    if 'is' in features or 'iv' in features:
+        if len(user['hourly']) > 0:
+            is_, iv = await loop.run_in_executor(
+                executor, _compute_rhythm, dict(user['hourly']))
+        else:
+            is_, iv = None, None
+        if 'is' in features:
+            r['is'] = is_
+        if 'iv' in features:
+            r['iv'] = iv
+
+    if 'clusters' in features:
+        if user['clusters'] is None and len(user['gps']) > 0:
+            version = user['gps_version']
+            count = await loop.run_in_executor(
+                executor, functools.partial(_compute_clusters,
+                                            list(user['gps']),
+                                            state['cluster_args']))
+            # only cache if no point has arrived in the meantime
+            if user['gps_version'] == version:
+                user['clusters'] = count
+        else:
+            count = user['clusters']
+        r['clusters'] = count if len(user['gps']) > 0 else 0
+
+    return {k: _to_json_value(v) for k, v in r.items()}
+
+
+async def _handle_connection(reader, writer, state, executor):
+    """
+    Handles messages of a client connection.
+    """
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                message = json.loads(line.decode())
+                if message['type'] == 'query':
+                    reply = await query_features(
+                        state, message['user_id'],
+                        message.get('features', FEATURES), executor)
+                else:
+                    reply = {'accepted': update_feature_state(state,
+                                                              message)}
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+
+            writer.write((json.dumps(reply) + '\n').encode())
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve_features(host='127.0.0.1', port=0, executor=None,
+                         **state_args):
+    """
+    Starts the feature service.
+
+    For example:
+
+        server = await serve_features(port=8765)
+        async with server:
+            await server.serve_forever()
+
+    Parameters
+    ----------
+    host : str
+        Default is '127.0.0.1'.
+    port : int
+        Default is 0, i.e., a free port is chosen. The port can be
+        found from `server.sockets[0].getsockname()`.
+    executor : concurrent.futures.Executor
+        Worker pool for feature computation. If `None`, a
+        `ProcessPoolExecutor` is created, which is shut down when
+        the server is closed.
+    **state_args
+        See `create_feature_state`.
+
+    Returns
+    -------
+    asyncio.Server
+        The server. Its feature state is available as `server.state`.
+    """
+
+    state = create_feature_state(**state_args)
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ProcessPoolExecutor()
+
+    server = await asyncio.start_server(
+        functools.partial(_handle_connection, state=state,
+                          executor=executor), host, port)
+    server.state = state
+
+    if owns_executor:
+        close = server.close
+
+        def close_server():
+            close()
+            executor.shutdown(wait=False)
+        server.close = close_server
+
+    return server
+
+
+async def send_messages(host, port, messages):
+    """
+    Sends messages to the feature service.
+
+    Parameters
+    ----------
+    host : str
+    port : int
+    messages : iterable
+        Messages (dictionaries) to send.
+
+    Returns
+    -------
+    list
+        Replies (dictionaries) in the same order as messages.
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        l = []
+        for m in messages:
+            writer.write((json.dumps(m, default=str) + '\n').encode())
+            await writer.drain()
+            l.append(json.loads((await reader.readline()).decode()))
+        return l
+    finally:
+        writer.close()
+        await writer.wait_closed()
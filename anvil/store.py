@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.store
+    ~~~~~~~~~~~
+
+    Collection of utilities for incrementally maintaining features
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+import datetime as dt
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from .circadian import inter_daily_stability, intra_daily_variability,\
+    _calculate_srm_from_decimals, _convert_timestamp_to_decimal
+from .location import daily_location_cluster_count
+
+
+"""
+Feature store.
+
+Only sufficient statistics of each user-day are persisted (in a SQLite
+database): hourly sums and counts for IS/IV, decimal event times for SRM
+and daily location cluster counts. Appending a new day only touches the
+rows of that day and queries only read the requested date range.
+"""
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hourly (
+    user_id, date TEXT, hour INTEGER, total REAL, count INTEGER,
+    PRIMARY KEY (user_id, date, hour));
+CREATE TABLE IF NOT EXISTS srm_events (
+    user_id, date TEXT, target, decimal REAL);
+CREATE INDEX IF NOT EXISTS srm_events_user_date
+    ON srm_events (user_id, date);
+CREATE TABLE IF NOT EXISTS location_clusters (
+    user_id, date TEXT, cluster INTEGER,
+    PRIMARY KEY (user_id, date));
+"""
+
+
+def _to_python(values):
+    """
+    Converts array values to Python objects for SQLite.
+    """
+
+    return [_to_python_value(v) for v in values]
+
+
+def _to_python_value(v):
+    """
+    Converts NumPy scalar to Python object for SQLite.
+    """
+
+    return v.item() if hasattr(v, 'item') else v
+
+
+def _to_date(z):
+    """
+    Converts a date-like value to `datetime.date`.
+    """
+
+    return pd.Timestamp(z).date()
+
+
+def open_feature_store(path):
+    """
+    Opens (or creates) a feature store.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database. Use ':memory:' for a
+        temporary store.
+
+    Returns
+    -------
+    sqlite3.Connection
+        Connection to be used with other functions of this module.
+    """
+
+    conn = sqlite3.connect(path)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def append_hourly_values(conn, df, value_col, user_col='user_id',
+                         accumulate=False):
+    """
+    Appends hourly sufficient statistics.
+
+    Values are summed for each user, date and hour. By default, each
+    day must be appended with all of its rows, since the stored hours
+    of the user-days in `df` are replaced (so appending a day again,
+    e.g., retrying a batch, does not count its values twice).
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time).
+    value_col : str
+        Column with activity values.
+    user_col : str
+        User id column. Default is 'user_id'.
+    accumulate : bool
+        If True, sums and counts are added to the stored values
+        instead, so the rows of a given day can be appended in
+        several (disjoint) batches. Appending the same rows again
+        then counts them twice. Default is False.
+    """
+
+    index = pd.DatetimeIndex(df.index)
+    g = df[value_col].groupby([df[user_col].values,
+                               index.date, index.hour]).agg(['sum', 'count'])
+
+    users = _to_python(g.index.get_level_values(0))
+    dates = [d.isoformat() for d in g.index.get_level_values(1)]
+    rows = zip(users, dates,
+               _to_python(g.index.get_level_values(2)),
+               _to_python(g['sum'].values),
+               _to_python(g['count'].values))
+
+    with conn:
+        if accumulate:
+            conn.executemany(
+                'INSERT INTO hourly VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (user_id, date, hour) DO UPDATE SET '
+                'total = total + excluded.total, '
+                'count = count + excluded.count', rows)
+        else:
+            conn.executemany('DELETE FROM hourly '
+                             'WHERE user_id = ? AND date = ?',
+                             set(zip(users, dates)))
+            conn.executemany('INSERT INTO hourly VALUES (?, ?, ?, ?, ?)',
+                             rows)
+
+
+def append_srm_events(conn, df, target_col,
+                      time_col='completion_time',
+                      user_col='user_id'):
+    """
+    Appends SRM events.
+
+    Timestamps are stored as decimal values (see
+    `anvil.circadian._convert_timestamp_to_decimal`). Each day must be
+    appended with all of its events, since the stored events of the
+    days in `df` are replaced (so appending a day again does not
+    duplicate its events).
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    df : DataFrame
+    target_col : str
+        Column with target names.
+    time_col : str
+        Column containing timestamps (in local time).
+        Default is 'completion_time'.
+    user_col : str
+        User id column. Default is 'user_id'.
+    """
+
+    times = pd.to_datetime(df[time_col])
+    users = _to_python(df[user_col].values)
+    dates = [d.isoformat() for d in times.map(lambda z: z.date())]
+    rows = zip(users, dates, _to_python(df[target_col].values),
+               _to_python(_convert_timestamp_to_decimal(times).values))
+
+    with conn:
+        conn.executemany('DELETE FROM srm_events '
+                         'WHERE user_id = ? AND date = ?',
+                         set(zip(users, dates)))
+        conn.executemany('INSERT INTO srm_events VALUES (?, ?, ?, ?)', rows)
+
+
+def append_location_clusters(conn, df, user_col='user_id', **kwargs):
+    """
+    Computes and stores daily location cluster counts.
+
+    Each day must be appended with all of its rows, since the
+    count of an existing day is replaced.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time).
+    user_col : str
+        User id column. Default is 'user_id'.
+    **kwargs
+        Keyword arguments passed to `daily_location_cluster_count`.
+    """
+
+    rows = []
+    for k, v in df.groupby(user_col):
+        r = daily_location_cluster_count(v, **kwargs)
+        rows.extend(zip([_to_python_value(k)] * len(r),
+                        [d.isoformat() for d in r['date']],
+                        _to_python(r['cluster'].values)))
+
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO location_clusters '
+                         'VALUES (?, ?, ?)', rows)
+
+
+def query_hourly_values(conn, user_id, start_date, end_date,
+                        how='sum'):
+    """
+    Queries hourly values for a date range.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    user_id : object
+    start_date : date
+        First date (inclusive).
+    end_date : date
+        Last date (inclusive).
+    how : str
+        Either 'sum' or 'mean' of the values in each hour.
+        Default is 'sum'.
+
+    Returns
+    -------
+    DataFrame
+        It contains date, hour and value columns sorted by date
+        and hour.
+    """
+
+    if how not in ('sum', 'mean'):
+        raise ValueError('Unknown aggregation: {0}. Must be either '
+                         'sum or mean'.format(how))
+
+    cur = conn.execute(
+        'SELECT date, hour, total, count FROM hourly '
+        'WHERE user_id = ? AND date BETWEEN ? AND ? '
+        'ORDER BY date, hour',
+        (_to_python_value(user_id), _to_date(start_date).isoformat(),
+         _to_date(end_date).isoformat()))
+
+    df = pd.DataFrame(cur.fetchall(),
+                      columns=['date', 'hour', 'total', 'count'])
+    df['date'] = df['date'].map(dt.date.fromisoformat)
+    if how == 'sum':
+        df['value'] = df['total']
+    else:
+        df['value'] = df['total'] / df['count']
+
+    return df[['date', 'hour', 'value']]
+
+
+def query_rhythm(conn, user_id, start_date, end_date, how='sum'):
+    """
+    Computes IS and IV for a date range.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    user_id : object
+    start_date : date
+        First date (inclusive).
+    end_date : date
+        Last date (inclusive).
+    how : str
+        See `query_hourly_values`.
+
+    Returns
+    -------
+    dict
+        Dictionary with 'is' and 'iv' keys.
+    """
+
+    df = query_hourly_values(conn, user_id, start_date, end_date, how=how)
+    return {'is': inter_daily_stability(df, 'value'),
+            'iv': intra_daily_variability(df, 'value')}
+
+
+def query_srm(conn, user_id, start_date, end_date, min_samples=3):
+    """
+    Computes SRM for a date range.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    user_id : object
+    start_date : date
+        First date (inclusive).
+    end_date : date
+        Last date (inclusive).
+    min_samples : int
+        See `anvil.circadian.calculate_srm`.
+
+    Returns
+    -------
+    float
+        SRM score. It is NaN if no target has enough events (e.g.,
+        for a range without events).
+    """
+
+    cur = conn.execute(
+        'SELECT target, decimal FROM srm_events '
+        'WHERE user_id = ? AND date BETWEEN ? AND ?',
+        (_to_python_value(user_id), _to_date(start_date).isoformat(),
+         _to_date(end_date).isoformat()))
+
+    df = pd.DataFrame(cur.fetchall(), columns=['target', 'decimal'])
+    groups = (v['decimal'] for k, v in df.groupby('target'))
+
+    try:
+        return _calculate_srm_from_decimals(groups, min_samples=min_samples)
+    except ZeroDivisionError:
+        return np.nan
+
+
+def rolling_srm(conn, user_id, start_date, how_many_days, **srm_args):
+    """
+    Calculates rolling (weekly) SRM from the stored events.
+
+    It follows `anvil.circadian.rolling_srm_across_users`, but only
+    reads the events of each week.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    user_id : object
+    start_date : date
+    how_many_days : int
+        Number of start days, i.e., SRM is calculated for the week
+        starting at each day d where
+        start_date <= d < start_date + how_many_days.
+    **srm_args
+        See `query_srm`.
+
+    Returns
+    -------
+    DataFrame
+        A DataFrame with date and srm columns.
+    """
+
+    start_date = _to_date(start_date)
+
+    l = []
+    for i in range(how_many_days):
+        s = start_date + dt.timedelta(days=i)
+        e = s + dt.timedelta(days=6)
+        l.append({'date': s,
+                  'srm': query_srm(conn, user_id, s, e, **srm_args)})
+
+    return pd.DataFrame(l)
+
+
+def query_location_clusters(conn, user_id, start_date, end_date):
+    """
+    Queries stored daily location cluster counts.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+    user_id : object
+    start_date : date
+        First date (inclusive).
+    end_date : date
+        Last date (inclusive).
+
+    Returns
+    -------
+    DataFrame
+        It contains date and cluster columns.
+    """
+
+    cur = conn.execute(
+        'SELECT date, cluster FROM location_clusters '
+        'WHERE user_id = ? AND date BETWEEN ? AND ? ORDER BY date',
+        (_to_python_value(user_id), _to_date(start_date).isoformat(),
+         _to_date(end_date).isoformat()))
+
+    df = pd.DataFrame(cur.fetchall(), columns=['date', 'cluster'])
+    df['date'] = df['date'].map(dt.date.fromisoformat)
+    return df
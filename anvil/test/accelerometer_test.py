@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.accelerometer_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing accelerometer module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import accelerometer, circadian
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class AccelerometerTest(unittest.TestCase):
+
+    def setUp(self):
+        # two days at 10 Hz, moving only in the first half of each day
+        rs = np.random.RandomState(0)
+        self.fs = 10
+        t = np.arange(self.fs * 3600 * 48) / self.fs
+        moving = (t % 86400 < 43200) * 0.5
+        self.values = np.c_[moving * np.sin(2 * np.pi * t),
+                            moving * np.cos(2 * np.pi * t),
+                            1 + 0.01 * rs.randn(len(t))]
+
+    def test_enmo(self):
+        self.assertTrue(np.allclose(
+            accelerometer.enmo([[0, 0, 1], [0, 0, 0.5], [0, 3, 4]]),
+            [0, 0, 4]))
+
+    def test_epoch_activity(self):
+        for method in accelerometer.ACTIVITY_METHODS:
+            r = accelerometer.epoch_activity(self.values, self.fs,
+                                             '2016-01-01', method=method,
+                                             chunk_size=10**6)
+            expected = accelerometer.epoch_activity(
+                self.values, self.fs, '2016-01-01', method=method,
+                chunk_size=12345)
+            self.assertEqual(len(r), 48 * 60)
+            self.assertEqual(r.index[1], pd.Timestamp('2016-01-01 00:01'))
+            # chunking does not change the result
+            self.assertTrue(np.allclose(r[method], expected[method]))
+
+            hourly = r[method].groupby(r.index.hour).mean()
+            self.assertTrue(hourly[:12].min() > 10 * hourly[12:].max())
+
+        r = accelerometer.epoch_activity(self.values[:600], self.fs,
+                                         '2016-01-01')
+        self.assertAlmostEqual(
+            r.enmo.iloc[0], accelerometer.enmo(self.values[:600]).mean())
+
+        self.assertRaises(ValueError, accelerometer.epoch_activity,
+                          self.values, self.fs, '2016-01-01', epoch='0.05s')
+        self.assertRaises(ValueError, accelerometer.epoch_activity,
+                          self.values, self.fs, '2016-01-01', method='x')
+
+    def test_streaming_state(self):
+        state = {}
+        l = []
+        for i in range(0, len(self.values), 100000):
+            l.extend(accelerometer.iter_epoch_activity(
+                [self.values[i:i + 100000]], self.fs, '2016-01-01',
+                method='counts', state=state))
+        expected = accelerometer.epoch_activity(self.values, self.fs,
+                                                '2016-01-01',
+                                                method='counts')
+        self.assertTrue(np.allclose(pd.concat(l).counts, expected.counts))
+
+    def test_hourly_activity(self):
+        r = accelerometer.epoch_activity(self.values, self.fs, '2016-01-01')
+        hourly = accelerometer.hourly_activity(r, 'enmo')
+        self.assertEqual(len(hourly), 48)
+        # same activity pattern in both days
+        self.assertAlmostEqual(
+            circadian.inter_daily_stability(hourly, 'value'), 1, places=3)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.approximate_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing approximate module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import approximate, circadian, location, utils
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class ApproximateTest(unittest.TestCase):
+
+    def test_stratified_sample(self):
+        df = pd.DataFrame({'k': [0] * 10 + [1] * 3, 'v': np.arange(13)})
+        r = approximate.stratified_sample(df, 'k', 4, random_state=0)
+
+        self.assertEqual(r['k'].value_counts().to_dict(), {0: 4, 1: 3})
+        # sampled rows keep the original order
+        self.assertTrue(r['v'].is_monotonic_increasing)
+        self.assertTrue(r.equals(
+            approximate.stratified_sample(df, 'k', 4, random_state=0)))
+        self.assertRaises(ValueError, approximate.stratified_sample,
+                          df, 'k', 0)
+
+    def test_approximate_inter_daily_stability(self):
+        rs = np.random.RandomState(0)
+        rng = pd.date_range('2016-01-01', periods=24 * 30, freq='h')
+        df = pd.DataFrame({'value': np.cos(2 * np.pi * rng.hour / 24) +
+                           rs.randn(len(rng)) * 0.1,
+                           'hour': rng.hour})
+
+        exact = circadian.inter_daily_stability(df, 'value')
+        # all rows are used if sample size is large enough
+        r, se = approximate.approximate_inter_daily_stability(
+            df, 'value', sample_size=30, random_state=0)
+        self.assertAlmostEqual(r, exact)
+        self.assertGreater(se, 0)
+
+        r, se = approximate.approximate_inter_daily_stability(
+            df, 'value', sample_size=10, random_state=0)
+        self.assertLess(abs(r - exact), 0.05)
+
+    def test_approximate_hourly_distribution(self):
+        rng = pd.date_range('2016-01-01', periods=2 * 3600, freq='s')
+        df = pd.DataFrame({'steps': np.arange(len(rng)) % 3600},
+                          index=rng)
+        df.loc[df.index[:10], 'steps'] = np.nan
+
+        r = approximate.approximate_hourly_distribution(
+            df, 'steps', sample_size=600, random_state=0)
+        self.assertEqual(list(r.columns),
+                         ['hour', 'date', 'steps', 'steps_se'])
+        self.assertEqual(list(r['hour']), [0, 1])
+        self.assertTrue((abs(r['steps'] - 1799.5) <
+                         3 * r['steps_se']).all())
+
+        # all rows are used if sample size is large enough
+        exact = utils.get_hourly_distribution(
+            df, lambda x: {'steps': x.steps.mean()})
+        r = approximate.approximate_hourly_distribution(
+            df, ['steps'], sample_size=3600, random_state=0)
+        self.assertTrue(np.allclose(r['steps'], exact['steps']))
+        self.assertTrue((r['steps_se'] == 0).all())
+
+    def test_approximate_daily_location_cluster_count(self):
+        rs = np.random.RandomState(0)
+        rng = pd.date_range('2016-01-01', periods=100, freq='30min')
+        df = pd.DataFrame({'latitude': np.r_[np.full(50, 42.44),
+                                             np.full(50, 42.50)],
+                           'longitude': np.full(100, -76.5)},
+                          index=rng)
+        df += rs.randn(100, 2) * 1e-4
+
+        exact = location.daily_location_cluster_count(df)
+        # 5 samples of 50 points cost more than 100 points
+        r = approximate.approximate_daily_location_cluster_count(
+            df, sample_size=50, random_state=0)
+        self.assertEqual(list(r['cluster']), list(exact['cluster']))
+        self.assertTrue((r['cluster_se'] == 0).all())
+
+        r = approximate.approximate_daily_location_cluster_count(
+            df, sample_size=20, random_state=0)
+        self.assertEqual(list(r['cluster']), list(exact['cluster']))
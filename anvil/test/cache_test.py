@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.cache_test
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing cache module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import cache
+import numpy as np
+import pandas as pd
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+
+def _total(df, col='x', factor=1):
+    return df[col].sum() * factor
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_disk_cache(self):
+        df = pd.DataFrame({'x': np.arange(10)})
+        f = cache.disk_cache(self.cache_dir)(_total)
+
+        self.assertEqual(f(df), 45)
+        self.assertEqual(f(df, 'x'), 45)
+        self.assertEqual(f(df, factor=1), 45)
+        info = f.cache_info()
+        self.assertEqual((info['hits'], info['misses']), (2, 1))
+        self.assertEqual(info['entries'], 1)
+
+        # a new slice or new parameters should miss
+        self.assertEqual(f(df.iloc[:5]), 10)
+        self.assertEqual(f(df, factor=2), 90)
+        self.assertEqual(f.cache_info()['misses'], 3)
+
+        self.assertTrue(f.invalidate(df))
+        self.assertFalse(f.invalidate(df))
+        f(df)
+        self.assertEqual(f.cache_info()['misses'], 4)
+
+        f.cache_clear()
+        info = f.cache_info()
+        self.assertEqual((info['hits'], info['entries']), (0, 0))
+
+    def test_eviction(self):
+        df = pd.DataFrame({'x': np.arange(10)})
+        f = cache.disk_cache(self.cache_dir, max_size=1)(_total)
+
+        f(df)
+        f(df, factor=2)
+        # only the last entry fits
+        self.assertEqual(f.cache_info()['entries'], 1)
+        f(df, factor=2)
+        self.assertEqual(f.cache_info()['hits'], 1)
+
+        # the directory is only scanned when the cache is full
+        with mock.patch.object(cache, '_cache_entries',
+                               wraps=cache._cache_entries) as scan:
+            g = cache.disk_cache(self.cache_dir, max_size=2**20)(_total)
+            for i in range(5):
+                g(df, factor=i)
+        self.assertEqual(scan.call_count, 1)
+        self.assertEqual(g.cache_info()['entries'], 5)
+
+    def test_time_zone_key(self):
+        index = pd.date_range('2016-01-01', periods=24, freq='h', tz='UTC')
+        df = pd.DataFrame({'x': np.arange(24)}, index=index)
+        local = df.tz_convert('America/New_York')
+        f = cache.disk_cache(self.cache_dir)(
+            lambda df: df.index.hour[0])
+
+        # same instants, but different local hours
+        self.assertEqual(f(df), 0)
+        self.assertEqual(f(local), 19)
+        self.assertEqual(f.cache_info()['misses'], 2)
+
+        renamed = df.rename_axis('time')
+        self.assertEqual(f(renamed), 0)
+        self.assertEqual(f.cache_info()['misses'], 3)
+
+    def test_callable_key(self):
+        df = pd.DataFrame({'x': np.arange(10)})
+        f = cache.disk_cache(self.cache_dir)(
+            lambda df, func: func(df['x']))
+
+        # lambdas of the same scope share the qualified name
+        self.assertEqual(f(df, lambda z: z.mean()), 4.5)
+        self.assertEqual(f(df, lambda z: z.max()), 9)
+
+        def scaled(factor):
+            return lambda z: z.sum() * factor
+
+        self.assertEqual(f(df, scaled(1)), 45)
+        self.assertEqual(f(df, scaled(2)), 90)
+        self.assertEqual(f(df, scaled(2)), 90)
+        info = f.cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 4))
+
+    def test_content_key(self):
+        f = cache.disk_cache(self.cache_dir)(lambda x: int(np.sum(x)))
+
+        # repr of long indexes is truncated in the middle
+        index = pd.Index(np.arange(1000))
+        changed = index.values.copy()
+        changed[500] = -7
+        self.assertEqual(f(index), 499500)
+        self.assertEqual(f(pd.Index(changed)), 498993)
+
+        a = pd.Categorical(['x', 'y'] * 500)
+        b = pd.Categorical(['x', 'y'] * 250 + ['y', 'x'] + ['x', 'y'] * 249)
+        g = cache.disk_cache(self.cache_dir)(
+            lambda x: ''.join(np.asarray(x)[499:503]))
+        self.assertEqual(g(a), 'yxyx')
+        self.assertEqual(g(b), 'yyxx')
+
+        # object arrays are hashed by their elements
+        h = cache.disk_cache(self.cache_dir)(lambda x: len(x))
+        self.assertEqual(h(np.array(['a', 'b'], dtype=object)), 2)
+        self.assertEqual(h(np.array(['a', 'b'], dtype=object)), 2)
+        self.assertEqual(h.cache_info()['hits'], 1)
+
+        # values without a content hash are not cached
+        self.assertEqual(h([object()]), 1)
+        self.assertEqual(h.cache_info()['uncached'], 1)
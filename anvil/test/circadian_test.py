@@ -10,6 +10,10 @@
 """
 
 from anvil import circadian
+from anvil import utils
+import datetime as dt
+import numpy as np
+import pandas as pd
 import unittest
 
 
@@ -25,3 +29,283 @@ class CircadianAnalysisTest(unittest.TestCase):
 
     def test_calculate_srm(self):
         raise NotImplementedError
+
+    def test_rolling_srm_across_users_compact(self):
+        n = 300
+        rs = np.random.RandomState(0)
+        hours = rs.rand(n) * 20 * 24
+        df = pd.DataFrame({'user_id': rs.choice(['u1', 'u2', 'u3'], n),
+                           'target': rs.choice(['wake', 'lunch'], n),
+                           'completion_time': pd.Timestamp('2016-01-01') +
+                           pd.to_timedelta(hours, unit='h')})
+
+        start = dt.datetime(2016, 1, 1)
+        expected = circadian.rolling_srm_across_users(df, start, 5,
+                                                      target_col='target')
+        r = circadian.rolling_srm_across_users(df, start, 5,
+                                               target_col='target',
+                                               compact=True)
+
+        self.assertEqual(r.user_id.dtype.name, 'category')
+        self.assertEqual(r.srm.dtype, np.float32)
+        self.assertEqual(r.date.dtype, np.int32)
+        self.assertEqual(list(r.user_id), list(expected.user_id))
+        self.assertTrue(np.allclose(r.srm, expected.srm))
+        self.assertEqual(list(utils.from_day_number(r.date)),
+                         list(expected.date))
+
+        # only valid user-days are used
+        valid = utils.select_valid_days(
+            utils.completeness_index(df, time_col='completion_time'),
+            min_samples=8)
+        v = circadian.rolling_srm_across_users(df, start, 5,
+                                               target_col='target',
+                                               valid_dates=valid)
+        expected_v = circadian.rolling_srm_across_users(
+            utils.filter_valid_dates(df, valid, time_col='completion_time',
+                                     user_col='user_id'),
+            start, 5, target_col='target')
+        self.assertTrue(np.allclose(v.srm, expected_v.srm))
+        self.assertLess(len(valid), 60)
+
+        # the same result is written batch by batch to the sink
+        l = []
+        self.assertIsNone(circadian.rolling_srm_across_users(
+            df, start, 5, target_col='target', compact=True, sink=l.append))
+        self.assertEqual(len(l), 5)
+        self.assertTrue(np.allclose(pd.concat(l).srm, r.srm))
+
+    def test_batch_cosinor(self):
+        t = np.arange(0, 72, 0.5)
+        values = np.vstack([10 + 3 * np.cos(2 * np.pi * (t - 15) / 24),
+                            5 + np.cos(2 * np.pi * (t - 3) / 24),
+                            np.ones_like(t)])
+        mask = np.ones_like(values, dtype=bool)
+        mask[1, ::3] = False
+        values[0, 5] = np.nan
+        # only two samples
+        mask[2, 2:] = False
+
+        r = circadian.batch_cosinor(values, t, mask=mask,
+                                    user_ids=['a', 'b', 'c'])
+
+        self.assertEqual(list(r.user_id), ['a', 'b', 'c'])
+        self.assertTrue(np.allclose(r.mesor[:2], [10, 5]))
+        self.assertTrue(np.allclose(r.amplitude[:2], [3, 1]))
+        self.assertTrue(np.allclose(r.acrophase[:2], [15, 3]))
+        self.assertEqual(list(r.n), [len(t) - 1, len(t) * 2 // 3, 2])
+        self.assertTrue(np.isnan(r.mesor[2]))
+
+    def test_cosinor_across_users(self):
+        rng = pd.date_range('1/1/2016', periods=48, freq='h')
+        hours = np.arange(48)
+        df = pd.DataFrame({
+            'user_id': ['a'] * 48 + ['b'] * 24,
+            'x': np.r_[np.cos(2 * np.pi * (hours - 14) / 24),
+                       2 + np.cos(2 * np.pi * (hours[:24] - 2) / 24)]},
+            index=rng.append(rng[24:]))
+
+        r = circadian.cosinor_across_users(df, 'x')
+        self.assertEqual(list(r.user_id), ['a', 'b'])
+        self.assertTrue(np.allclose(r.acrophase, [14, 2]))
+        self.assertTrue(np.allclose(r.mesor, [0, 2]))
+        self.assertEqual(list(r.n), [48, 24])
+
+        # duplicates are averaged and rows without user are ignored
+        x = df.x.iloc[54]
+        extra = pd.DataFrame({'user_id': ['b', 'b', None],
+                              'x': [x + 5, x - 5, 100.0]},
+                             index=rng[[30, 30, 40]])
+        r = circadian.cosinor_across_users(pd.concat([df, extra]), 'x')
+        self.assertEqual(list(r.user_id), ['a', 'b'])
+        self.assertTrue(np.allclose(r.acrophase, [14, 2]))
+        self.assertTrue(np.allclose(r.mesor, [0, 2]))
+        self.assertEqual(list(r.n), [48, 24])
+
+        # users whose data starts years apart
+        later = df[df.user_id == 'b'].copy()
+        later.index = later.index + pd.Timedelta(days=3650)
+        r = circadian.cosinor_across_users(
+            pd.concat([df[df.user_id == 'a'], later]), 'x')
+        self.assertTrue(np.allclose(r.acrophase, [14, 2]))
+        self.assertTrue(np.allclose(r.amplitude, [1, 1]))
+        self.assertEqual(list(r.n), [48, 24])
+
+    def test_chi_square_periodogram(self):
+        rs = np.random.RandomState(0)
+        t = np.arange(24 * 10)
+        values = np.vstack([np.cos(2 * np.pi * t / 24),
+                            np.cos(2 * np.pi * t / 22)])
+        values += 0.3 * rs.randn(*values.shape)
+        periods = np.arange(20, 29)
+
+        q = circadian.chi_square_periodogram(values, periods)
+        self.assertEqual(q.shape, (2, len(periods)))
+        self.assertEqual(list(periods[q.argmax(axis=1)]), [24, 22])
+
+        mask = rs.rand(*values.shape) > 0.3
+        q = circadian.chi_square_periodogram(values, periods, mask=mask)
+        self.assertEqual(list(periods[q.argmax(axis=1)]), [24, 22])
+
+    def test_lomb_scargle_periodogram(self):
+        rs = np.random.RandomState(0)
+        times = np.sort(rs.rand(2, 300) * 240, axis=1)
+        values = np.vstack([np.cos(2 * np.pi * times[0] / 24),
+                            np.cos(2 * np.pi * times[1] / 25.5)])
+        values += 0.3 * rs.randn(*values.shape)
+        # padding
+        values[1, -10:] = np.nan
+        periods = np.arange(20, 28.01, 0.25)
+
+        p = circadian.lomb_scargle_periodogram(times, values, periods,
+                                               block_size=1000)
+        self.assertEqual(list(periods[p.argmax(axis=1)]), [24, 25.5])
+
+        # padding of times is the same as padding of values
+        times[1, -10:] = np.nan
+        values[1, -10:] = 0
+        r = circadian.lomb_scargle_periodogram(times, values, periods)
+        self.assertTrue(np.allclose(r, p))
+
+    def test_hourly_tensor_metrics(self):
+        rs = np.random.RandomState(1)
+        rng = pd.date_range('1/1/2016', periods=24 * 5, freq='h')
+        a = pd.DataFrame({'user_id': 'a', 'x': rs.rand(len(rng))}, index=rng)
+        b = pd.DataFrame({'user_id': 'b', 'x': rs.rand(len(rng))},
+                         index=rng + pd.Timedelta(days=1))
+        tensor, users, days = utils.get_hourly_tensor(pd.concat([a, b]), 'x')
+
+        for i, df in enumerate([a, b]):
+            df = df.assign(hour=df.index.hour)
+            self.assertAlmostEqual(
+                circadian.inter_daily_stability(tensor)[i],
+                circadian.inter_daily_stability(df, 'x'), places=5)
+            self.assertAlmostEqual(
+                circadian.intra_daily_variability(tensor)[i],
+                circadian.intra_daily_variability(df, 'x'), places=5)
+
+            expected = circadian.sort_by_hourly_values(df, 'x')
+            r = circadian.sort_by_hourly_values(tensor)[i]
+            self.assertEqual([z[0] for z in r], [z[0] for z in expected])
+            self.assertTrue(np.allclose([z[1] for z in r],
+                                        [z[1] for z in expected]))
+
+        # (users, hours) arrays from the resampler can be used directly
+        values = utils.resample_to_grid(pd.concat([a, b]), 'x')[0]
+        self.assertTrue(np.allclose(circadian.inter_daily_stability(values),
+                                    circadian.inter_daily_stability(tensor)))
+        self.assertTrue(np.allclose(
+            circadian.intra_daily_variability(values),
+            circadian.intra_daily_variability(tensor)))
+
+        # hours must be whole days
+        self.assertRaises(ValueError, circadian.inter_daily_stability,
+                          values[:, :30])
+        self.assertRaises(ValueError, circadian.intra_daily_variability,
+                          values[:, :, None])
+
+    def test_srm_parameter_sweep(self):
+        rs = np.random.RandomState(0)
+        n = 40
+        # quarter hours create ties at the hit range boundaries
+        minutes = (rs.choice([7, 8, 9, 12, 22], n) * 60 +
+                   rs.choice([0, 15, 30, 45], n) +
+                   rs.randint(0, 3, n) * 1440)
+        df = pd.DataFrame({
+            'user_id': rs.choice(['a', 'b', 'c'], n),
+            'target': rs.choice(['wake', 'sleep', 'lunch', 'x'], n),
+            'completion_time': pd.Timestamp('2016-01-01') +
+            pd.to_timedelta(minutes, unit='m')})
+        # rows without user id, target or time are ignored
+        df.loc[[0, 1], 'user_id'] = np.nan
+        df.loc[[2, 3], 'target'] = np.nan
+        df.loc[[4, 5], 'completion_time'] = pd.NaT
+
+        r = circadian.srm_parameter_sweep(df, 'target',
+                                          hit_ranges=[0.25, 45/60],
+                                          outlier_factors=[1, 1.5],
+                                          min_samples_values=[1, 3, 6],
+                                          min_std_values=[0.5, 4])
+        self.assertEqual(len(r), 3 * 2 * 2 * 3 * 2)
+
+        for _, z in r.iterrows():
+            v = df[df.user_id == z.user_id]
+            try:
+                expected = circadian.calculate_srm(
+                    v, 'target', min_samples=z.min_samples,
+                    hit_range=z.hit_range, outlier_factor=z.outlier_factor,
+                    min_std=z.min_std)
+            except ZeroDivisionError:
+                expected = np.nan
+            self.assertTrue(np.isclose(expected, z.srm, equal_nan=True))
+
+    def test_profile_similarity(self):
+        rs = np.random.RandomState(0)
+        n = 60
+        phases = rs.randint(0, 24, n)
+        df = pd.DataFrame({'user_id': np.repeat(np.arange(n), 24 * 3),
+                           'hour': np.tile(np.arange(24), n * 3)})
+        df['value'] = np.cos(2 * np.pi * (df.hour - phases[df.user_id]) /
+                             24) + 0.3 * rs.randn(len(df))
+
+        raw, users = circadian.hourly_profile_matrix(df, 'value',
+                                                     normalize=False)
+        self.assertEqual(list(users), list(range(n)))
+        expected = dict(circadian.sort_by_hourly_values(
+            df[df.user_id == 3], 'value'))
+        self.assertTrue(np.allclose(raw[3], [expected[h] for h in range(24)]))
+
+        # rows without user id are ignored
+        with_nan = df.astype({'user_id': float})
+        with_nan.loc[with_nan.user_id == 0, 'user_id'] = np.nan
+        r, users = circadian.hourly_profile_matrix(with_nan, 'value',
+                                                   normalize=False)
+        self.assertEqual(list(users), list(range(1, n)))
+        self.assertTrue(np.allclose(r, raw[1:]))
+
+        profiles, users = circadian.hourly_profile_matrix(df, 'value')
+        r = circadian.profile_similarity(profiles, block_size=7)
+        self.assertTrue(np.allclose(r, np.corrcoef(raw)))
+
+        # shifted profiles are similar
+        r = circadian.profile_similarity(profiles, metric='shift')
+        self.assertTrue(np.all(r >= circadian.profile_similarity(profiles)))
+        self.assertGreater(r.min(), 0.8)
+
+        indices, similarities = circadian.nearest_profiles(
+            profiles, k=3, block_size=16)
+        self.assertEqual(indices.shape, (n, 3))
+        self.assertTrue(np.all(indices != np.arange(n)[:, None]))
+        self.assertTrue(np.all(np.diff(similarities, axis=1) <= 0))
+        d = np.abs(phases[indices[:, 0]] - phases)
+        self.assertTrue(np.all(np.minimum(d, 24 - d) <= 1))
+
+        self.assertRaises(ValueError, circadian.profile_similarity,
+                          profiles, metric='x')
+
+    def test_sleep_regularity_index(self):
+        rs = np.random.RandomState(0)
+        states = np.zeros((3, 7, 1440))
+        # same sleep every night
+        states[0, :, :420] = 1
+        # random states
+        states[1] = rs.rand(7, 1440) > 0.5
+        # sleep shifts by an hour every day
+        for d in range(7):
+            states[2, d, d * 60:d * 60 + 420] = 1
+
+        r = circadian.sleep_regularity_index(states, block_size=2)
+        self.assertEqual(r[0], 100)
+        self.assertLess(abs(r[1]), 5)
+        # 120 of 1440 minutes (an hour at each end of the sleep)
+        # differ between successive days
+        self.assertAlmostEqual(r[2], -100 + 200 * (1 - 120 / 1440))
+
+        # missing epochs are ignored
+        states[2, 1:, :] = np.nan
+        mask = np.ones(states.shape, dtype=bool)
+        mask[0, 3:] = False
+        r = circadian.sleep_regularity_index(states.reshape(3, -1),
+                                             mask=mask)
+        self.assertEqual(r[0], 100)
+        self.assertTrue(np.isnan(r[2]))
@@ -8,9 +8,14 @@
     :copyright: (c) 2015 by Saeed Abdullah.
 
 """
-from anvil import location
+from anvil import location, utils
+from geopy.distance import EARTH_RADIUS
 import pandas as pd
 import numpy as np
+import os
+import shutil
+from sklearn import cluster
+import tempfile
 import unittest
 
 
@@ -98,3 +103,230 @@ class LocationUtilTest(unittest.TestCase):
 
         self.assertEqual(r.cluster.values[0], 1)
         self.assertEqual(r.cluster.values[1], 0)
+
+    def test_daily_location_cluster_count_sink(self):
+        dates = pd.to_datetime(['2016-05-18'] * 4 + ['2016-05-19'] * 2 +
+                               ['2016-05-20'] * 2)
+        df = self.location_df.set_index(dates)
+        expected = location.daily_location_cluster_count(df, min_samples=2)
+
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'clusters.csv')
+            self.assertIsNone(location.daily_location_cluster_count(
+                df, min_samples=2, sink=utils.csv_sink(path),
+                batch_size=2))
+            r = pd.read_csv(path)
+            self.assertEqual(list(r.columns), ['date', 'cluster'])
+            self.assertEqual(list(r.date), [str(z) for z in expected.date])
+            self.assertEqual(list(r.cluster), list(expected.cluster))
+        finally:
+            shutil.rmtree(d)
+
+    def test_daily_location_cluster_count_sampling(self):
+        rs = np.random.RandomState(0)
+        centers = np.array([[42.40, -76.50], [42.45, -76.50],
+                            [42.40, -76.45], [42.45, -76.45]])
+        points = np.vstack([c + rs.randn(k, 2) * 0.0005
+                            for c, k in zip(centers, [500, 300, 150, 50])] +
+                           [rs.rand(30, 2) * 0.3 + [42.3, -76.6]])
+        points = points[rs.permutation(len(points))]
+        df = pd.DataFrame({'latitude': points[:, 0],
+                           'longitude': points[:, 1]},
+                          index=pd.date_range('2016-01-01',
+                                              periods=len(points),
+                                              freq='60s'))
+        kwargs = {'min_samples': 20, 'metric': location.haversine_metric}
+
+        exact = location.daily_location_cluster_count(df, **kwargs)
+        self.assertEqual(list(exact.cluster), [4])
+        # without scaling min_samples, the smallest place would have
+        # about 5 of the 100 sampled points
+        r = location.daily_location_cluster_count(
+            df, sample_size=100, random_state=0, **kwargs)
+        self.assertEqual(list(r.columns), ['date', 'cluster', 'cluster_se'])
+        self.assertEqual(list(r.cluster), [4])
+
+    def test_tiled_location_clustering(self):
+        rs = np.random.RandomState(0)
+        centers = rs.rand(10, 2) * 0.2 + [42.4, -76.6]
+        points = centers[rs.randint(0, 10, 2000)] + rs.randn(2000, 2) * 0.002
+        points = np.vstack([points, rs.rand(200, 2) * 0.2 + [42.4, -76.6]])
+        df = pd.DataFrame({'latitude': points[:, 0],
+                           'longitude': points[:, 1]})
+
+        expected = cluster.DBSCAN(eps=0.2 / EARTH_RADIUS, min_samples=5,
+                                  metric='haversine').fit(
+            np.radians(points)).labels_
+
+        for n_jobs, tile_size in [(1, None), (1, 0.01), (2, 0.03)]:
+            labels = location.tiled_location_clustering(
+                df, eps=0.2, min_samples=5, n_jobs=n_jobs,
+                tile_size=tile_size)
+            self.assertTrue(np.all(labels == expected))
+
+        labels = location.tiled_location_clustering(self.location_df,
+                                                    n_jobs=1)
+        self.assertTrue(np.all(labels == [0, 0, 0, 0, 0, 0, -1, -1]))
+
+    def test_vectorized_metric(self):
+        rs = np.random.RandomState(0)
+        points = rs.randn(500, 2) * 0.01 + [42.4, -76.5]
+        points = np.vstack([points, points[:5]])
+        df = pd.DataFrame({'latitude': points[:, 0],
+                           'longitude': points[:, 1],
+                           'altitude': rs.rand(len(points)) * 1000})
+
+        expected = cluster.DBSCAN(eps=0.2 / EARTH_RADIUS, min_samples=3,
+                                  metric='haversine').fit(
+            np.radians(points)).labels_
+        labels = location.do_location_clustering(
+            df, eps=0.2, metric=location.haversine_metric,
+            block_size=64).labels_
+        self.assertTrue(np.all(labels == expected))
+
+        calls = []
+
+        @location.vectorized_metric
+        def distance_3d(x, y):
+            calls.append((len(x), len(y)))
+            d = location.haversine_metric(x, y)
+            h = (x[:, 2, None] - y[None, :, 2]) / 1000
+            return np.sqrt(d ** 2 + h ** 2)
+
+        labels = location.do_location_clustering(
+            df, eps=0.2, metric=distance_3d, block_size=100,
+            metric_cols=['longitude', 'latitude', 'altitude']).labels_
+        # tiles are bounded in both axes
+        self.assertEqual(len(calls), 6 * 6)
+        self.assertEqual(max(max(z) for z in calls), 100)
+        self.assertEqual(sum(a * b for a, b in calls), len(df) ** 2)
+        # altitude separates some of the points
+        self.assertGreater(np.sum(labels == -1), np.sum(expected == -1))
+
+        self.assertRaises(ValueError, location.do_location_clustering, df,
+                          metric=location.vectorized_metric(
+                              lambda x, y: np.zeros(len(x))))
+
+    def test_location_visits(self):
+        rng = pd.date_range('2016-05-18 08:00', periods=9, freq='10min')
+        df = pd.DataFrame({'x': range(9)}, index=rng)
+        labels = [0, 0, -1, 0, 1, 1, 0, 2, 2]
+
+        visits = location.get_location_visits(df, labels)
+        self.assertEqual(list(visits.cluster), [0, 1, 0, 2])
+        self.assertEqual(list(visits.n_points), [3, 2, 1, 2])
+        self.assertEqual(visits.start.iloc[1], rng[4])
+        self.assertEqual(visits.end.iloc[0], rng[3])
+        self.assertEqual(visits.duration.iloc[0], pd.Timedelta('30min'))
+
+        visits = location.get_location_visits(df, labels, include_noise=True)
+        self.assertEqual(list(visits.cluster), [0, -1, 0, 1, 0, 2])
+
+        # a gap splits the visit
+        visits = location.get_location_visits(df.iloc[[0, 1, 2, 3]],
+                                              [0, 0, 0, 0],
+                                              max_gap='10min')
+        self.assertEqual(len(visits), 1)
+        df2 = df.iloc[[0, 1, 3, 4]]
+        visits = location.get_location_visits(df2, [0, 0, 0, 0],
+                                              max_gap='10min')
+        self.assertEqual(list(visits.n_points), [2, 2])
+
+        visits = location.get_location_visits(df, labels)
+        dwell = location.location_dwell_time(visits)
+        self.assertEqual(list(dwell.index), [0, 1, 2])
+        self.assertEqual(dwell[0], pd.Timedelta('30min'))
+        self.assertEqual(dwell[1], pd.Timedelta('10min'))
+
+        transitions = location.location_transition_matrix(visits)
+        self.assertEqual(transitions.shape, (3, 3))
+        self.assertEqual(transitions.loc[0, 1], 1)
+        self.assertEqual(transitions.loc[1, 0], 1)
+        self.assertEqual(transitions.loc[0, 2], 1)
+        self.assertEqual(transitions.values.sum(), 3)
+
+    def test_location_clustering_sweep(self):
+        # duplicate points have zero distance
+        df = pd.concat([self.location_df, self.location_df.iloc[[7]]],
+                       ignore_index=True)
+        r = location.location_clustering_sweep(df, [10, 0.001, 1.0], [2, 3])
+
+        self.assertEqual(list(r.eps), [0.001, 0.001, 1.0, 1.0, 10, 10])
+        self.assertEqual(list(r.min_samples), [2, 3] * 3)
+
+        for _, z in r.iterrows():
+            expected = location.do_location_clustering(
+                df, eps=z.eps, min_samples=z.min_samples).labels_
+            self.assertTrue(np.all(z.labels == expected))
+
+        self.assertEqual(list(r.cluster), [1, 0, 2, 2, 1, 1])
+        self.assertEqual(r.noise.iloc[0], 7)
+
+        # great circle and vectorized metrics use the blocked path
+        for kwargs in [{'distance_method': 'great_circle'},
+                       {'metric': location.haversine_metric}]:
+            r = location.location_clustering_sweep(
+                df, [0.001, 1.0, 10], [2, 3], block_size=3, **kwargs)
+            for _, z in r.iterrows():
+                expected = location.do_location_clustering(
+                    df, eps=z.eps, min_samples=z.min_samples,
+                    **kwargs).labels_
+                self.assertTrue(np.all(z.labels == expected))
+
+        self.assertRaises(ValueError, location.location_clustering_sweep,
+                          df, [], [2])
+
+        df['date'] = pd.to_datetime('2016-05-18')
+        df = df.set_index('date')
+        r = location.daily_location_clustering_sweep(df, [1.0], [2, 3])
+        self.assertEqual(list(r.columns), ['date', 'eps', 'min_samples',
+                                           'cluster', 'noise'])
+        self.assertEqual(list(r.cluster), [2, 2])
+
+    def test_label_geofences(self):
+        places = [{'name': 'home', 'latitude': 42.44, 'longitude': -76.50,
+                   'radius': 0.2},
+                  {'name': 'work', 'polygon': [(42.45, -76.49),
+                                               (42.45, -76.47),
+                                               (42.46, -76.47),
+                                               (42.46, -76.49)]},
+                  {'name': 'lab', 'polygon': [(42.40, -76.55),
+                                              (42.42, -76.55),
+                                              (42.40, -76.53)]},
+                  # overlaps with home, so it is never used
+                  {'name': 'garden', 'latitude': 42.44,
+                   'longitude': -76.50, 'radius': 0.1}]
+        df = pd.DataFrame({'latitude': [42.4405, 42.455, 42.405, 42.415,
+                                        42.445, 42.44],
+                           'longitude': [-76.5, -76.48, -76.545, -76.535,
+                                         -76.50, -76.50]},
+                          index=list('abcdef'))
+
+        for cell_size in [None, 0.001, 1]:
+            index = location.build_geofence_index(places, cell_size)
+            r = location.label_geofences(df, index)
+            self.assertEqual(list(r.index), list('abcdef'))
+            self.assertEqual(list(r.isnull()), [False, False, False, True,
+                                                True, False])
+            self.assertEqual(list(r.dropna()), ['home', 'work', 'lab',
+                                                'home'])
+
+        self.assertRaises(ValueError, location.build_geofence_index,
+                          [{'name': 'x', 'polygon': [(0, 0), (1, 1)]}])
+
+    def test_assign_to_clusters(self):
+        df = pd.DataFrame({'latitude': [42.44, 42.4401, 42.4399, 42.50,
+                                        42.5001, 42.4999, 45.0],
+                           'longitude': [-76.5] * 6 + [0.0]})
+        labels = [0, 0, 0, 1, 1, 1, -1]
+        new_df = pd.DataFrame({'latitude': [42.441, 42.49, 43.0],
+                               'longitude': [-76.5, -76.5, -76.5]})
+
+        r, distances = location.assign_to_clusters(df, labels, new_df)
+        self.assertEqual(list(r), [0, 1, 1])
+        self.assertAlmostEqual(distances[0], 0.111, places=3)
+
+        r, distances = location.assign_to_clusters(df, labels, new_df,
+                                                    max_distance=5)
+        self.assertEqual(list(r), [0, 1, -1])
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.parallel_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing parallel module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import parallel
+import numpy as np
+import pandas as pd
+import unittest
+
+
+def _dtypes(df):
+    return {c: str(t) for c, t in df.dtypes.items()}
+
+
+def _index_type(df):
+    return type(df.index).__name__
+
+
+def _summary(df):
+    return {'n': len(df), 'total': df.x.sum(),
+            'first_day': df.index[0].date(),
+            'labels': ''.join(df.label)}
+
+
+class ParallelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        users = ['c', 'a', 'b', 'a', 'c', 'c', 'b', 'a', 'c']
+        rng = pd.date_range('1/1/2016', periods=len(users), freq='D',
+                            tz='America/New_York')
+        cls.df = pd.DataFrame({'user_id': users,
+                               'x': np.arange(len(users), dtype=float),
+                               'label': list('abcdefghi')}, index=rng)
+
+    def test_balanced_chunks(self):
+        chunks = parallel._balanced_chunks([10, 1, 1, 9, 1], 2)
+        self.assertEqual(sorted(sum(chunks, [])), [0, 1, 2, 3, 4])
+
+        loads = sorted(sum([10, 1, 1, 9, 1][i] for i in c) for c in chunks)
+        self.assertEqual(loads, [11, 11])
+
+        # never more chunks than groups
+        self.assertEqual(len(parallel._balanced_chunks([3, 4], 8)), 2)
+
+    def test_apply_by_user(self):
+        serial = parallel.apply_by_user(self.df, _summary, n_jobs=1)
+        r = parallel.apply_by_user(self.df, _summary, n_jobs=2)
+
+        self.assertEqual(list(r.user_id), ['a', 'b', 'c'])
+        self.assertEqual(list(r.n), [3, 2, 4])
+        self.assertEqual(list(r.labels), ['bdh', 'cg', 'aefi'])
+        self.assertTrue(r.equals(serial))
+
+        # scalar results are returned as a Series
+        r = parallel.apply_by_user(self.df, len, n_jobs=2)
+        self.assertEqual(list(r.index), ['a', 'b', 'c'])
+        self.assertEqual(list(r.values), [3, 2, 4])
+
+    def test_apply_by_user_dtypes(self):
+        df = self.df.assign(
+            cat=pd.Categorical(list('xyzxyzxyz'), categories=list('zyx')),
+            count=pd.array([1, None, 3, 4, 5, None, 7, 8, 9],
+                           dtype='Int64'),
+            delay=pd.to_timedelta(np.arange(9), unit='m'))
+        df.index = pd.CategoricalIndex(list('pqrpqrpqr'))
+
+        serial = parallel.apply_by_user(df, _dtypes, n_jobs=1)
+        r = parallel.apply_by_user(df, _dtypes, n_jobs=2)
+        self.assertTrue(r.equals(serial))
+        self.assertEqual(r['cat'].iloc[0], 'category')
+        self.assertEqual(r['count'].iloc[0], 'Int64')
+
+        r = parallel.apply_by_user(df, _index_type, n_jobs=2)
+        self.assertEqual(list(r.values), ['CategoricalIndex'] * 3)
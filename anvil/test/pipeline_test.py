@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.pipeline_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing pipeline module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import circadian, location, pipeline
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class FeaturePipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        rng = pd.date_range('2016-01-01', periods=24 * 7, freq='h')
+        self.activity = pd.concat([
+            pd.DataFrame({'user_id': u, 'value': rs.rand(len(rng))},
+                         index=rng) for u in ['u1', 'u2']])
+
+        times = pd.date_range('2016-01-01 07:00', periods=14, freq='12h')
+        times = times + pd.to_timedelta(rs.randint(0, 90, 14), unit='m')
+        self.events = pd.concat([
+            pd.DataFrame({'user_id': u, 'target': ['wake', 'sleep'] * 7,
+                          'completion_time': times}) for u in ['u1', 'u2']])
+
+        rng = pd.date_range('2016-01-01', periods=20, freq='2h')
+        self.gps = pd.DataFrame({'user_id': 'u1',
+                                 'latitude': 42.44 + rs.randn(20) * 1e-4,
+                                 'longitude': -76.5 + rs.randn(20) * 1e-4},
+                                index=rng)
+
+    def test_plan_features(self):
+        order = pipeline.plan_features(['is', 'iv', 'srm'])
+        # hourly bins are shared by IS and IV
+        self.assertEqual(order.count('hourly_bins'), 1)
+        self.assertLess(order.index('hourly_bins'), order.index('is'))
+        self.assertNotIn('gps_local', order)
+        self.assertRaises(ValueError, pipeline.plan_features, ['x'])
+
+    def test_compute_features(self):
+        for n_jobs in [1, None]:
+            r = pipeline.compute_features(
+                pipeline.FEATURES, activity=self.activity,
+                events=self.events, gps=self.gps, n_jobs=n_jobs,
+                hourly_func=lambda z: {'avg': z.value.mean()})
+            self.assertEqual(set(r), set(pipeline.FEATURES))
+
+            for u in ['u1', 'u2']:
+                a = self.activity[self.activity.user_id == u]
+                a = a.assign(hour=a.index.hour)
+                self.assertAlmostEqual(
+                    r['is'][u], circadian.inter_daily_stability(a, 'value'),
+                    places=5)
+                self.assertAlmostEqual(
+                    r['iv'][u],
+                    circadian.intra_daily_variability(a, 'value'), places=5)
+                self.assertEqual(
+                    [z[0] for z in r['sorted_hours'][u]],
+                    [z[0] for z in circadian.sort_by_hourly_values(
+                        a, 'value')])
+
+                e = self.events[self.events.user_id == u]
+                self.assertAlmostEqual(r['srm'][u],
+                                       circadian.calculate_srm(e, 'target'))
+
+            expected = location.daily_location_cluster_count(self.gps)
+            self.assertEqual(list(r['daily_clusters'].cluster),
+                             list(expected.cluster))
+            self.assertEqual(len(r['hourly_distribution']), 2 * 24 * 7)
+
+        self.assertRaises(ValueError, pipeline.compute_features, ['srm'],
+                          activity=self.activity)
+
+    def test_srm_processes(self):
+        # u3 has no target with enough samples
+        events = pd.concat([self.events, pd.DataFrame(
+            {'user_id': ['u3'], 'target': ['wake'],
+             'completion_time': [pd.Timestamp('2016-01-01 08:00')]})])
+        r = pipeline.compute_features(['srm'], events=events, n_jobs=1)
+        self.assertTrue(np.isnan(r['srm']['u3']))
+
+        p = pipeline.compute_features(['srm'], events=events,
+                                      srm_args={'n_jobs': 2})
+        pd.testing.assert_series_equal(p['srm'], r['srm'])
+
+        # SRM uses local times
+        local = pipeline.compute_features(
+            ['srm'], events=events, time_zone='America/New_York',
+            srm_args={'hit_range': 0.25})
+        e = events.copy()
+        e['completion_time'] = pd.DatetimeIndex(
+            e['completion_time']).tz_localize('UTC').tz_convert(
+                'America/New_York')
+        self.assertAlmostEqual(
+            local['srm']['u1'],
+            circadian.calculate_srm(e[e.user_id == 'u1'], 'target',
+                                    hit_range=0.25))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.pyramid_test
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing pyramid module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import circadian, pyramid
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class AggregationPyramidTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        rng = pd.date_range('2016-01-01', periods=60 * 24 * 21, freq='min')
+        self.df = pd.DataFrame({'user_id': rs.choice(['u1', 'u2'], len(rng)),
+                                'x': rs.rand(len(rng)) * 10}, index=rng)
+        self.pyramid = pyramid.build_aggregation_pyramid(self.df, 'x')
+
+    def _expected(self, start, end, freq):
+        v = self.df[self.df.user_id == 'u1'].x
+        v = v[(v.index >= start) & (v.index < end)]
+        r = v.groupby(start + (v.index - start) // pd.Timedelta(freq) *
+                      pd.Timedelta(freq))
+        return r.agg(['count', 'sum', 'mean', 'std', 'min', 'max'])
+
+    def test_query_pyramid(self):
+        for start, end, freq, level in [
+                ('2016-01-03 01:00', '2016-01-03 05:00', '15min', 'minute'),
+                ('2016-01-01', '2016-01-03', '3h', 'hour'),
+                ('2016-01-04', '2016-01-20', '2D', 'day'),
+                ('2016-01-04', '2016-01-18', '7D', 'week')]:
+            start, end = pd.Timestamp(start), pd.Timestamp(end)
+            self.assertEqual(pyramid._pyramid_level(
+                start, end, pd.Timedelta(freq))[0], level)
+
+            r = pyramid.query_pyramid(self.pyramid, 'u1', start, end, freq)
+            expected = self._expected(start, end, freq)
+            self.assertEqual(list(r.index), list(expected.index))
+            self.assertTrue(np.allclose(r.values, expected.values))
+
+        self.assertEqual(len(pyramid.query_pyramid(
+            self.pyramid, 'u3', '2016-01-01', '2016-01-02')), 0)
+        self.assertRaises(ValueError, pyramid.query_pyramid, self.pyramid,
+                          'u1', '2016-01-01 00:00:30', '2016-01-02')
+
+    def test_query_pyramid_hourly_values(self):
+        r = pyramid.query_pyramid_hourly_values(self.pyramid, 'u1',
+                                                '2016-01-01', '2016-01-07')
+        self.assertEqual(len(r), 7 * 24)
+        self.assertEqual(list(r.hour[:3]), [0, 1, 2])
+
+        v = self.df[self.df.user_id == 'u1'].x['2016-01-01':'2016-01-07']
+        expected = v.groupby([v.index.date, v.index.hour]).sum()
+        self.assertTrue(np.allclose(r.value, expected.values))
+        self.assertAlmostEqual(
+            circadian.inter_daily_stability(r, 'value'),
+            circadian.inter_daily_stability(
+                pd.DataFrame({'hour': expected.index.get_level_values(1),
+                              'value': expected.values}), 'value'))
+
+    def test_time_zone_aware_index(self):
+        df = self.df.tz_localize('UTC').tz_convert('America/New_York')
+        p = pyramid.build_aggregation_pyramid(df, 'x')
+
+        # bins follow local time, e.g., weeks start on local Monday
+        week = p['week']['u1']
+        self.assertTrue((week.index.dayofweek == 0).all())
+        self.assertEqual(week.index[0], pd.Timestamp('2015-12-28'))
+
+        start = pd.Timestamp('2016-01-04', tz='America/New_York')
+        r = pyramid.query_pyramid(p, 'u1', start,
+                                  start + pd.Timedelta(days=7), '1D')
+        v = df[df.user_id == 'u1'].x['2016-01-04':'2016-01-10']
+        self.assertEqual(list(r.index.date),
+                         sorted(set(v.index.date)))
+        self.assertTrue(np.allclose(
+            r['sum'], v.groupby(v.index.date).sum().values))
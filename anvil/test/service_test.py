@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.service_test
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing service module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import circadian, service
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import unittest
+
+
+class FeatureServiceTest(unittest.TestCase):
+
+    def test_update_feature_state(self):
+        state = service.create_feature_state(window_days=2)
+
+        service.update_feature_state(state, {
+            'type': 'events', 'user_id': 'u1',
+            'events': [{'time': '2016-05-16T08:00:00', 'target': 'wake'},
+                       {'time': '2016-05-18T08:00:00', 'target': 'wake'},
+                       {'time': '2016-05-17T08:00:00', 'target': 'wake'}]})
+        # only the last two days are kept
+        events = state['users']['u1']['events']
+        self.assertEqual(len(events), 2)
+
+        service.update_feature_state(state, {
+            'type': 'gps', 'user_id': 'u1',
+            'points': [{'time': '2016-05-18T08:00:00',
+                        'latitude': 42.4, 'longitude': -76.5},
+                       {'time': '2016-05-19T08:00:00',
+                        'latitude': 42.4, 'longitude': -76.5},
+                       {'time': '2016-05-18T09:00:00',
+                        'latitude': 42.4, 'longitude': -76.5}]})
+        # points of previous days are discarded
+        self.assertEqual(len(state['users']['u1']['gps']), 1)
+
+        self.assertRaises(ValueError, service.update_feature_state,
+                          state, {'type': 'x', 'user_id': 'u1'})
+
+        # a rejected batch leaves the state unchanged
+        events = list(state['users']['u1']['events'])
+        hourly = {}
+        state['users']['u1']['hourly'] = hourly
+        for message in [
+                {'type': 'events', 'user_id': 'u1',
+                 'events': [{'time': '2016-05-18T09:00:00',
+                             'target': 'sleep'},
+                            {'time': 'x', 'target': 'wake'}]},
+                {'type': 'activity', 'user_id': 'u1',
+                 'values': [{'time': '2016-05-18T09:00:00', 'value': 1},
+                            {'time': '2016-05-18T10:00:00', 'value': 'x'}]},
+                {'type': 'gps', 'user_id': 'u3',
+                 'points': [{'time': '2016-05-18T09:00:00',
+                             'latitude': 42.4}]}]:
+            self.assertRaises((ValueError, KeyError, TypeError),
+                              service.update_feature_state, state, message)
+        self.assertEqual(list(state['users']['u1']['events']), events)
+        self.assertEqual(hourly, {})
+        self.assertNotIn('u3', state['users'])
+
+        # times with an offset are local times
+        self.assertEqual(service.update_feature_state(state, {
+            'type': 'events', 'user_id': 'u1',
+            'events': [{'time': '2016-05-18T09:00:00+00:00',
+                        'target': 'sleep'}]}), 1)
+        self.assertEqual(service.update_feature_state(state, {
+            'type': 'events', 'user_id': 'u1',
+            'events': [{'time': '2016-05-18T10:00:00', 'target': 'sleep'}]}),
+            1)
+        times = [z[0] for z in state['users']['u1']['events']]
+        self.assertTrue(all(t.tz is None for t in times))
+        self.assertEqual(times[-2], pd.Timestamp('2016-05-18 09:00'))
+
+        # querying an unknown user does not create state
+        r = asyncio.run(service.query_features(state, 'u2'))
+        self.assertEqual(r, {'srm': None, 'is': None, 'iv': None,
+                             'clusters': 0})
+        self.assertEqual(list(state['users']), ['u1'])
+
+    def test_serve_features(self):
+        times = pd.date_range('2016-05-16 07:00', periods=12, freq='12h')
+        events = [{'time': t.isoformat(), 'target': k}
+                  for t, k in zip(times, ['wake', 'sleep'] * 6)]
+        rng = pd.date_range('2016-05-16', periods=48, freq='h')
+        values = [{'time': t.isoformat(), 'value': float(i % 24)}
+                  for i, t in enumerate(rng)]
+
+        async def run():
+            with ThreadPoolExecutor(2) as executor:
+                server = await service.serve_features(executor=executor)
+                host, port = server.sockets[0].getsockname()[:2]
+                async with server:
+                    return await service.send_messages(host, port, [
+                        {'type': 'events', 'user_id': 'u1',
+                         'events': events},
+                        {'type': 'activity', 'user_id': 'u1',
+                         'values': values},
+                        {'type': 'query', 'user_id': 'u1',
+                         'features': ['srm', 'is', 'iv']},
+                        {'type': 'query', 'user_id': 'u2'},
+                        {'type': 'query', 'user_id': 'u1',
+                         'features': ['x']}])
+
+        r = asyncio.run(run())
+
+        self.assertEqual(r[0], {'accepted': 12})
+        self.assertEqual(r[1], {'accepted': 48})
+
+        df = pd.DataFrame({'completion_time': times,
+                           'target': ['wake', 'sleep'] * 6})
+        self.assertAlmostEqual(r[2]['srm'],
+                               circadian.calculate_srm(df, 'target'))
+        # same activity in both days
+        self.assertAlmostEqual(r[2]['is'], 1.0)
+        self.assertEqual(set(r[2]), {'srm', 'is', 'iv'})
+
+        self.assertEqual(r[3], {'srm': None, 'is': None, 'iv': None,
+                                'clusters': 0})
+        self.assertIn('error', r[4])
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    anvil.test.store_test
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Unit testing store module
+
+    :copyright: (c) 2016 by Saeed Abdullah.
+
+"""
+
+from anvil import circadian, store
+import datetime as dt
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class FeatureStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = store.open_feature_store(':memory:')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_hourly_values(self):
+        rng = pd.date_range('1/1/2016', periods=72, freq='30min')
+        df = pd.DataFrame({'user_id': 'u1',
+                           'steps': np.arange(len(rng), dtype=float)},
+                          index=rng)
+
+        # the rows of the same hour can be appended separately
+        store.append_hourly_values(self.conn, df.iloc[::2], 'steps',
+                                   accumulate=True)
+        store.append_hourly_values(self.conn, df.iloc[1::2], 'steps',
+                                   accumulate=True)
+        # appending a day again replaces it
+        store.append_hourly_values(self.conn, df.loc['2016-01-01'], 'steps')
+
+        r = store.query_hourly_values(self.conn, 'u1',
+                                      dt.date(2016, 1, 1),
+                                      dt.date(2016, 1, 2))
+        self.assertEqual(len(r), 36)
+        self.assertEqual(list(r.hour[:3]), [0, 1, 2])
+        self.assertEqual(list(r.value[:3]), [1, 5, 9])
+        self.assertEqual(r.date.iloc[-1], dt.date(2016, 1, 2))
+
+        r = store.query_hourly_values(self.conn, 'u1',
+                                      dt.date(2016, 1, 2),
+                                      dt.date(2016, 1, 2), how='mean')
+        self.assertEqual(len(r), 12)
+        self.assertEqual(r.value.iloc[0], 48.5)
+
+        expected = store.query_hourly_values(self.conn, 'u1',
+                                             dt.date(2016, 1, 1),
+                                             dt.date(2016, 1, 2))
+        rhythm = store.query_rhythm(self.conn, 'u1', dt.date(2016, 1, 1),
+                                    dt.date(2016, 1, 2))
+        self.assertAlmostEqual(
+            rhythm['is'], circadian.inter_daily_stability(expected, 'value'))
+
+        self.assertEqual(len(store.query_hourly_values(
+            self.conn, 'u2', dt.date(2016, 1, 1), dt.date(2016, 1, 2))), 0)
+
+    def test_srm(self):
+        times = pd.date_range('2016-01-01 07:00', periods=28, freq='12h')
+        times = times + pd.to_timedelta(np.arange(28) % 3 * 10, unit='m')
+        df = pd.DataFrame({'user_id': 'u1',
+                           'target': ['wake', 'sleep'] * 14,
+                           'completion_time': times})
+
+        # append one day at a time
+        for k, v in df.groupby(df.completion_time.dt.date):
+            store.append_srm_events(self.conn, v, 'target')
+        # appending a day again replaces its events
+        store.append_srm_events(self.conn, df.iloc[:2], 'target')
+
+        w = df[df.completion_time < pd.Timestamp('2016-01-08')]
+        self.assertAlmostEqual(
+            store.query_srm(self.conn, 'u1', dt.date(2016, 1, 1),
+                            dt.date(2016, 1, 7)),
+            circadian.calculate_srm(w, 'target'))
+
+        r = store.rolling_srm(self.conn, 'u1', dt.date(2016, 1, 1), 3)
+        self.assertEqual(list(r.date), [dt.date(2016, 1, 1),
+                                        dt.date(2016, 1, 2),
+                                        dt.date(2016, 1, 3)])
+        self.assertAlmostEqual(r.srm.iloc[0],
+                               circadian.calculate_srm(w, 'target'))
+
+        self.assertTrue(np.isnan(store.query_srm(
+            self.conn, 'u1', dt.date(2017, 1, 1), dt.date(2017, 1, 7))))
@@ -12,8 +12,12 @@
 from anvil import utils
 import datetime as dt
 from functools import partial
+import importlib.util
 import numpy as np
+import os
 import pandas as pd
+import shutil
+import tempfile
 import unittest
 
 
@@ -111,3 +115,329 @@ class UtilsTest(unittest.TestCase):
         expected = [0.5] * (len(diff) - 1)
         expected.append(0)  # the last value is zero
         self.assertTrue(np.all(np.isclose(diff, expected)))
+
+    def test_day_number(self):
+        rng = pd.date_range('1/1/1970', periods=3, freq='D')
+        self.assertEqual(list(utils.to_day_number(rng)), [0, 1, 2])
+        self.assertEqual(utils.to_day_number(rng).dtype, np.int32)
+
+        # local date is used for timezone aware values
+        rng = pd.DatetimeIndex(['2016-05-18 23:30']).tz_localize(
+            'America/New_York')
+        self.assertEqual(utils.from_day_number(utils.to_day_number(rng))[0],
+                         dt.date(2016, 5, 18))
+
+    def test_compact_frame(self):
+        df = pd.DataFrame({'user_id': ['a', 'b', 'a'],
+                           'latitude': [42.443961, 42.444151, 42.443898],
+                           'value': [1e9 + 0.5, 1.0, 2.0]})
+        r = utils.compact_frame(df, categorical_cols=['user_id'],
+                                float_cols=['latitude', 'value'])
+
+        self.assertEqual(r.user_id.dtype.name, 'category')
+        self.assertEqual(r.latitude.dtype, np.float32)
+        # float32 can not represent the first value
+        self.assertEqual(r.value.dtype, np.float64)
+        # the given DataFrame is not modified
+        self.assertNotEqual(df.user_id.dtype.name, 'category')
+        self.assertEqual(df.latitude.dtype, np.float64)
+        # unconverted columns are not copied
+        self.assertTrue(np.shares_memory(r.value.values, df.value.values))
+
+    def test_get_hourly_tensor(self):
+        rng = pd.DatetimeIndex(['2011-01-01 00:00', '2011-01-01 00:30',
+                                '2011-01-01 01:00', '2011-01-03 00:10'])
+        df = pd.DataFrame({'user_id': ['b', 'a', 'b', 'b'],
+                           'x': [1.0, 2.0, 3.0, 4.0]}, index=rng)
+
+        tensor, users, days = utils.get_hourly_tensor(df, 'x')
+        self.assertEqual(tensor.shape, (2, 3, 24))
+        self.assertEqual(tensor.dtype, np.float32)
+        self.assertEqual(list(users), ['a', 'b'])
+        self.assertEqual(list(days), [dt.date(2011, 1, 1),
+                                      dt.date(2011, 1, 2),
+                                      dt.date(2011, 1, 3)])
+
+        self.assertEqual(tensor[0, 0, 0], 2)
+        self.assertEqual(tensor[1, 0, 0], 1)
+        self.assertEqual(tensor[1, 0, 1], 3)
+        self.assertEqual(tensor[1, 2, 0], 4)
+        self.assertEqual(np.sum(~np.isnan(tensor)), 4)
+
+        tensor, _, _ = utils.get_hourly_tensor(df, 'x', user_col=None,
+                                               how='mean')
+        self.assertEqual(tensor.shape, (1, 3, 24))
+        self.assertEqual(tensor[0, 0, 0], 1.5)
+
+        # rows without user id are ignored
+        df.loc[rng[1], 'user_id'] = None
+        tensor, users, _ = utils.get_hourly_tensor(df, 'x')
+        self.assertEqual(list(users), ['b'])
+        self.assertEqual(np.nansum(tensor), 8)
+
+        # missing values are ignored
+        df.loc[rng[0], 'x'] = np.nan
+        df.loc[rng[3], 'x'] = np.inf
+        df = pd.concat([df, pd.DataFrame(
+            {'user_id': ['b'], 'x': [5.0]},
+            index=pd.DatetimeIndex(['2011-01-01 01:20']))])
+        tensor, _, days = utils.get_hourly_tensor(df, 'x', how='mean')
+        self.assertEqual(len(days), 1)
+        self.assertTrue(np.isnan(tensor[0, 0, 0]))
+        self.assertEqual(tensor[0, 0, 1], 4)
+        tensor, _, _ = utils.get_hourly_tensor(df, 'x', how='count')
+        self.assertEqual(np.nansum(tensor), 2)
+
+    def test_streaming_outlier_filtering(self):
+        rs = np.random.RandomState(0)
+        df = pd.DataFrame({'x': rs.randn(20000),
+                           'g': rs.choice(['a', 'b'], 20000)})
+        df.loc[df.g == 'b', 'x'] *= 10
+        chunks = [df.iloc[i:i + 1000] for i in range(0, len(df), 1000)]
+
+        r = pd.concat(utils.streaming_outlier_filtering(
+            chunks, filtering_col='x', factor=3, group_col='g'))
+        self.assertEqual(len(r), len(df))
+
+        # agreement with the batch filter on stationary data
+        filtering_f = partial(utils._sd_based_outlier_filtering, factor=3)
+        for k, v in df.groupby('g'):
+            expected = utils.outlier_filtering(v, filtering_col='x',
+                                               filtering_f=filtering_f,
+                                               is_recursive=True)
+            expected = ~v.index.isin(expected.index)
+            agreement = np.mean(r.is_outlier[v.index].values == expected)
+            self.assertGreater(agreement, 0.999)
+
+        # state is kept across calls
+        state = {}
+        for c in chunks[:2]:
+            list(utils.streaming_outlier_filtering([c], 'x', state=state))
+        self.assertEqual(state['moments'].n.sum(), 2000)
+
+        # robust bounds
+        r = pd.concat(utils.streaming_outlier_filtering(
+            chunks, filtering_col='x', group_col='g', sketch_size=500,
+            random_state=0))
+        self.assertTrue(np.all(r.groupby('g').is_outlier.mean() < 0.02))
+        self.assertTrue(r.is_outlier[r.x.abs() > 40].all())
+
+        samples = [rs.randn(n) for n in [1, 2, 7, 100]]
+        q1, q3 = utils._sample_quartiles(samples)
+        expected = np.array([np.percentile(z, [25, 75]) for z in samples])
+        self.assertTrue(np.allclose(q1, expected[:, 0]))
+        self.assertTrue(np.allclose(q3, expected[:, 1]))
+
+    def test_iter_batches(self):
+        records = ({'x': i} for i in range(5))
+        r = list(utils.iter_batches(records, 2))
+        self.assertEqual([len(z) for z in r], [2, 2, 1])
+        self.assertEqual(list(pd.concat(r).x), list(range(5)))
+
+        r = list(utils.iter_batches([], None))
+        self.assertEqual(len(r), 1)
+        self.assertEqual(len(r[0]), 0)
+
+    def test_result_sinks(self):
+        rng = pd.date_range('1/1/2016', periods=72, freq='h')
+        df = pd.DataFrame({'steps': np.arange(len(rng), dtype=float)},
+                          index=rng)
+
+        def func(z):
+            return {'total': z.steps.sum()}
+
+        expected = utils.get_hourly_distribution(df, func, compact=True)
+
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'hourly.csv')
+            self.assertIsNone(utils.get_hourly_distribution(
+                df, func, compact=True, sink=utils.csv_sink(path),
+                batch_size=10))
+            r = pd.read_csv(path)
+            self.assertEqual(len(r), len(expected))
+            self.assertEqual(list(r.total), list(expected.total))
+            self.assertEqual(list(r.date), list(expected.date))
+
+            # later batches follow the columns of the first one
+            path = os.path.join(d, 'mixed.csv')
+            sink = utils.csv_sink(path)
+            sink(pd.DataFrame({'a': [1], 'b': [2]}))
+            sink(pd.DataFrame({'b': [3], 'c': [4]}))
+            utils.csv_sink(path)(pd.DataFrame({'b': [5], 'a': [6]}))
+            r = pd.read_csv(path)
+            self.assertEqual(list(r.columns), ['a', 'b'])
+            self.assertEqual(list(r.b), [2, 3, 5])
+            self.assertEqual(list(r.a.fillna(0)), [1, 0, 6])
+        finally:
+            shutil.rmtree(d)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'),
+                         'requires pyarrow')
+    def test_parquet_sink(self):
+        d = tempfile.mkdtemp()
+        try:
+            sink = utils.parquet_sink(os.path.join(d, 'out'))
+            sink(pd.DataFrame({'x': [1, 2]}))
+            sink(pd.DataFrame({'x': [3]}))
+            r = pd.read_parquet(os.path.join(d, 'out'))
+            self.assertEqual(sorted(r.x), [1, 2, 3])
+        finally:
+            shutil.rmtree(d)
+
+    def test_sessionize(self):
+        index = pd.to_datetime(['2016-01-01 09:50', '2016-01-01 09:55',
+                                '2016-01-01 10:20', '2016-01-01 10:21',
+                                '2016-01-01 10:22', '2016-01-01 23:30',
+                                '2016-01-02 00:30', '2016-01-02 01:00',
+                                '2016-01-01 08:00', '2016-01-01 08:10'])
+        df = pd.DataFrame({'user_id': ['u1'] * 8 + ['u2'] * 2,
+                           'screen': ['on', 'on', 'off', 'off', 'on', 'off',
+                                      'on', 'off', 'on', 'unlock']},
+                          index=index)
+
+        # the last 'on' of u2 is never turned off
+        r = utils.sessionize(df.sample(frac=1, random_state=0), 'screen')
+        self.assertEqual(list(r.user_id), ['u1'] * 3)
+        self.assertEqual(list(r.start), list(index[[0, 4, 6]]))
+        self.assertEqual(list(r.end), list(index[[2, 5, 7]]))
+
+        r = utils.sessionize(df, 'screen', max_gap='5min')
+        self.assertEqual(list(r.start), list(index[[0, 6]]))
+        self.assertEqual(list(r.end), list(index[[5, 7]]))
+
+        sessions = utils.sessionize(df, 'screen')
+        r = utils.split_sessions(sessions, '1D')
+        self.assertEqual(len(r), 3)
+
+        r = utils.get_hourly_usage(sessions)
+        self.assertEqual(len(r), 16)
+        self.assertEqual(list(r.hour[:3]), [9, 10, 11])
+        self.assertEqual(list(r.minutes[:3]), [10, 58, 60])
+        self.assertEqual(r.date.iloc[-1], dt.date(2016, 1, 2))
+        self.assertEqual(r.minutes.sum(), 30 + 788 + 30)
+
+        # time zone aware index keeps local hours
+        tz_df = df.copy()
+        tz_df.index = index.tz_localize('America/New_York')
+        r = utils.get_hourly_usage(utils.sessionize(tz_df, 'screen'))
+        self.assertEqual(list(r.hour[:3]), [9, 10, 11])
+        self.assertEqual(r.date.iloc[-1], dt.date(2016, 1, 2))
+
+        # rows without user id are ignored
+        nan_user = pd.DataFrame({'user_id': [np.nan, np.nan],
+                                 'screen': ['on', 'off']},
+                                index=pd.to_datetime(['2016-01-03 09:00',
+                                                      '2016-01-03 10:00']))
+        r = utils.sessionize(pd.concat([df, nan_user]), 'screen')
+        self.assertEqual(list(r.user_id), ['u1'] * 3)
+        self.assertEqual(list(r.end), list(index[[2, 5, 7]]))
+
+        # 01:00-02:00 is repeated at the end of DST
+        utc = pd.to_datetime(['2016-11-06 05:30', '2016-11-06 05:40',
+                              '2016-11-06 05:50', '2016-11-06 06:10'],
+                             utc=True)
+        dst = pd.DataFrame({'user_id': 'u1',
+                            'screen': ['on', 'off', 'on', 'off']},
+                           index=utc.tz_convert('America/New_York'))
+        r = utils.sessionize(dst.iloc[::-1], 'screen')
+        self.assertEqual(list(r.start), list(pd.to_datetime(
+            ['2016-11-06 01:30', '2016-11-06 01:50'])))
+        self.assertEqual(list(r.duration), [pd.Timedelta(minutes=10),
+                                            pd.Timedelta(minutes=20)])
+        r = utils.sessionize(dst, 'screen', max_gap='10min')
+        self.assertEqual(list(r.duration), [pd.Timedelta(minutes=40)])
+
+    def test_resample_to_grid(self):
+        index = pd.to_datetime(['2016-01-01 01:10', '2016-01-01 03:20',
+                                '2016-01-01 07:00', '2016-01-01 07:30',
+                                '2016-01-01 00:00', '2016-01-01 02:30'])
+        df = pd.DataFrame({'user_id': ['u1'] * 4 + ['u2'] * 2,
+                           'x': [1., 3., 8., 10., 5., 7.]}, index=index)
+
+        values, users, grid = utils.resample_to_grid(df, 'x')
+        self.assertEqual(values.shape, (2, 24))
+        self.assertEqual(values.dtype, np.float32)
+        self.assertEqual(list(users), ['u1', 'u2'])
+        self.assertEqual(grid[0], pd.Timestamp('2016-01-01'))
+        self.assertEqual(values[0, 7], 9)
+        self.assertTrue(np.isnan(values[0, 2]))
+
+        values = utils.resample_to_grid(df, 'x', gaps='zero', how='max')[0]
+        self.assertEqual(list(values[0, :8]), [0, 1, 0, 3, 0, 0, 0, 10])
+
+        values = utils.resample_to_grid(df, 'x', gaps='interpolate')[0]
+        self.assertEqual(list(values[0, 1:8]), [1, 2, 3, 4.5, 6, 7.5, 9])
+        self.assertEqual(list(values[1, :3]), [5, 6, 7])
+        # gaps at the ends are not filled
+        self.assertTrue(np.isnan(values[0, 0]) and np.isnan(values[1, 3]))
+
+        values = utils.resample_to_grid(df, 'x', gaps='interpolate',
+                                        limit=2)[0]
+        self.assertEqual(values[0, 2], 2)
+        self.assertTrue(np.all(np.isnan(values[0, 4:7])))
+
+        values, users, grid = utils.resample_to_grid(df, 'x', freq='4h',
+                                                     how='count')
+        self.assertEqual(list(values[0, :2]), [2, 2])
+
+        self.assertRaises(ValueError, utils.resample_to_grid, df, 'x',
+                          gaps='x')
+
+        # rows without user id are ignored
+        df.loc[index[4], 'user_id'] = None
+        values, users, grid = utils.resample_to_grid(df, 'x', how='count')
+        self.assertEqual(list(users), ['u1', 'u2'])
+        self.assertEqual(np.nansum(values), 5)
+
+    def test_completeness_index(self):
+        index = pd.to_datetime(['2016-01-01 00:30', '2016-01-01 00:40',
+                                '2016-01-01 06:00', '2016-01-02 12:00',
+                                '2016-01-01 12:00'])
+        df = pd.DataFrame({'user_id': ['u1', 'u1', 'u1', 'u1', 'u2'],
+                           'x': 1.0}, index=index)
+
+        r = utils.completeness_index(df)
+        self.assertEqual(list(r.user_id), ['u1', 'u1', 'u2'])
+        self.assertEqual(list(r.date), [dt.date(2016, 1, 1),
+                                        dt.date(2016, 1, 2),
+                                        dt.date(2016, 1, 1)])
+        self.assertEqual(list(r.samples), [3, 1, 1])
+        self.assertEqual(list(r.covered_hours), [2, 1, 1])
+        # from 06:00 to midnight
+        self.assertEqual(list(r.longest_gap), [18 * 60, 12 * 60, 12 * 60])
+
+        # rows without user id are ignored
+        nan_user = pd.DataFrame({'user_id': [np.nan], 'x': 1.0},
+                                index=pd.to_datetime(['2016-01-02 13:00']))
+        r2 = utils.completeness_index(pd.concat([df, nan_user]))
+        self.assertEqual(list(r2.user_id), list(r.user_id))
+        self.assertEqual(list(r2.samples), [3, 1, 1])
+        self.assertEqual(list(r2.longest_gap), list(r.longest_gap))
+
+        r = utils.completeness_index(df, by='hour')
+        self.assertEqual(list(r.hour[:2]), [0, 6])
+        self.assertEqual(list(r.covered_minutes[:2]), [2, 1])
+        self.assertEqual(r.longest_gap.iloc[0], 30)
+
+        valid = utils.select_valid_days(utils.completeness_index(df),
+                                        min_samples=1, max_gap=13 * 60)
+        self.assertEqual(len(valid), 2)
+        r = utils.filter_valid_dates(df, valid, user_col='user_id')
+        self.assertEqual(list(r.index), list(index[[3, 4]]))
+        r = utils.filter_valid_dates(df, [dt.date(2016, 1, 1)])
+        self.assertEqual(len(r), 4)
+
+        # 2016-01-01 is only valid for u2
+        r = utils.get_hourly_distribution(df, lambda z: {'n': len(z)},
+                                          valid_dates=valid)
+        self.assertEqual(list(r.n), [1, 1])
+        u1 = df[df.user_id == 'u1'].drop(columns='user_id')
+        self.assertRaises(ValueError, utils.filter_valid_dates, u1, valid)
+        r = utils.filter_valid_dates(u1, valid[valid.user_id == 'u1'])
+        self.assertEqual(list(r.index), list(index[[3]]))
+
+        r = utils.get_hourly_distribution(df, lambda z: {'n': len(z)},
+                                          compact=True,
+                                          valid_dates=[dt.date(2016, 1, 2)])
+        self.assertEqual(list(r.n), [1])
@@ -9,6 +9,9 @@
 
 """
 
+import os
+
+import numpy as np
 import pandas as pd
 
 
@@ -190,7 +193,507 @@ def outlier_filtering(df, filtering_col,
         return df2
 
 
-def get_hourly_distribution(df, func):
+def _merge_moments(moments, values, keys):
+    """
+    Merges running moments with a chunk of values.
+
+    Uses the parallel variant of Welford's algorithm (Chan et al.),
+    so moments of a chunk are merged without revisiting older values.
+
+    Parameters
+    ----------
+    moments : DataFrame
+        Running moments indexed by group with n, mean and m2 columns.
+    values : Series
+    keys : array-like
+        Group of each value.
+
+    Returns
+    -------
+    DataFrame
+        Merged moments.
+    """
+
+    g = values.groupby(keys)
+    n = g.count()
+    c = pd.DataFrame({'n': n, 'mean': g.mean(),
+                      'm2': g.var(ddof=0).fillna(0) * n})
+
+    index = moments.index.union(c.index)
+    s = moments.reindex(index, fill_value=0)
+    c = c.reindex(index, fill_value=0)
+
+    total = s['n'] + c['n']
+    delta = c['mean'] - s['mean']
+    return pd.DataFrame({
+        'n': total,
+        'mean': s['mean'] + delta * c['n'] / total,
+        'm2': s['m2'] + c['m2'] + delta**2 * s['n'] * c['n'] / total})
+
+
+def _update_reservoirs(reservoirs, values, keys, size, random_state):
+    """
+    Updates per group reservoir samples (algorithm R).
+
+    Parameters
+    ----------
+    reservoirs : dict
+        Group -> (sample array, number of seen values).
+    values : Series
+    keys : array-like
+        Group of each value.
+    size : int
+        Maximum reservoir size.
+    random_state : np.random.RandomState
+    """
+
+    for k, v in values.groupby(keys):
+        v = v.values
+        sample, seen = reservoirs.get(k, (np.empty(0), 0))
+
+        fill = min(size - len(sample), len(v))
+        sample = np.concatenate([sample, v[:fill]])
+
+        rest = v[fill:]
+        if len(rest) > 0:
+            # value i (0-based position in the stream) replaces a random
+            # element with probability size / (i + 1)
+            j = random_state.randint(0, seen + fill + np.arange(len(rest)) + 1)
+            replace = j < size
+            sample[j[replace]] = rest[replace]
+
+        reservoirs[k] = (sample, seen + len(v))
+
+
+def _sample_quartiles(samples):
+    """
+    Computes first and third quartiles of many samples at once.
+
+    Quartiles are linearly interpolated, as in `np.percentile`.
+
+    Parameters
+    ----------
+    samples : list
+        Non-empty arrays.
+
+    Returns
+    -------
+    tuple
+        (q1, q3) arrays with one value for each sample.
+    """
+
+    sizes = np.array([len(z) for z in samples], dtype=int)
+    if len(sizes) == 0:
+        return np.empty(0), np.empty(0)
+
+    values = np.concatenate(samples)
+    order = np.lexsort((values, np.repeat(np.arange(len(sizes)), sizes)))
+    values = values[order]
+    starts = np.cumsum(sizes) - sizes
+
+    r = []
+    for q in (0.25, 0.75):
+        pos = q * (sizes - 1)
+        lo = np.floor(pos).astype(int)
+        hi = np.minimum(lo + 1, sizes - 1)
+        a, b = values[starts + lo], values[starts + hi]
+        r.append(a + (pos - lo) * (b - a))
+
+    return r[0], r[1]
+
+
+def streaming_outlier_filtering(chunks, filtering_col, factor=1.5,
+                                group_col=None, sketch_size=None,
+                                outlier_col='is_outlier',
+                                random_state=None, state=None):
+    """
+    Marks outliers in a stream of DataFrame chunks.
+
+    It is the streaming version of `outlier_filtering` with
+    `_sd_based_outlier_filtering`. Each chunk is processed once:
+    running mean and SD (Welford) of each group are updated with the
+    chunk and values outside of mean ± factor * SD are marked as
+    outliers. So, memory usage only depends on the number of groups.
+
+    If `sketch_size` is given, a reservoir sample of that size is kept
+    for each group and robust bounds q1 - factor * IQR and
+    q3 + factor * IQR (from the sample quartiles) are used instead.
+
+    Parameters
+    ----------
+    chunks : iterable
+        DataFrame chunks.
+    filtering_col : str
+        Filtering column name.
+    factor : float
+        Threshold window size. Default is 1.5.
+    group_col : str
+        Column for computing bounds separately for each group
+        (e.g., user id). Default is None.
+    sketch_size : int
+        Reservoir size for robust bounds. Default is None, i.e.,
+        mean ± factor * SD is used.
+    outlier_col : str
+        Name of the added Boolean column where True indicates outlier.
+        Default is 'is_outlier'.
+    random_state : int
+        Seed for the reservoir sampling. Default is None.
+    state : dict
+        If given, running statistics are kept in this dictionary, so
+        a stream can be processed across several calls. Default is
+        None.
+
+    Returns
+    -------
+    generator
+        Chunks with `outlier_col` column.
+
+    Notes
+    -----
+        Bounds are computed from values seen so far (including the
+        current chunk), so the first chunks use less accurate bounds.
+        For stationary data, the running moments converge to the
+        batch ones and the marks agree with `outlier_filtering` with
+        `is_recursive=False`. The recursive batch filter keeps
+        removing tails as long as any value falls outside the window.
+        For small factors (e.g., 1.5 on Gaussian data) it discards
+        most values, while for factor >= 3 it stops after about one
+        pass and the streaming marks agree with it as well.
+    """
+
+    if state is None:
+        state = {}
+    state.setdefault('moments', pd.DataFrame({'n': [], 'mean': [], 'm2': []}))
+    state.setdefault('reservoirs', {})
+
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    for chunk in chunks:
+        col = chunk[filtering_col]
+        if group_col is None:
+            keys = np.zeros(len(chunk), dtype=int)
+        else:
+            keys = chunk[group_col].values
+
+        if sketch_size is None:
+            state['moments'] = m = _merge_moments(state['moments'], col, keys)
+            mean = m['mean'].reindex(keys).values
+            threshold = np.sqrt(m['m2'] / (m['n'] - 1)).reindex(keys).values\
+                * factor
+            min_val, max_val = mean - threshold, mean + threshold
+        else:
+            _update_reservoirs(state['reservoirs'], col, keys, sketch_size,
+                               random_state)
+            # only the groups of this chunk are needed
+            codes, groups = pd.factorize(keys)
+            q1, q3 = _sample_quartiles(
+                [state['reservoirs'][k][0] for k in groups])
+            iqr = q3 - q1
+            min_val = (q1 - factor * iqr)[codes]
+            max_val = (q3 + factor * iqr)[codes]
+
+        chunk = chunk.copy()
+        values = col.values
+        chunk[outlier_col] = ~((min_val < values) & (values < max_val))
+        yield chunk
+
+
+def to_day_number(dates):
+    """
+    Converts dates to day numbers.
+
+    Day number is the number of days since 1970-01-01. For
+    timezone aware timestamps, the local date is used.
+
+    Parameters
+    ----------
+    dates : DatetimeIndex, Series or iterable
+        Timestamps or `datetime.date` values.
+
+    Returns
+    -------
+    ndarray
+        int32 day numbers.
+    """
+
+    dates = pd.DatetimeIndex(dates)
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+
+    return dates.values.astype('datetime64[D]').astype('i8').astype('i4')
+
+
+def from_day_number(numbers):
+    """
+    Converts day numbers to dates.
+
+    Inverse of `to_day_number`.
+
+    Parameters
+    ----------
+    numbers : array-like
+        Day numbers.
+
+    Returns
+    -------
+    ndarray
+        Array of `datetime.date`.
+    """
+
+    return np.asarray(numbers).astype('datetime64[D]').astype(object)
+
+
+def compact_frame(df, categorical_cols=(), float_cols=(), atol=1e-5):
+    """
+    Converts columns to compact dtypes.
+
+    Parameters
+    ----------
+    df : DataFrame
+    categorical_cols : iterable
+        Columns (e.g., user ids or target names) that should be
+        converted to categoricals.
+    float_cols : iterable
+        Columns (e.g., latitude or longitude) that should be converted
+        to float32. A column is only converted if the precision allows,
+        i.e., no value changes by more than `atol`.
+    atol : float
+        Maximum absolute error for float32 conversion. The default
+        (1e-5) is about a meter for coordinates.
+
+    Returns
+    -------
+    DataFrame
+        A new DataFrame with converted columns. Other columns are not
+        copied.
+    """
+
+    df = df.copy(deep=False)
+
+    for c in categorical_cols:
+        if not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype('category')
+
+    for c in float_cols:
+        x = df[c].values
+        y = x.astype('f4')
+        if np.all(np.isclose(x, y, rtol=0, atol=atol, equal_nan=True)):
+            df[c] = y
+
+    return df
+
+
+def get_hourly_tensor(df, value_col, user_col='user_id', how='sum'):
+    """
+    Bins values into a dense users x days x 24 array.
+
+    All values are binned in one pass using `np.bincount`. The array
+    can be used with `inter_daily_stability`, `intra_daily_variability`
+    and `sort_by_hourly_values` in `anvil.circadian` to compute
+    metrics for all users simultaneously.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time).
+    value_col : str
+        Column with values. Missing (and infinite) values are ignored.
+    user_col : str
+        User id column. Rows without user id are ignored. If `None`,
+        all rows belong to a single user. Default is 'user_id'.
+    how : str
+        Either 'sum', 'mean' or 'count' of values in each hour.
+        Default is 'sum'.
+
+    Returns
+    -------
+    tuple
+        (tensor, users, days) where tensor is a float32 array of shape
+        (users, days, 24) with NaN for hours without any value, users
+        is the sorted user ids and days is an array of `datetime.date`
+        from the first to the last date (inclusive).
+    """
+
+    if how not in ('sum', 'mean', 'count'):
+        raise ValueError('Unknown aggregation: {0}. Must be either '
+                         'sum, mean or count'.format(how))
+
+    df = df[np.isfinite(df[value_col].values.astype('f8'))]
+    if user_col is None:
+        user_codes, users = np.zeros(len(df), dtype=int), pd.Index([None])
+    else:
+        df = df[df[user_col].notnull()]
+        user_codes, users = pd.factorize(df[user_col], sort=True)
+
+    day_numbers = to_day_number(df.index)
+    hours = pd.DatetimeIndex(df.index).hour.values
+
+    first = day_numbers.min() if len(df) > 0 else 0
+    n_days = day_numbers.max() - first + 1 if len(df) > 0 else 0
+    n_cells = len(users) * n_days * 24
+
+    flat = (user_codes * n_days + (day_numbers - first)) * 24 + hours
+    counts = np.bincount(flat, minlength=n_cells)
+
+    if how == 'count':
+        tensor = counts.astype('f4')
+    else:
+        tensor = np.bincount(flat, weights=df[value_col].values,
+                             minlength=n_cells)
+        if how == 'mean':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tensor = tensor / counts
+        tensor = tensor.astype('f4')
+
+    tensor[counts == 0] = np.nan
+    days = from_day_number(np.arange(first, first + n_days))
+
+    return tensor.reshape(len(users), n_days, 24), users, days
+
+
+GAP_POLICIES = ('nan', 'zero', 'interpolate')
+
+
+def _interpolate_gaps(values, missing, limit=None):
+    """
+    Linearly interpolates missing bins (in place) along the rows.
+
+    Only gaps with values on both sides and of at most `limit` bins
+    are filled.
+    """
+
+    n = values.shape[1]
+    position = np.arange(n)
+
+    prev = np.where(missing, -1, position)
+    np.maximum.accumulate(prev, axis=1, out=prev)
+    nxt = np.where(missing, n, position)
+    nxt = np.minimum.accumulate(nxt[:, ::-1], axis=1)[:, ::-1]
+
+    fill = missing & (prev >= 0) & (nxt < n)
+    if limit is not None:
+        fill &= (nxt - prev - 1) <= limit
+
+    rows, cols = np.nonzero(fill)
+    p, q = prev[rows, cols], nxt[rows, cols]
+    a, b = values[rows, p], values[rows, q]
+    values[rows, cols] = a + (b - a) * (cols - p) / (q - p)
+
+
+def resample_to_grid(df, value_col, user_col='user_id', freq='1h',
+                     how='mean', gaps='nan', limit=None, start=None,
+                     end=None):
+    """
+    Resamples irregular values of all users onto a regular grid.
+
+    All values are binned in one pass, and gaps are handled for all
+    users simultaneously. With hourly bins (the default) and a grid
+    starting at midnight, the result can be passed directly to
+    `inter_daily_stability`, `intra_daily_variability` and
+    `sort_by_hourly_values` in `anvil.circadian`.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time). It does not
+        need to be sorted.
+    value_col : str
+        Column with values. Missing values are ignored.
+    user_col : str
+        User id column. Rows without user id are ignored. If `None`,
+        all rows belong to a single user. Default is 'user_id'.
+    freq : str or Timedelta
+        Bin length. Default is '1h'.
+    how : str
+        Either 'sum', 'mean', 'count', 'min' or 'max' of values in
+        each bin. Default is 'mean'.
+    gaps : str
+        Policy for bins without any value: 'nan', 'zero' or
+        'interpolate' (linear interpolation between the values on
+        both sides; other gaps are NaN). Default is 'nan'.
+    limit : int
+        Maximum length (in bins) of gaps filled by 'interpolate'.
+        Longer gaps are left as NaN. Default is None, i.e., no limit.
+    start : DateTime
+        Start of the grid. Default is the midnight of the first date.
+    end : DateTime
+        End of the grid (exclusive). Values outside of the grid are
+        ignored. Default is the midnight after the last date.
+
+    Returns
+    -------
+    tuple
+        (values, users, grid) where values is a float32 array of shape
+        (users, bins), users is the sorted user ids and grid is the
+        `DatetimeIndex` of the start of the bins.
+    """
+
+    if how not in ('sum', 'mean', 'count', 'min', 'max'):
+        raise ValueError('Unknown aggregation: {0}. Must be either '
+                         'sum, mean, count, min or max'.format(how))
+    if gaps not in GAP_POLICIES:
+        raise ValueError('Unknown gap policy: {0}. Must be one of '
+                         '{1}'.format(gaps, GAP_POLICIES))
+
+    index = pd.DatetimeIndex(df.index)
+    values = df[value_col].values.astype('f8')
+    valid = ~np.isnan(values)
+
+    if user_col is None:
+        user_codes, users = np.zeros(len(df), dtype=int), pd.Index([None])
+    else:
+        user_codes, users = pd.factorize(df[user_col], sort=True)
+        # rows without user id
+        valid &= user_codes >= 0
+
+    if valid.any():
+        first, last = index[valid].min(), index[valid].max()
+    else:
+        first = last = pd.Timestamp(0)
+    start = first.normalize() if start is None else pd.Timestamp(start)
+    end = (last.normalize() + pd.Timedelta(days=1) if end is None
+           else pd.Timestamp(end))
+
+    f = pd.Timedelta(freq).value
+    n_ns = _to_nanoseconds([end])[0] - _to_nanoseconds([start])[0]
+    n_bins = max(0, -(-n_ns // f))
+
+    bins = (_to_nanoseconds(index) - _to_nanoseconds([start])[0]) // f
+    valid &= (bins >= 0) & (bins < n_bins)
+    flat = user_codes[valid] * n_bins + bins[valid]
+    values = values[valid]
+    n_cells = len(users) * n_bins
+
+    counts = np.bincount(flat, minlength=n_cells)
+    if how == 'count':
+        r = counts.astype('f8')
+    elif how in ('sum', 'mean'):
+        r = np.bincount(flat, weights=values, minlength=n_cells)
+        if how == 'mean':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = r / counts
+    elif how == 'min':
+        r = np.full(n_cells, np.inf)
+        np.minimum.at(r, flat, values)
+    else:
+        r = np.full(n_cells, -np.inf)
+        np.maximum.at(r, flat, values)
+
+    r = r.reshape(len(users), n_bins)
+    missing = (counts == 0).reshape(r.shape)
+    r[missing] = 0 if gaps == 'zero' else np.nan
+    if gaps == 'interpolate':
+        _interpolate_gaps(r, missing, limit=limit)
+
+    grid = pd.DatetimeIndex(start + pd.Timedelta(f, unit='ns') *
+                            np.arange(n_bins))
+
+    return r.astype('f4'), users, grid
+
+
+def get_hourly_distribution(df, func, compact=False, sink=None,
+                            batch_size=1000, valid_dates=None):
     """
     Computes hourly distribution across the days.
 
@@ -216,12 +719,32 @@ def get_hourly_distribution(df, func):
         the calls. Since 'date' and 'hour' keys are already used,
         this function should not use these keys.
 
+    compact : bool
+        If the result should use compact dtypes: 'date' contains
+        int32 day numbers (see `to_day_number`), 'hour' is int8
+        and float columns are float32 where precision allows.
+        Default is False.
+
+    sink : function
+        If given, results are passed to `sink` in DataFrame batches
+        of (at most) `batch_size` rows as they are computed, instead
+        of being returned. See `csv_sink` and `parquet_sink`.
+        Default is None.
+
+    batch_size : int
+        Number of rows in each batch passed to `sink`. Default is 1000.
+
+    valid_dates : iterable or DataFrame
+        If given, only the rows of these dates are used (see
+        `filter_valid_dates` and `select_valid_days`). Default is None.
+
 
     Returns
     -------
     r : DataFrame
         Returns a DataFrame with 'hour', 'date' and the keys of the
-        dictionary returned by `func` as columns.
+        dictionary returned by `func` as columns. If `sink` is given,
+        `None` is returned.
 
     Note
     ----
@@ -229,13 +752,543 @@ def get_hourly_distribution(df, func):
         as keys while returning the calculated dictionary.
     """
 
-    l = []
+    batches = iter_hourly_distribution(
+        df, func, compact=compact,
+        batch_size=batch_size if sink is not None else None,
+        valid_dates=valid_dates)
 
-    for k, v in df.groupby(lambda z: z.date()):
-        for k1, v1 in v.groupby(lambda z: z.hour):
+    if sink is not None:
+        for r in batches:
+            sink(r)
+        return None
+
+    return next(batches)
+
+
+def _hourly_distribution_records(df, func, compact):
+    """
+    Generates rows of `get_hourly_distribution` as dictionaries.
+    """
+
+    if compact:
+        days = to_day_number(df.index)
+        hours = pd.DatetimeIndex(df.index).hour.values.astype('i1')
+
+        for (k, k1), v1 in df.groupby([days, hours]):
             d = {'hour': k1, 'date': k}
             d.update(func(v1))
-            l.append(d)
+            yield d
+    else:
+        for k, v in df.groupby(lambda z: z.date()):
+            for k1, v1 in v.groupby(lambda z: z.hour):
+                d = {'hour': k1, 'date': k}
+                d.update(func(v1))
+                yield d
+
+
+def iter_hourly_distribution(df, func, compact=False, batch_size=1000,
+                             valid_dates=None):
+    """
+    Computes hourly distribution in batches.
+
+    It yields the rows of `get_hourly_distribution` as DataFrame
+    batches while they are computed, so the whole result is never
+    kept in memory.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex`.
+    func : function
+        See `get_hourly_distribution`.
+    compact : bool
+        See `get_hourly_distribution`.
+    batch_size : int
+        Maximum number of rows in each batch. If `None`, a single
+        batch (possibly empty) with all rows is yielded.
+        Default is 1000.
+    valid_dates : iterable or DataFrame
+        See `get_hourly_distribution`.
+
+    Returns
+    -------
+    generator
+        DataFrame batches.
+    """
+
+    if valid_dates is not None:
+        df = filter_valid_dates(df, valid_dates)
+
+    for r in iter_batches(_hourly_distribution_records(df, func, compact),
+                          batch_size):
+        if compact and len(r) > 0:
+            r['date'] = r['date'].astype('i4')
+            r['hour'] = r['hour'].astype('i1')
+            float_cols = [c for c in r.columns if r[c].dtype.kind == 'f']
+            r = compact_frame(r, float_cols=float_cols)
+        yield r
+
+
+def iter_batches(records, batch_size):
+    """
+    Groups records into DataFrame batches.
+
+    Parameters
+    ----------
+    records : iterable
+        Dictionaries (one for each row).
+    batch_size : int
+        Maximum number of rows in each batch. If `None`, a single
+        batch (possibly empty) with all records is yielded.
+
+    Returns
+    -------
+    generator
+        DataFrame batches.
+    """
+
+    if batch_size is None:
+        yield pd.DataFrame(list(records))
+        return
+
+    l = []
+    for d in records:
+        l.append(d)
+        if len(l) >= batch_size:
+            yield pd.DataFrame(l)
+            l = []
+
+    if len(l) > 0:
+        yield pd.DataFrame(l)
+
+
+def csv_sink(path, **kwargs):
+    """
+    Creates a sink that appends batches to a CSV file.
+
+    The header is only written if the file is empty (or does not
+    exist). Columns are fixed by the header (of the existing file or
+    of the first batch), and later batches are reindexed to them, so
+    missing columns are empty and other columns are dropped. Since
+    each batch is written as soon as it is computed, partial results
+    are kept even if the computation fails.
+
+    Parameters
+    ----------
+    path : str
+        CSV file path.
+    **kwargs
+        Keyword arguments passed to `DataFrame.to_csv`.
+
+    Returns
+    -------
+    function
+        A function that takes a DataFrame batch.
+    """
+
+    state = {'columns': None}
+
+    def sink(df):
+        header = not os.path.exists(path) or os.path.getsize(path) == 0
+        if header:
+            state['columns'] = list(df.columns)
+        elif state['columns'] is None:
+            state['columns'] = list(pd.read_csv(
+                path, nrows=0, sep=kwargs.get('sep', ',')).columns)
+        df = df.reindex(columns=state['columns'])
+        df.to_csv(path, mode='a', header=header, index=False, **kwargs)
+
+    return sink
+
+
+def parquet_sink(directory, **kwargs):
+    """
+    Creates a sink that writes batches as Parquet files.
+
+    Each batch is written to a new file (part-00000.parquet,
+    part-00001.parquet and so on) in `directory`, and the directory
+    can be read as one dataset, e.g., `pd.read_parquet(directory)`.
+    It requires a Parquet engine (pyarrow or fastparquet).
+
+    Parameters
+    ----------
+    directory : str
+        Output directory. It is created if it does not exist.
+    **kwargs
+        Keyword arguments passed to `DataFrame.to_parquet`.
+
+    Returns
+    -------
+    function
+        A function that takes a DataFrame batch.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    state = {'part': len([f for f in os.listdir(directory)
+                          if f.endswith('.parquet')])}
+
+    def sink(df):
+        p = os.path.join(directory,
+                         'part-{0:05d}.parquet'.format(state['part']))
+        df.to_parquet(p, index=False, **kwargs)
+        state['part'] += 1
+
+    return sink
+
+
+def _to_nanoseconds(times):
+    """
+    Converts timestamps to int64 nanoseconds of local (wall) time.
+    """
+
+    times = pd.DatetimeIndex(times)
+    if times.tz is not None:
+        times = times.tz_localize(None)
+    return times.values.astype('datetime64[ns]').view('i8')
+
+
+def _to_epoch_nanoseconds(times):
+    """
+    Converts timestamps to int64 nanoseconds since the UTC epoch.
+
+    Time zone naive timestamps are taken as they are.
+    """
+
+    times = pd.DatetimeIndex(times)
+    if times.tz is not None:
+        times = times.tz_convert('UTC').tz_localize(None)
+    return times.values.astype('datetime64[ns]').view('i8')
+
+
+def sessionize(df, state_col, user_col='user_id', on_value='on',
+               off_value='off', max_gap=None):
+    """
+    Creates usage sessions from on/off events (e.g., screen events).
+
+    A session starts at the first 'on' event after an 'off' event (or
+    at the first event of a user) and ends at the next 'off' event.
+    Repeated 'on' or 'off' events are ignored, and so is an 'on' event
+    without a following 'off' event.
+
+    Events are ordered, and durations are computed, by their absolute
+    time. So, with a time zone aware index, sessions spanning a DST
+    change get their real duration.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time). It does not
+        need to be sorted.
+    state_col : str
+        Column with event types.
+    user_col : str
+        User id column. Rows without user id are ignored.
+        Default is 'user_id'.
+    on_value : object
+        Value of `state_col` starting a session. Default is 'on'.
+    off_value : object
+        Value of `state_col` ending a session. Other values are
+        ignored. Default is 'off'.
+    max_gap : str or Timedelta
+        If given, successive sessions of a user separated by at most
+        `max_gap` are merged. Default is None.
+
+    Returns
+    -------
+    DataFrame
+        It contains user id, start and end columns (in local time,
+        without time zone) and duration column (Timedelta), sorted by
+        user and start.
+    """
+
+    state = df[state_col].values
+    is_on = state == on_value
+    valid = (is_on | (state == off_value)) & df[user_col].notnull().values
+
+    codes, users = pd.factorize(df[user_col].values[valid])
+    index = pd.DatetimeIndex(df.index)[valid]
+    t = _to_epoch_nanoseconds(index)
+    order = np.lexsort((t, codes))
+    t, u, is_on = t[order], codes[order], is_on[valid][order]
+    wall = _to_nanoseconds(index)[order]
+
+    # segments of successive events with the same state
+    change = np.ones(len(t), dtype=bool)
+    change[1:] = (u[1:] != u[:-1]) | (is_on[1:] != is_on[:-1])
+    seg = np.flatnonzero(change)
+    seg_on, seg_u = is_on[seg], u[seg]
+
+    # an 'on' segment followed by an 'off' segment of the same user
+    k = np.flatnonzero(seg_on[:-1] & ~seg_on[1:] &
+                       (seg_u[:-1] == seg_u[1:]))
+    # positions of the start and end events
+    start, end, u = seg[k], seg[k + 1], seg_u[k]
+
+    if max_gap is not None and len(start) > 0:
+        gap = pd.Timedelta(max_gap).value
+        new = np.ones(len(start), dtype=bool)
+        new[1:] = (u[1:] != u[:-1]) | (t[start[1:]] - t[end[:-1]] > gap)
+        first = np.flatnonzero(new)
+        # sessions of a user are ordered and do not overlap
+        last = np.r_[first[1:], len(start)] - 1
+        start, end, u = start[first], end[last], u[first]
+
+    return pd.DataFrame({user_col: users[u],
+                         'start': wall[start].view('datetime64[ns]'),
+                         'end': wall[end].view('datetime64[ns]'),
+                         'duration': pd.to_timedelta(t[end] - t[start])})
+
+
+def split_sessions(sessions, freq='1h', user_col='user_id'):
+    """
+    Splits sessions at the boundaries of fixed length bins.
+
+    Parameters
+    ----------
+    sessions : DataFrame
+        DataFrame with user id, start and end columns (see
+        `sessionize`).
+    freq : str or Timedelta
+        Bin length, e.g., '1h' or '1D'. Bins are aligned to midnight.
+        Default is '1h'.
+    user_col : str
+        User id column. Default is 'user_id'.
+
+    Returns
+    -------
+    DataFrame
+        It contains user id, time (start of the bin), start and end
+        columns. Each row is the part of a session in a bin.
+    """
+
+    f = pd.Timedelta(freq).value
+    s = _to_nanoseconds(sessions['start'])
+    e = _to_nanoseconds(sessions['end'])
+    keep = e > s
+    s, e = s[keep], e[keep]
+
+    first = s // f * f
+    k = ((e - 1) // f * f - first) // f + 1
+    i = np.repeat(np.arange(len(s)), k)
+    offset = np.arange(len(i)) - np.repeat(np.cumsum(k) - k, k)
+
+    time = first[i] + offset * f
+    return pd.DataFrame({
+        user_col: sessions[user_col].values[keep][i],
+        'time': time.view('datetime64[ns]'),
+        'start': np.maximum(s[i], time).view('datetime64[ns]'),
+        'end': np.minimum(e[i], time + f).view('datetime64[ns]')})
+
+
+def get_hourly_usage(sessions, user_col='user_id'):
+    """
+    Computes usage minutes in each hour.
+
+    Parameters
+    ----------
+    sessions : DataFrame
+        DataFrame with user id, start and end columns (see
+        `sessionize`).
+    user_col : str
+        User id column. Default is 'user_id'.
+
+    Returns
+    -------
+    DataFrame
+        It contains user id, date, hour and minutes columns, sorted by
+        user, date and hour. Only hours with usage are included.
+    """
+
+    r = split_sessions(sessions, freq='1h', user_col=user_col)
+    minutes = (r['end'] - r['start']) / pd.Timedelta(minutes=1)
+    g = minutes.groupby([r[user_col], r['time']], sort=True).sum()
+
+    time = pd.DatetimeIndex(g.index.get_level_values(1))
+    return pd.DataFrame({user_col: g.index.get_level_values(0),
+                         'date': time.date,
+                         'hour': time.hour,
+                         'minutes': g.values})
+
+
+def completeness_index(df, user_col='user_id', time_col=None, by='day'):
+    """
+    Computes data completeness of each user-day or user-hour.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time), or with
+        timestamps in `time_col`.
+    user_col : str
+        User id column. Rows without user id are ignored. If `None`,
+        all rows belong to a single user. Default is 'user_id'.
+    time_col : str
+        Column with timestamps. If `None`, the index is used.
+        Default is None.
+    by : str
+        Either 'day' or 'hour'. Default is 'day'.
+
+    Returns
+    -------
+    DataFrame
+        One row for each user-day (or user-hour) with at least one
+        sample, sorted by user and time. It contains user id, date
+        (and hour), samples, covered_hours (or covered_minutes for
+        hours), i.e., number of hours (minutes) with at least one
+        sample, and longest_gap columns. The longest gap (in minutes)
+        includes the gaps from the start of the day (hour) to the
+        first sample and from the last sample to the end.
+    """
+
+    if by not in ('day', 'hour'):
+        raise ValueError('Unknown period: {0}. Must be either day '
+                         'or hour'.format(by))
+
+    if user_col is None:
+        user_codes, users = np.zeros(len(df), dtype=int), pd.Index([None])
+    else:
+        df = df[df[user_col].notnull()]
+        user_codes, users = pd.factorize(df[user_col], sort=True)
+
+    times = pd.DatetimeIndex(df.index if time_col is None else df[time_col])
+    t = _to_nanoseconds(times)
+
+    if by == 'day':
+        period, sub = pd.Timedelta(days=1), pd.Timedelta(hours=1)
+    else:
+        period, sub = pd.Timedelta(hours=1), pd.Timedelta(minutes=1)
+    period, sub = period.value, sub.value
+
+    order = np.lexsort((t, user_codes))
+    t, u = t[order], user_codes[order]
+    cell = t // period
+
+    change = np.ones(len(t), dtype=bool)
+    change[1:] = (u[1:] != u[:-1]) | (cell[1:] != cell[:-1])
+    starts = np.flatnonzero(change)
+    ends = np.r_[starts[1:], len(t)] - 1
+
+    new_sub = change.copy()
+    new_sub[1:] |= (t[1:] // sub) != (t[:-1] // sub)
+
+    gaps = np.zeros(len(t), dtype='i8')
+    gaps[:-1] = np.diff(t)
+    gaps[ends] = 0
+    if len(t) > 0:
+        longest = np.maximum.reduceat(gaps, starts)
+        covered = np.add.reduceat(new_sub.astype(int), starts)
+    else:
+        longest = covered = np.zeros(0, dtype='i8')
+
+    cell_start = cell[starts] * period
+    longest = np.maximum(longest, t[starts] - cell_start)
+    longest = np.maximum(longest, cell_start + period - t[ends])
+
+    cell_times = pd.DatetimeIndex(cell_start.view('datetime64[ns]'))
+    r = pd.DataFrame({user_col or 'user_id': users[u[starts]],
+                      'date': cell_times.date})
+    if by == 'hour':
+        r['hour'] = cell_times.hour
+    r['samples'] = ends - starts + 1
+    r['covered_hours' if by == 'day' else 'covered_minutes'] = covered
+    r['longest_gap'] = longest / pd.Timedelta(minutes=1).value
 
-    r = pd.DataFrame(l)
     return r
+
+
+def select_valid_days(index, min_samples=1, min_covered_hours=0,
+                      max_gap=None):
+    """
+    Selects user-days with enough data.
+
+    Parameters
+    ----------
+    index : DataFrame
+        Completeness index by day (see `completeness_index`).
+    min_samples : int
+        Minimum number of samples. Default is 1.
+    min_covered_hours : int
+        Minimum number of hours with at least one sample.
+        Default is 0.
+    max_gap : float
+        Maximum length (in minutes) of the longest gap. Default is
+        None, i.e., no limit.
+
+    Returns
+    -------
+    DataFrame
+        Rows of `index` satisfying all conditions. It can be passed
+        as `valid_dates` to `filter_valid_dates` and to the functions
+        accepting it (e.g., `get_hourly_distribution`,
+        `anvil.circadian.calculate_srm` or
+        `anvil.location.daily_location_cluster_count`).
+    """
+
+    mask = (index['samples'] >= min_samples) & \
+        (index['covered_hours'] >= min_covered_hours)
+    if max_gap is not None:
+        mask &= index['longest_gap'] <= max_gap
+
+    return index[mask]
+
+
+def _as_day_numbers(dates):
+    """
+    Converts dates (or day numbers) to day numbers.
+    """
+
+    if not hasattr(dates, 'dtype'):
+        dates = list(dates)
+    dates = np.asarray(dates)
+    if dates.dtype.kind in 'iu':
+        return dates.astype('i4')
+    return to_day_number(dates)
+
+
+def filter_valid_dates(df, valid_dates, time_col=None, user_col='user_id'):
+    """
+    Keeps rows of valid dates.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with `DateTimeIndex` (in local time), or with
+        timestamps in `time_col`.
+    valid_dates : iterable or DataFrame
+        Dates (or day numbers, see `to_day_number`) to keep. It can
+        also be a DataFrame with a date column (e.g., from
+        `select_valid_days`). If the DataFrame also has `user_col`
+        column, the user-days are matched when `df` has `user_col`
+        column too. Otherwise, it must contain a single user.
+    time_col : str
+        Column with timestamps. If `None`, the index is used.
+        Default is None.
+    user_col : str
+        User id column. Default is 'user_id'.
+
+    Returns
+    -------
+    DataFrame
+        Rows of `df` on valid dates.
+    """
+
+    times = df.index if time_col is None else df[time_col]
+    days = to_day_number(times)
+
+    if isinstance(valid_dates, pd.DataFrame):
+        valid_days = _as_day_numbers(valid_dates['date'].values)
+        if user_col is not None and user_col in valid_dates.columns:
+            if user_col in df.columns:
+                keys = pd.MultiIndex.from_arrays([df[user_col].values,
+                                                  days])
+                mask = keys.isin(pd.MultiIndex.from_arrays(
+                    [valid_dates[user_col].values, valid_days]))
+                return df[mask]
+            if valid_dates[user_col].nunique() > 1:
+                raise ValueError('valid_dates contains several users, but '
+                                 'there is no {0} column to match '
+                                 'them'.format(user_col))
+    else:
+        valid_days = _as_day_numbers(valid_dates)
+
+    return df[np.isin(days, valid_days)]